@@ -57,22 +57,58 @@ def build_ways( args ):
     output    = args.output or 'morpheo_'+os.path.splitext(os.path.basename(shapefile))[0] 
     dbname    = args.dbname or output
 
-    if args.P or args.W:
+    if args.buffer_sweep:
+        # The sweep builds places from clusters of vertices only
+        incompatible = [opt for opt, used in (('-G', args.G), ('-W', args.W), ('--update', args.update),
+                                              ('--input-places', args.input_places is not None),
+                                              ('--bulk-place-vtx', args.bulk_place_vtx)) if used]
+        if incompatible:
+            logging.error("--buffer-sweep cannot be used with {}".format(', '.join(incompatible)))
+            sys.exit(1)
+
+    if args.update:
+        # Patch graph and places from the edited input
+        builder = Builder.from_database( dbname )
+        builder.update_graph(shapefile, args.snap_distance, args.min_edge_length,
+                             buffer_size=args.buffer,
+                             way_attribute=args.way_attribute,
+                             output=output,
+                             workers=args.workers)
+        if args.G or args.P: return
+    elif args.P or args.W:
         builder = Builder.from_database( dbname )
     else:
-        builder = Builder.from_shapefile( shapefile, dbname )
+        if args.resume:
+            # Continue from the last completed sanitizer stage
+            builder = Builder.from_database( dbname )
+        else:
+            builder = Builder.from_shapefile( shapefile, dbname )
     
         # Compute graph
         builder.build_graph(args.snap_distance, args.min_edge_length, args.way_attribute,
-                            output=output)
+                            output=output,
+                            in_memory_cut=args.in_memory_cut,
+                            grid_snap=args.grid_snap,
+                            tile_size=args.tile_size,
+                            tile_halo=args.tile_halo,
+                            workers=args.workers,
+                            resume=args.resume)
 
     if args.G: return
 
-    if not args.W:
+    if args.buffer_sweep:
+        # Compute places for each buffer size
+        builder.sweep_places(args.buffer_sweep, output)
+        return
+
+    if not (args.W or args.update):
         # Compute places
         builder.build_places(buffer_size=args.buffer,
                              places=args.input_places,
-                             output=output)
+                             output=output,
+                             workers=args.workers,
+                             cluster_vertices=args.cluster_places,
+                             bulk_place_vtx=args.bulk_place_vtx)
 
     if args.P: return
 
@@ -85,6 +121,11 @@ def build_ways( args ):
                       closeness     = args.closeness,
                       stress        = args.stress)
 
+    if args.threshold_sweep:
+        # Compute way partitions for each threshold
+        builder.sweep_ways([t/180.0 * pi for t in args.threshold_sweep], output=output)
+        return
+
     if args.way_attribute is not None:
         builder.build_ways_from_attribute(args.way_attribute, output=args.output, **kwargs)
     else:
@@ -311,12 +352,27 @@ def main():
     # Options controlling graph
     ways_cmd.add_argument("--snap-distance"  , metavar='VALUE', type=float, default=0.2, help="Snap distance")
     ways_cmd.add_argument("--min-edge-length", metavar='VALUE', type=float, default=4, help="Min edge length")
+    ways_cmd.add_argument("--in-memory-cut"  , action='store_true', default=False, help="Cut lines at crossing points in memory")
+    ways_cmd.add_argument("--grid-snap"      , action='store_true', default=False, help="Snap vertices to vertices with a hash grid instead of snapping to geometries")
+    ways_cmd.add_argument("--tile-size"      , metavar='VALUE', type=float, default=None, help="Sanitize graph by tiles of the given size (not compatible with --way-attribute)")
+    ways_cmd.add_argument("--tile-halo"      , metavar='VALUE', type=float, default=None, help="Overlap between tiles (default to the largest line extent plus twice the snap distance)")
+    ways_cmd.add_argument("--workers"        , metavar='NUM', type=int, default=1, help="Number of worker processes")
+    ways_cmd.add_argument("--resume"         , action='store_true', default=False, help="Resume an interrupted graph sanitization")
+    ways_cmd.add_argument("--update"         , action='store_true', default=False, help="Update existing graph and places from edited input")
     # Options controlling places
     ways_cmd.add_argument("--buffer"         , metavar='VALUE', type=float, default=4 , help="Place Buffer size")
     ways_cmd.add_argument("--input-places"   , metavar='PATH' , default=None, help="Default input polygons for places")
+    ways_cmd.add_argument("--cluster-places" , action='store_true', default=False, help="Build places from clusters of vertices")
+    ways_cmd.add_argument("--buffer-sweep"   , metavar='VALUE', type=float, nargs='+', default=None, 
+                          help=("Build places from clusters of vertices (see --cluster-places) for each buffer size "
+                                "and stop, ways are not computed. Cannot be used with -G, -W, --update, "
+                                "--input-places or --bulk-place-vtx"))
+    ways_cmd.add_argument("--bulk-place-vtx" , action='store_true', default=False, help="Assign vertices to places in memory")
     # Options controlling ways
     ways_cmd.add_argument("--way-attribute"  , metavar='NAME', default=None, help="Attribute for building street ways")
     ways_cmd.add_argument("--threshold"      , metavar='VALUE', type=float, default=30, help="Treshold angle (in degree)")
+    ways_cmd.add_argument("--threshold-sweep", metavar='VALUE', type=float, nargs='+', default=None,
+                          help="Compute way partitions for each treshold angle (in degree) and stop")
     ways_cmd.add_argument("--rtopo"          , action='store_true', default=False, help="Compute topological radius")
     ways_cmd.add_argument("--attributes"     , action='store_true', default=False, help="Compute attributes")
     ways_cmd.add_argument("--orthogonality"  , action='store_true', default=False, help="Compute orthogonality (require --attributes)")
@@ -10,12 +10,36 @@ import numpy as np
 # Partition
 #-------------------------------
 
+class PartitionTable(np.ndarray):
+    """ Partition table
+
+        An array where each element holds its parent in a union-find
+        forest. Class sizes and minimum indices are stored at the roots
+        so that classes can be linked by size while keeping the minimum
+        index as the partition index.
+    """
+    sizes   = None
+    minimum = None
+
+
 def create_partition( size ):
     """ Init a partition table
         by assigning each element to its
         own equivalence class
     """
-    return np.arange(size)
+    table = np.arange(size).view(PartitionTable)
+    table.sizes   = np.ones(size, dtype=int)
+    table.minimum = np.arange(size)
+    return table
+
+
+def _find( table, k ):
+    """ Return the root of k, halving the path on the way
+    """
+    while table[k] != k:
+        table[k] = table[table[k]]
+        k = table[k]
+    return k
 
 
 def resolve( table, k, j ):
@@ -23,13 +47,40 @@ def resolve( table, k, j ):
 
         :return: the index of the partition
     """
-    while table[j]!=j: 
-        j=table[j]
-    while table[k]!=k:
-        k=table[k]
+    j = _find(table, j)
+    k = _find(table, k)
+    sizes = getattr(table, 'sizes', None)
+    if sizes is None:
+        # Plain array: link by minimum index
+        if j!=k:
+            table[max(j,k)]=min(j,k)
+        return min(j,k)
     if j!=k:
-        table[max(j,k)]=min(j,k)
-    return min(j,k)
+        if sizes[j] < sizes[k]:
+            j, k = k, j
+        table[k] = j
+        sizes[j] += sizes[k]
+        table.minimum[j] = min(table.minimum[j], table.minimum[k])
+    return table.minimum[j]
+
+
+def _flatten( table ):
+    """ Make all elements point to their root by pointer jumping
+    """
+    while True:
+        parent = table[table]
+        if np.array_equal(parent, table):
+            break
+        table[:] = parent
+
+
+def _reset( table ):
+    """ Set roots to minimum indices of a flattened table
+    """
+    if getattr(table, 'minimum', None) is not None:
+        table[:] = table.minimum[table]
+        table.sizes[:]   = np.bincount(table, minlength=len(table))
+        table.minimum[:] = np.arange(len(table))
 
 
 def update( table ):
@@ -37,44 +88,51 @@ def update( table ):
 
         This function has to be called after 
         multiple calls to resolve: it shuffles the partition
-        table in order to assign the corroect partition index
+        table in order to assign the correct partition index
         to all elements from the same equivalent class
     """
-    for j in range(len(table)):
-        while table[j] != table[table[j]]:
-            table[j] = table[table[j]]
+    if len(table):
+        _flatten(table)
+        _reset(table)
+
+
+def resolve_pairs( table, k, j ):
+    """ Assign all pairs of elements k[i], j[i] to the same partitions
+
+        This is the same as calling resolve() for each pair followed
+        by update(), for arrays of pairs: roots are linked to the 
+        smallest root of their pairs until all pairs share the same root.
+    """
+    update(table)
+    k = np.asarray(k, dtype=int)
+    j = np.asarray(j, dtype=int)
+    while len(k):
+        rk, rj = table[k], table[j]
+        diff = rk != rj
+        if not diff.any():
+            break
+        k, j, rk, rj = k[diff], j[diff], rk[diff], rj[diff]
+        np.minimum.at(table, np.maximum(rk,rj), np.minimum(rk,rj))
+        _flatten(table)
+    _reset(table)
 
 
 def num_partitions( table ):
     """ Return the number of equivalence classes.
+
+        The table must have been updated
     """
-    n = 1
-    m = table[0]
-    for j in range(len(table)):
-        if m < table[j]:
-            m = table[j]
-            n = n+1
-    return n
+    return int(np.count_nonzero(table == np.arange(len(table))))
 
 
 def get_index_table( table ):
     """ Create a mapping index table
+
+        Each element is mapped to the rank of its partition, partitions
+        being ordered by partition index. The table must have been updated.
     """
-    sz = len(table)
-    itable = np.full(sz,0,dtype=int)
-    m = table[0]
-    n = 0
-    for j in range(sz):
-        if m < table[j]:
-            m = table[j]
-            n = n+1
-            itable[j] = n
-        elif m > table[j]:
-            itable[j] = itable[table[j]]
-        else:
-            itable[j] = n
-
-    return itable
+    roots = table == np.arange(len(table))
+    return (np.cumsum(roots) - 1)[table]
 
 #-------------------------------
 # Pair matrix 
@@ -143,6 +201,119 @@ def get_value( m, i1, i2 ):
     return m.values[min(i1,i2),max(i1,i2)] 
 
 
+#-------------------------------
+# Vectorized edge pairing
+#-------------------------------
+
+def group_offsets( keys ):
+    """ Return the start offsets and sizes of runs of equal keys
+
+        :param keys: a list of keys such that equal keys are adjacent
+    """
+    n = len(keys)
+    starts = [k for k in range(n) if k == 0 or keys[k] != keys[k-1]]
+    starts = np.array(starts, dtype=int)
+    sizes  = np.diff(np.append(starts, n))
+    return starts, sizes
+
+
+def group_pairs( starts, sizes, min_size=2 ):
+    """ Return all pairs (i, j), i<j, of elements in the same group
+
+        :param starts: start offsets of groups
+        :param sizes: sizes of groups
+        :param min_size: ignore groups with less elements
+        :return: a tuple (g, i, j) of arrays where g is the start offset
+                 of the group of the pair and i, j the element indices
+    """
+    pg, pi, pj = [], [], []
+    for n in np.unique(sizes[sizes >= min_size]):
+        s = starts[sizes == n]
+        ti, tj = np.triu_indices(n, 1)
+        pg.append(np.repeat(s, len(ti)))
+        pi.append((s[:,None] + ti[None,:]).ravel())
+        pj.append((s[:,None] + tj[None,:]).ravel())
+    if not pg:
+        return tuple(np.array([], dtype=int) for _ in range(3))
+    return np.concatenate(pg), np.concatenate(pi), np.concatenate(pj)
+
+
+def sort_pairs( g, i, j, values ):
+    """ Sort pairs by group and value
+
+        Ties are resolved in row-major order so that the pairs of a
+        group are visited in the same order as with next_argmin() on
+        the group's pair matrix.
+
+        :return: the sorting indices
+    """
+    return np.lexsort((j, i, values, g))
+
+
+def greedy_pairing( i, j, size ):
+    """ Pair elements greedily from a sorted list of candidate pairs
+
+        A candidate pair is accepted if none of its elements has been
+        paired before: this is the same as iterating with next_argmin()
+        and calling pop_args() on accepted pairs.
+
+        :param i, j: arrays of candidate pairs in visit order
+        :param size: the number of elements
+        :return: a boolean array of accepted pairs
+    """
+    used   = np.zeros(size, dtype=bool).tolist()
+    accept = np.zeros(len(i), dtype=bool)
+    for k, (e1, e2) in enumerate(zip(i.tolist(), j.tolist())):
+        if not (used[e1] or used[e2]):
+            used[e1] = used[e2] = True
+            accept[k] = True
+    return accept
+
+
+def orthogonality_sums(owners, places, others, angles):
+    """ Sum minimum angles for each owner
+
+        For each owner, take the minimum angle for each (place, other) pair
+        then sum these minimums over all pairs.
+
+        :return: a tuple (owners, sums) of arrays
+    """
+    if len(owners) == 0:
+        return owners, angles
+
+    order = np.lexsort((others, places, owners))
+    owners, places, others, angles = owners[order], places[order], others[order], angles[order]
+
+    first = np.ones(len(owners), dtype=bool)
+    first[1:] = (owners[1:]!=owners[:-1]) | (places[1:]!=places[:-1]) | (others[1:]!=others[:-1])
+    idx  = np.nonzero(first)[0]
+    mins = np.minimum.reduceat(angles, idx)
+    owners = owners[idx]
+
+    first = np.ones(len(owners), dtype=bool)
+    first[1:] = owners[1:]!=owners[:-1]
+    idx  = np.nonzero(first)[0]
+    return owners[idx], np.add.reduceat(mins, idx)
+
+
+def angles_from_azimuths( az1, az2 ):
+    """ Compute angles between arrays of azimuths
+
+        See angle_from_azimuth()
+    """
+    angle = np.abs(az1-az2)
+    angle = np.where(angle > pi, 2*pi - angle, angle)
+    return np.abs(angle - pi)
+
+
+def azimuths( x1, y1, x2, y2 ):
+    """ Compute azimuths for arrays of directions
+
+        See azimuth()
+    """
+    return np.arctan2(x2-x1, y2-y1)
+
+
 def angle_from_azimuth( az1, az2 ):
     """ Compute angle between two azimuths
     """
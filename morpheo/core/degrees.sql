@@ -0,0 +1,38 @@
+-- Update vertices and edges degrees
+--
+-- The 'vertices' parameter is a query returning the ids of the vertices
+-- to update: edges connected to these vertices are updated too.
+-- Use 'SELECT OGC_FID FROM vertices' for updating the whole graph.
+
+-- Degrees are counted from edge end points: loops are counted twice
+
+CREATE TEMP TABLE vertex_degree(ID integer PRIMARY KEY, VALUE integer);
+
+INSERT INTO vertex_degree(ID,VALUE)
+SELECT VTX, Count(1) FROM (
+    SELECT START_VTX AS VTX FROM edges WHERE START_VTX IN ($vertices)
+    UNION ALL
+    SELECT END_VTX AS VTX FROM edges WHERE END_VTX IN ($vertices)
+)
+GROUP BY VTX
+;
+
+UPDATE vertices 
+SET DEGREE = COALESCE((SELECT VALUE FROM vertex_degree WHERE ID=vertices.OGC_FID), 0)
+WHERE OGC_FID IN ($vertices)
+;
+
+DROP TABLE vertex_degree;
+
+-- Update edges degree
+
+UPDATE edges 
+SET DEGREE = 
+        (SELECT DEGREE FROM vertices WHERE vertices.OGC_FID = edges.START_VTX)
+       +(CASE WHEN edges.START_VTX != edges.END_VTX
+         THEN (SELECT DEGREE FROM vertices WHERE vertices.OGC_FID = edges.END_VTX)
+         ELSE 0
+         END)
+       - 2
+WHERE START_VTX IN ($vertices) OR END_VTX IN ($vertices)
+;
@@ -0,0 +1,14 @@
+-- Create edge_ends table: entry point and direction of place edges at places
+-- The azimuth is computed from the end point to the next point of the edge
+
+CREATE TABLE edge_ends(
+    PLACE    integer, -- REFERENCES places(OGC_FID)
+    EDGE     integer, -- REFERENCES place_edges(OGC_FID)
+    IS_START integer,
+    X        real,
+    Y        real,
+    AZIMUTH  real
+);
+
+CREATE INDEX edge_ends_PLACE_idx ON edge_ends(PLACE);
+CREATE INDEX edge_ends_EDGE_idx  ON edge_ends(EDGE);
@@ -2,10 +2,9 @@
 
 import logging
 import networkx as nx
+import numpy as np
 from numpy import sin
-from .logger import Progress
 from .sql import SQL, attr_table, table_exists
-from .angles import azimuth, angle_from_azimuth
 from .classes import compute_classes
 
 
@@ -39,69 +38,41 @@ def iter_places(rows):
         yield p,l
 
 
-def compute_angles(conn, force=False):
-    """ Compute angles between edges at places
+def angle_rows(conn):
+    """ Compute angles between edges of different ways at places
 
-        :param force: if True, force recomputing angles
+        :return: a tuple (places, angles, ways1, edges1, ways2, edges2) of arrays
+                 holding one row for each pair of edges of different ways at 
+                 places, -1 stands for missing places or ways.
     """
-    cur  = conn.cursor()
-    if not force:
-        [count] = cur.execute("SELECT Count(*)>0 FROM way_angles").fetchone()
-        if count:
-            return
+    from .angles import group_offsets, group_pairs, angles_from_azimuths
+    from .places import require_edge_ends
 
-    logging.info("Computing angles between edges")
+    require_edge_ends(conn)
+    cur = conn.cursor()
 
+    # Get edge azimuths at places
     rows = cur.execute(SQL("""SELECT 
-        pl, way, edge,  ST_X(p1), ST_Y(p1), ST_X(p2), ST_Y(p2)
-        FROM (
-            SELECT 
-            START_PL AS pl,
-            WAY AS way,
-            OGC_FID AS edge,
-            ST_StartPoint(GEOMETRY) AS p1, 
-            ST_PointN(GEOMETRY,2) AS p2
-            FROM place_edges
-        UNION ALL
-            SELECT
-            END_PL AS pl,
-            WAY AS way,
-            OGC_FID AS edge,
-            ST_EndPoint(GEOMETRY) AS p1, 
-            ST_PointN(GEOMETRY, ST_NumPoints(GEOMETRY)-1) AS p2
-            FROM place_edges)
-        ORDER BY pl
+        e.PLACE, p.WAY, e.EDGE, e.AZIMUTH
+        FROM edge_ends AS e, place_edges AS p
+        WHERE p.OGC_FID=e.EDGE
+        ORDER BY e.PLACE, e.ROWID
     """)).fetchall()
 
-    # compute azimuths
-    way_places = [(r[0],r[1],r[2], azimuth(*r[3:])) for r in rows]
-
     # Compute all angles for each pairs of way 
     # for each places
+    starts, sizes = group_offsets([r[0] for r in rows])
+    _, i, j = group_pairs(starts, sizes, min_size=2)
+
+    places = np.array([-1 if r[0] is None else r[0] for r in rows], dtype=int)
+    ways   = np.array([-1 if r[1] is None else r[1] for r in rows], dtype=int)
+    edges  = np.array([r[2] for r in rows], dtype=int)
+    az     = np.array([r[3] for r in rows], dtype=float)
 
-    progress = Progress(len(way_places))
-
-    def compute_angles():
-        for place, ways in iter_places(way_places):
-            n = len(ways)
-            progress(n)
-            if n==1:
-                continue
-            for i in range(n-1):
-                w1 = ways[i]
-                i1 = w1[1]
-                for j in range(i+1,n):
-                    w2 = ways[j]
-                    i2 = w2[1]  
-                    if i1 != i2:
-                        angle = sin( angle_from_azimuth(w1[3],w2[3]) )
-                        yield (place,angle,i1,w1[2],i2,w2[2])
-
-    # Build way_angles table
-    logging.info("Ways: computing angles")
-    cur.execute(SQL("DELETE FROM way_angles"))
-    cur.executemany(SQL("INSERT INTO way_angles(PLACE,ANGLE,WAY1,EDGE1,WAY2,EDGE2) SELECT ?,?,?,?,?,?"),
-            [(pl,angle,way1,e1,way2,e2) for pl,angle,way1,e1,way2,e2 in compute_angles()])
+    keep = ways[i] != ways[j]
+    i, j = i[keep], j[keep]
+    return (places[i], sin(angles_from_azimuths(az[i], az[j])),
+            ways[i], edges[i], ways[j], edges[j])
 
 
 def compute_edge_classes(attr_table, cur, attribute, classes):
@@ -116,25 +87,23 @@ def compute_edge_classes(attr_table, cur, attribute, classes):
 def compute_orthogonality(conn):
     """ Compute orthogonality
 
-        Note the table way_angle must have been 
-        computed !
+        Angles between edges are computed in memory (see angle_rows)
     """
-    compute_angles(conn)   
+    from .angles import orthogonality_sums
 
-   # Update orthogonality
     logging.info("Edges: computing orthogonality")
+    places, angles, _, edges1, _, edges2 = angle_rows(conn)
+
+    edges, sums = orthogonality_sums(np.concatenate((edges1, edges2)),
+                                     np.concatenate((places, places)),
+                                     np.concatenate((edges2, edges1)),
+                                     np.concatenate((angles, angles)))
+
     cur = conn.cursor()
-    cur.execute(SQL("UPDATE place_edges SET ORTHOG = NULL"))
-    cur.execute(SQL("""UPDATE place_edges SET ORTHOG = (
-        SELECT Sum(inner)/place_edges.DEGREE FROM (
-        SELECT Min(a) AS inner FROM (
-        SELECT PLACE AS p, ANGLE AS a, EDGE2 AS e
-        FROM way_angles WHERE EDGE1=place_edges.OGC_FID
-        UNION ALL
-        SELECT PLACE AS p, ANGLE AS a, EDGE1 AS e
-        FROM way_angles WHERE EDGE2=place_edges.OGC_FID)
-          GROUP BY p,e
-        ))"""))
+    degree = dict(cur.execute(SQL("SELECT OGC_FID, DEGREE FROM place_edges")).fetchall())
+    with attr_table(cur, "edge_orthogonality") as attrs:
+        attrs.update('place_edges', 'OGC_FID', 'ORTHOG',
+                     [(e, s/degree[e]) for e, s in zip(edges.tolist(), sums.tolist()) if degree.get(e)])
 
 
 def compute_local_attributes(conn,  orthogonality=False, classes=0 ):
@@ -0,0 +1,356 @@
+# -*- encoding=utf-8 -*-
+""" In-memory geometry helpers
+
+    Helpers used for processing bulk geometries in python
+    instead of issuing one spatialite query per feature.
+"""
+import numpy as np
+
+
+def parse_linestring( wkt ):
+    """ Parse a WKT linestring as returned by spatialite AsText()
+
+        :return: a tuple (linetype, coords) where linetype is the
+                 WKT prefix (i.e 'LINESTRING' or 'LINESTRING Z') and
+                 coords a (n, dim) array of coordinates
+    """
+    linetype, _, body = wkt.partition('(')
+    body = body.rstrip(')').strip()
+    coords = [[float(c) for c in p.split()] for p in body.split(',')]
+    return linetype.strip(), np.array(coords)
+
+
+def format_linestring( linetype, coords ):
+    """ Format coordinates as WKT linestring
+
+        :param linetype: the WKT prefix as returned by parse_linestring()
+        :param coords: sequence of coordinates
+    """
+    return "{}({})".format(linetype, ','.join(' '.join(repr(float(c)) for c in p) for p in coords))
+
+
+def linestring_key( coords ):
+    """ Return a hashable key shared by all topologically equal lines
+
+        The key is made of the bounding box and of the end points in
+        canonical order, the end points of closed lines are ignored since
+        equal rings may start from any vertex. Lines sharing a key are only
+        candidates for equality and must be checked with Equals().
+    """
+    xy = coords[:,:2]
+    start, end = tuple(xy[0].tolist()), tuple(xy[-1].tolist())
+    ends = () if start == end else tuple(sorted((start, end)))
+    return tuple(xy.min(axis=0).tolist()) + tuple(xy.max(axis=0).tolist()) + ends
+
+
+class GridIndex(object):
+    """ Simple spatial hash grid of bounding boxes
+
+        :param cell_size: the size of a grid cell
+    """
+
+    def __init__(self, cell_size):
+        self._size  = float(cell_size)
+        self._cells = {}
+
+    def _range(self, xmin, ymin, xmax, ymax):
+        s = self._size
+        for i in range(int(np.floor(xmin/s)), int(np.floor(xmax/s))+1):
+            for j in range(int(np.floor(ymin/s)), int(np.floor(ymax/s))+1):
+                yield i,j
+
+    def insert(self, key, xmin, ymin, xmax, ymax):
+        """ Insert a bounding box in the index
+        """
+        for cell in self._range(xmin, ymin, xmax, ymax):
+            self._cells.setdefault(cell,[]).append(key)
+
+    def query(self, xmin, ymin, xmax, ymax):
+        """ Return the keys of all boxes whose cells overlap the given bounding box
+        """
+        keys = set()
+        for cell in self._range(xmin, ymin, xmax, ymax):
+            keys.update(self._cells.get(cell,()))
+        return keys
+
+
+def _close_pairs( points, distance, groups=None ):
+    """ Return pairs of points closer than a given distance
+
+        Points are hashed in a grid of cell size 'distance' so that only
+        points from adjacent cells are compared.
+
+        :return: a tuple (i, j, d2) of arrays of point indices and squared distances
+    """
+    grid = {}
+    for i, cell in enumerate(np.floor(points[:,:2]/distance).astype(np.int64).tolist()):
+        grid.setdefault(tuple(cell),[]).append(i)
+
+    d2 = distance*distance
+    pi, pj, pd = [], [], []
+    for (cx, cy), idx in grid.items():
+        idx = np.array(idx)
+        # Visit only half of the neighbour cells so that
+        # each pair of cells is compared once
+        for ox, oy in ((0,0),(1,-1),(1,0),(1,1),(0,1)):
+            other = grid.get((cx+ox, cy+oy))
+            if other is None:
+                continue
+            other = np.array(other)
+            delta = points[idx,None,:2] - points[None,other,:2]
+            dist  = (delta*delta).sum(axis=2)
+            close = dist <= d2
+            if ox == 0 and oy == 0:
+                close = np.triu(close, 1)
+            if groups is not None:
+                close &= groups[idx][:,None] != groups[other][None,:]
+            i, j = np.nonzero(close)
+            pi.append(idx[i])
+            pj.append(other[j])
+            pd.append(dist[i,j])
+
+    if not pi:
+        return np.array([], dtype=int), np.array([], dtype=int), np.array([])
+    return np.concatenate(pi), np.concatenate(pj), np.concatenate(pd)
+
+
+def cluster_points( points, distance, groups=None ):
+    """ Cluster points closer than a given distance
+
+        Points are hashed in a grid of cell size 'distance' so that only
+        points from adjacent cells are compared. Clusters are the transitive 
+        closure of close pairs.
+
+        :param points: (n, 2) array of coordinates
+        :param distance: the clustering distance
+        :param groups: optional array of size n: points from the same
+                       group are not paired together
+        :return: a partition table (see angles.create_partition) where each point
+                 is assigned to the lowest index of its cluster
+    """
+    from .angles import create_partition, resolve_pairs
+
+    part = create_partition(len(points))
+    resolve_pairs(part, *_close_pairs(points, distance, groups)[:2])
+    return part
+
+
+def cluster_seeds( points, distance, groups=None ):
+    """ Assign points to seed points closer than a given distance
+
+        Points are visited in order: a point not yet assigned becomes a seed
+        and all unassigned points closer than 'distance' are assigned to it.
+        Unlike cluster_points(), clusters do not chain: all points of a cluster
+        are within 'distance' of its seed.
+
+        :param points: (n, 2) array of coordinates
+        :param distance: the clustering distance
+        :param groups: optional array of size n: points from the same
+                       group are not assigned to each other
+        :return: an array where each point is assigned to the index of its seed
+    """
+    i, j, _ = _close_pairs(points, distance, groups)
+    k = np.concatenate((i, j))
+    l = np.concatenate((j, i))
+    order = np.lexsort((l, k))
+    k, l = k[order], l[order]
+
+    seeds = np.arange(len(points))
+    assigned = np.zeros(len(points), dtype=bool)
+    firsts, starts = np.unique(k, return_index=True)
+    ends = np.append(starts[1:], len(k))
+    for p, start, end in zip(firsts.tolist(), starts.tolist(), ends.tolist()):
+        if assigned[p]:
+            continue
+        others = l[start:end]
+        others = others[~assigned[others]]
+        seeds[others] = p
+        assigned[others] = True
+        assigned[p] = True
+    return seeds
+
+
+def cluster_sweep( points, distances ):
+    """ Cluster points for an increasing list of distances
+
+        Clusters only merge as the distance grows: close pairs are computed
+        once for the largest distance and sorted by distance, then merged
+        incrementally up to each distance.
+
+        :param points: (n, 2) array of coordinates
+        :param distances: list of clustering distances
+        :return: an iterator of (distance, partition) in increasing distance order,
+                 partitions are the same as returned by cluster_points()
+    """
+    from .angles import create_partition, resolve_pairs
+
+    distances = sorted(distances)
+    i, j, d2  = _close_pairs(points, distances[-1])
+    order = np.argsort(d2, kind='stable')
+    i, j, d2 = i[order], j[order], d2[order]
+
+    part  = create_partition(len(points))
+    start = 0
+    for distance in distances:
+        end = np.searchsorted(d2, distance*distance, side='right')
+        resolve_pairs(part, i[start:end], j[start:end])
+        start = end
+        yield distance, part.copy()
+
+
+def locate_points( coords, points ):
+    """ Locate points along a line
+
+        This is the equivalent of spatialite Line_Locate_Point() for
+        several points at once.
+
+        :param coords: (n, dim) array of line coordinates
+        :param points: (m, 2) array of points coordinates
+        :return: a tuple (locations, distances) of arrays of size m, locations
+                 are given as fraction of the 2D length of the line
+    """
+    a  = coords[:-1,:2]
+    ab = coords[1:,:2] - a
+    seglen = np.sqrt((ab*ab).sum(axis=1))
+    cumlen = np.concatenate(([0.0], np.cumsum(seglen)))
+    length = cumlen[-1]
+
+    # Projection of each point on each segment
+    ap = points[:,None,:] - a[None,:,:]
+    sq = (ab*ab).sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t = np.where(sq > 0, (ap*ab[None,:,:]).sum(axis=2)/sq, 0.0)
+    t = np.clip(t, 0.0, 1.0)
+    d = ap - t[:,:,None]*ab[None,:,:]
+    d = np.sqrt((d*d).sum(axis=2))
+
+    # Take the first closest segment
+    k = np.argmin(d, axis=1)
+    rows = np.arange(len(points))
+    distances = d[rows,k]
+    if length > 0:
+        locations = (cumlen[k] + t[rows,k]*seglen[k])/length
+    else:
+        locations = np.zeros(len(points))
+    return locations, distances
+
+
+def morton_order( x, y, bits=16 ):
+    """ Return the indices sorting points along a Z-order (Morton) curve
+
+        Points close in the ordering are spatially close, which is used
+        for grouping geometries into spatially coherent chunks.
+
+        :param x: array of x coordinates
+        :param y: array of y coordinates
+        :param bits: number of bits used for quantizing each coordinate
+    """
+    def quantize( v ):
+        span = v.max() - v.min()
+        if span <= 0:
+            return np.zeros(len(v), dtype=np.uint64)
+        return ((v - v.min())/span * (2**bits-1)).astype(np.uint64)
+
+    def spread( v ):
+        # Insert a zero bit between each bit of v
+        v = (v | (v << 8)) & 0x00FF00FF
+        v = (v | (v << 4)) & 0x0F0F0F0F
+        v = (v | (v << 2)) & 0x33333333
+        v = (v | (v << 1)) & 0x55555555
+        return v
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    keys = spread(quantize(x)) | (spread(quantize(y)) << 1)
+    return np.argsort(keys, kind='stable')
+
+
+def parse_polygon( wkt ):
+    """ Parse a WKT polygon as returned by spatialite AsText()
+
+        :return: a list of (n, dim) arrays of coordinates, the first
+                 one is the exterior ring
+    """
+    _, _, body = wkt.partition('(')
+    body = body.strip()[:-1]
+    rings = []
+    for ring in body.split('),'):
+        ring = ring.strip().lstrip('(').rstrip(')')
+        rings.append(np.array([[float(c) for c in p.split()] for p in ring.split(',')]))
+    return rings
+
+
+def _points_in_ring( points, ring ):
+    """ Test points against a closed ring using ray casting
+    """
+    x  = points[:,0,None]
+    y  = points[:,1,None]
+    x1 = ring[None,:-1,0]
+    y1 = ring[None,:-1,1]
+    x2 = ring[None,1:,0]
+    y2 = ring[None,1:,1]
+    crossing = (y1 > y) != (y2 > y)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        xint = x1 + (y - y1)*(x2 - x1)/(y2 - y1)
+    return ((crossing & (x < xint)).sum(axis=1) % 2) == 1
+
+
+def points_in_polygons( points, polygons, leaf_size=16 ):
+    """ Find polygons containing points
+
+        Polygon bounding boxes are packed into leaves with the 
+        Sort-Tile-Recursive algorithm: points are selected for each leaf
+        from a x-sorted array then tested against each polygon of the leaf
+        by ray casting.
+
+        :param points: (n, 2) array of coordinates
+        :param polygons: list of polygons as returned by parse_polygon()
+        :param leaf_size: number of polygons in each leaf
+        :return: a tuple (point indices, polygon indices) of arrays of 
+                 the containing pairs
+    """
+    npoly = len(polygons)
+    if npoly == 0 or len(points) == 0:
+        return np.array([], dtype=int), np.array([], dtype=int)
+
+    boxes = np.array([(r[0][:,0].min(), r[0][:,1].min(), r[0][:,0].max(), r[0][:,1].max())
+                      for r in polygons])
+
+    # Sort-Tile-Recursive packing
+    nslices = int(np.ceil(np.sqrt(np.ceil(npoly/float(leaf_size)))))
+    slice_size = nslices*leaf_size
+    order = np.argsort(boxes[:,0]+boxes[:,2], kind='stable')
+    leaves = []
+    for s in range(0, npoly, slice_size):
+        tile = order[s:s+slice_size]
+        tile = tile[np.argsort(boxes[tile,1]+boxes[tile,3], kind='stable')]
+        leaves.extend(tile[l:l+leaf_size] for l in range(0, len(tile), leaf_size))
+
+    xorder = np.argsort(points[:,0], kind='stable')
+    xs = points[xorder,0]
+
+    pt_idx, poly_idx = [], []
+    for leaf in leaves:
+        lb = boxes[leaf]
+        start = np.searchsorted(xs, lb[:,0].min(), side='left')
+        end   = np.searchsorted(xs, lb[:,2].max(), side='right')
+        cand  = xorder[start:end]
+        cand  = cand[(points[cand,1] >= lb[:,1].min()) & (points[cand,1] <= lb[:,3].max())]
+        if len(cand) == 0:
+            continue
+        for k in leaf:
+            xmin, ymin, xmax, ymax = boxes[k]
+            pts = cand[(points[cand,0] >= xmin) & (points[cand,0] <= xmax) &
+                       (points[cand,1] >= ymin) & (points[cand,1] <= ymax)]
+            if len(pts) == 0:
+                continue
+            rings  = polygons[k]
+            inside = _points_in_ring(points[pts], rings[0])
+            for hole in rings[1:]:
+                inside &= ~_points_in_ring(points[pts], hole)
+            pt_idx.append(pts[inside])
+            poly_idx.append(np.full(inside.sum(), k, dtype=int))
+
+    if not pt_idx:
+        return np.array([], dtype=int), np.array([], dtype=int)
+    return np.concatenate(pt_idx), np.concatenate(poly_idx)
@@ -81,78 +81,43 @@ FROM $input_table
 -- Create the vertices of the graph
 
 -- Fill up vertices table
+-- Vertices are keyed by the coordinates of edge end points: coordinates
+-- are already snapped to a grid so that equal points have equal coordinates
 
 INSERT INTO vertices(GEOMETRY)
-SELECT StartPoint( GEOMETRY ) AS GEOMETRY FROM edges
-UNION
-SELECT EndPoint( GEOMETRY ) AS GEOMETRY FROM edges
+SELECT GEOMETRY FROM (
+    SELECT StartPoint( GEOMETRY ) AS GEOMETRY FROM edges
+    UNION ALL
+    SELECT EndPoint( GEOMETRY ) AS GEOMETRY FROM edges
+)
+GROUP BY X(GEOMETRY), Y(GEOMETRY)
+;
+
+CREATE TEMP TABLE vertices_xy AS
+SELECT OGC_FID AS ID, X(GEOMETRY) AS X, Y(GEOMETRY) AS Y FROM vertices
 ;
 
+CREATE UNIQUE INDEX vertices_xy_idx ON vertices_xy(X,Y);
+
 -- Edges connectivity
 -- Set edges connectivity
 
 UPDATE edges 
 SET END_VTX = 
 (
-    SELECT v.OGC_FID 
-    FROM vertices AS v
-    WHERE Intersects( v.GEOMETRY, EndPoint( edges.GEOMETRY ) )
-    AND
-    v.ROWID IN (
-      SELECT ROWID FROM SpatialIndex 
-      WHERE f_table_name='vertices' AND search_frame=edges.GEOMETRY)
+    SELECT ID FROM vertices_xy
+    WHERE X = X(EndPoint(edges.GEOMETRY)) AND Y = Y(EndPoint(edges.GEOMETRY))
 ),
 START_VTX = 
 (
-    SELECT v.OGC_FID 
-    FROM vertices AS v
-    WHERE Intersects( v.GEOMETRY, StartPoint( edges.GEOMETRY ) )
-    AND
-    v.ROWID IN (
-      SELECT ROWID FROM SpatialIndex 
-      WHERE f_table_name='vertices' AND search_frame=edges.GEOMETRY)
-)
-;
-
--- Update vertices degree
-
-UPDATE vertices 
-SET DEGREE = 
-(
-    SELECT COUNT(1) 
-    FROM edges 
-    WHERE edges.END_VTX = vertices.OGC_FID 
-    OR edges.START_VTX = vertices.OGC_FID
-)
-;
-
-UPDATE vertices 
-SET DEGREE = vertices.DEGREE + -- add one to the count for each loops touching the vertex
-(
-    SELECT COUNT(1) 
-    FROM edges 
-    WHERE edges.END_VTX = vertices.OGC_FID 
-    AND edges.START_VTX = vertices.OGC_FID
+    SELECT ID FROM vertices_xy
+    WHERE X = X(StartPoint(edges.GEOMETRY)) AND Y = Y(StartPoint(edges.GEOMETRY))
 )
 ;
 
+DROP TABLE vertices_xy;
 
--- Update edges degree
-
-UPDATE edges 
-SET DEGREE = 
-        (SELECT DEGREE FROM vertices WHERE vertices.OGC_FID = edges.START_VTX)
-       +(SELECT DEGREE FROM vertices WHERE vertices.OGC_FID = edges.END_VTX)
-       - 2
-    WHERE edges.START_VTX != edges.END_VTX
-;
-
-UPDATE edges 
-SET DEGREE = 
-        (SELECT DEGREE FROM vertices WHERE vertices.OGC_FID = edges.START_VTX)
-       - 2
-    WHERE edges.START_VTX == edges.END_VTX
-;
+-- Vertices and edges degrees are computed in degrees.sql
 
 -- -----------------------------------------------------------
 -- Create places schema
@@ -264,6 +229,8 @@ CREATE TABLE way_partition(
 CREATE INDEX way_partition_EDGE_idx  ON way_partition(EDGE);
 CREATE INDEX way_partition_WAY_idx   ON way_partition(WAY);
 
+-- The edge_ends table is created in edge_ends.sql
+
 
 CREATE TABLE ways(
     OGC_FID integer PRIMARY KEY,
@@ -272,6 +239,7 @@ CREATE TABLE ways(
     END_PL   integer, -- REFERENCES places(OGC_FID),
     DEGREE           integer DEFAULT 0, 
     LENGTH           real,
+    DIRTY            integer DEFAULT 0, -- set to 1 when input data has changed
     -- Indicators
     CONN             real, -- connectivity
     CLOSEN           real, -- closeness
@@ -326,24 +294,6 @@ CREATE TABLE way_places(
 CREATE INDEX way_places_WAY_ID_idx ON way_places(WAY_ID);
 CREATE INDEX way_places_PLACE_idx  ON way_places(PLACE);
 
--- Create way_angles table for computing orthogonality
-
-CREATE TABLE way_angles(
-    PLACE integer, -- REFERENCES places(OGC_FID),
-    ANGLE real,
-    WAY1  integer,
-    EDGE1 integer, -- REFERENCES places_edges(OGC_FID),
-    WAY2  integer,
-    EDGE2 integer  -- REFERENCES places_edges(OGC_FID)
-)
-;
-
-CREATE INDEX way_angles_PLACE_idx ON way_angles(PLACE);
-CREATE INDEX way_angles_WAY1_idx  ON way_angles(WAY1);
-CREATE INDEX way_angles_WAY2_idx  ON way_angles(WAY2);
-CREATE INDEX way_angles_EDGE1_idx ON way_angles(EDGE1);
-CREATE INDEX way_angles_EDGE2_idx ON way_angles(EDGE2);
-
 -- Clean up
 VACUUM
 ;
@@ -9,6 +9,7 @@ from .errors import BuilderError, FileNotFoundError, DatabaseNotFound
 from .sql import SQL, execute_sql, delete_table, connect_database, set_srid
 from .layers import check_layer, import_vector_layer, import_shapefile, export_shapefile
 from .sanitize import sanitize
+from .incremental import GraphUpdater, store_input_hashes, UPDATE_TABLE
 
 
 class SpatialiteBuilder(object):
@@ -41,7 +42,8 @@ class SpatialiteBuilder(object):
     def connection(self):
         return self._conn
 
-    def build_graph( self, snap_distance, min_edge_length, way_attribute=None, output=None ):
+    def build_graph( self, snap_distance, min_edge_length, way_attribute=None, output=None,
+                     **kwargs ):
         """ Build morpheo topological graph
 
             This method will build the topological graph
@@ -54,12 +56,14 @@ class SpatialiteBuilder(object):
             :param min_edge_length: The minimum edge length - edge below this length will be removed
             :param way_attribute: The attribute which will be used to build way from street name.
                 If defined, this attribute has to be imported into the topological graph.
+            :param kwargs: Extra options passed to the sanitizer (see Sanitizer.sanitize),
+                i.e 'in_memory_cut', 'grid_snap', 'tile_size', 'tile_halo', 'workers' and 'resume'.
         """
         # sanitize graph
         if snap_distance > 0:
             logging.info("Builder: sanitizing graph")
             working_table = sanitize(self._conn, self._input_table, snap_distance, min_edge_length,
-                                     attribute=way_attribute)
+                                     attribute=way_attribute, **kwargs)
             # Because we still have rounding errors
             # We need to round coordinates using
 
@@ -84,6 +88,8 @@ class SpatialiteBuilder(object):
         logging.info("Builder: Computing vertices and edges")
 
         self.execute_sql('graph.sql', input_table=working_table)
+        self.execute_sql('degrees.sql', vertices='SELECT OGC_FID FROM vertices')
+        self.execute_sql('edge_ends.sql')
 
         # Copy attribute to graph edge
         if way_attribute:
@@ -108,6 +114,47 @@ class SpatialiteBuilder(object):
                                 min_edge_length=min_edge_length) 
             
 
+    def update_graph( self, path, snap_distance, min_edge_length, buffer_size=None,
+                      way_attribute=None, output=None, workers=1 ):
+        """ Update the topological graph and places from an edited shapefile
+
+            Features are compared to the input stored when the graph was built:
+            only the neighbourhood of added, modified or deleted features 
+            is sanitized again and edges, vertices, places and place edges 
+            are patched in place. Ways going through updated places are
+            marked as dirty (DIRTY=1) and need to be recomputed. The input
+            table and the sanitized table are replaced with the updated data.
+
+            Parameters must be the same as the ones used for building the graph
+            and the places.
+
+            :param path: The path of the edited shapefile
+            :param snap_distance: The snap distance used to sanitize the graph
+            :param min_edge_length: The minimum edge length
+            :param buffer_size: The buffer size used for building places
+            :param way_attribute: The attribute imported as edge name
+            :param output: Output path for exporting updated edges, vertices and places
+            :param workers: The number of worker processes for sanitizing updated regions
+
+            :return: True if the graph has been updated
+        """
+        if snap_distance <= 0:
+            raise BuilderError("Incremental update requires a sanitized graph")
+
+        delete_table(self._conn.cursor(), UPDATE_TABLE)
+        import_shapefile( self._dbname, path, UPDATE_TABLE, forceSinglePartGeometryType=True)
+        set_srid(self._conn.cursor(), UPDATE_TABLE, self._input_table)
+
+        updater = GraphUpdater(self._conn, self._dbname, self._input_table)
+        updated = updater.update(snap_distance, min_edge_length, buffer_size=buffer_size,
+                                 attribute=way_attribute, workers=workers)
+
+        if updated and output is not None:
+            logging.info("Builder: saving updated edges, vertices and places")
+            for table in ('edges', 'vertices', 'places', 'place_edges'):
+                export_shapefile(self._dbname, table, output)
+        return updated
+
     def write_manifest(self, output, suffix, **kwargs):
         """ Write  manifest as key=value file 
         """
@@ -127,7 +174,8 @@ class SpatialiteBuilder(object):
         builder = self.way_builder
         builder.save_line_graph(output, create=True)
 
-    def build_places(self, buffer_size, places=None, output=None):
+    def build_places(self, buffer_size, places=None, output=None, workers=1, cluster_vertices=False,
+                     bulk_place_vtx=False):
         """ Build places
 
             Build places from buffer and/or external places definition.
@@ -140,6 +188,10 @@ class SpatialiteBuilder(object):
             :param buffer_size: buffer size applied to vertices
             :param places: path of an external shapefile containing places definitions
             :param output: path of a shapefile to write computed places to.
+            :param workers: number of worker processes for computing the union of buffers
+            :param cluster_vertices: build places from clusters of vertices instead of 
+                                     the union of buffers when no places definition is used
+            :param bulk_place_vtx: assign vertices to places in memory
         """
         from .places import PlaceBuilder
         input_places_table = None
@@ -151,13 +203,32 @@ class SpatialiteBuilder(object):
             # Force srid
             set_srid(self._conn.cursor(), input_places_table, 'vertices')
 
-        builder = PlaceBuilder(self._conn)
-        builder.build_places(buffer_size, input_places_table)
+        builder = PlaceBuilder(self._conn, workers=workers)
+        builder.build_places(buffer_size, input_places_table, cluster_vertices=cluster_vertices,
+                             bulk_place_vtx=bulk_place_vtx)
 
         if output is not None:
             builder.export(self._dbname, output, export_graph=True)
             self.write_manifest(output,'places', buffer_size=buffer_size, input_file=places)
 
+    def sweep_places(self, buffer_sizes, output):
+        """ Build places for a list of buffer sizes
+
+            Places are built from clusters of vertices for each buffer size
+            in increasing order: results for each size are saved in the
+            folder '<output>_buffer_<size>'. The database holds the places
+            of the largest buffer size at the end.
+
+            :param buffer_sizes: list of buffer sizes applied to vertices
+            :param output: base path of the output folders
+        """
+        from .places import PlaceBuilder
+        builder = PlaceBuilder(self._conn)
+        for buffer_size in builder.sweep_places(buffer_sizes):
+            path = "{}_buffer_{:g}".format(output, buffer_size)
+            builder.export(self._dbname, path, export_graph=True)
+            self.write_manifest(path,'places', buffer_size=buffer_size, input_file=None)
+
     def build_ways(self,  threshold, output=None, attributes=False, rtopo=False, **kwargs) :
         """ Build way's hypergraph
 
@@ -179,6 +250,28 @@ class SpatialiteBuilder(object):
             self.write_manifest(output,'ways', angle_threshold=threshold)
 
 
+    def sweep_ways(self, thresholds, output=None):
+        """ Compute way partitions for a list of angle thresholds
+
+            The partition for each threshold is stored in the table 
+            'way_partition_<degrees>', the summary of way counts and length 
+            distributions in the table 'way_sweep'.
+
+            :param thresholds: list of angle thresholds (in radian)
+            :param output: optional folder where to write the summary as csv file
+        """
+        summary = self.way_builder.sweep_ways(thresholds)
+        if output is not None and summary:
+            if not os.path.exists(output):
+                os.makedirs(output)
+            path = os.path.join(output, "%s_way_sweep.csv" % self._basename)
+            columns = list(summary[0].keys())
+            with open(path,'w') as f:
+                f.write(','.join(columns)+'\n')
+                for row in summary:
+                    f.write(','.join(str(row[c]) for c in columns)+'\n')
+        return summary
+
     def compute_way_attributes( self, orthogonality, betweenness, closeness, stress,
                                 classes=10, rtopo=False, output=None):
         """ Compute attributes for ways:
@@ -279,7 +372,9 @@ class SpatialiteBuilder(object):
 
         layername = os.path.basename(os.path.splitext(dbname)[0]).lower()
         import_shapefile( dbname, path, layername, forceSinglePartGeometryType=True)
-        return SpatialiteBuilder(dbname)
+        builder = SpatialiteBuilder(dbname)
+        store_input_hashes(builder.connection, layername)
+        return builder
 
     @staticmethod
     def from_layer( layer, dbname=None, feedback=None, context=None ):
@@ -300,7 +395,9 @@ class SpatialiteBuilder(object):
         import_vector_layer( dbname, layer, tablename, forceSinglePartGeometryType=True,
                 feedback=feedback, context=context)
 
-        return SpatialiteBuilder(dbname)
+        builder = SpatialiteBuilder(dbname)
+        store_input_hashes(builder.connection, tablename)
+        return builder
 
     @staticmethod
     def from_database( dbname ):
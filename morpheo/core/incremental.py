@@ -0,0 +1,617 @@
+# -*- encoding=utf-8 -*-
+""" Incremental update of the graph from edited input features
+
+    Input features are identified by their FID and a hash of their geometry
+    stored at import time. On update, the edited input is compared to the
+    stored hashes and only the neighbourhood of changed features is sanitized
+    again: edges, vertices, places and place edges are then patched in place
+    and the ways going through modified places are marked as dirty. The
+    input table is finally replaced with the updated features.
+"""
+import os
+import shutil
+import logging
+import hashlib
+import tempfile
+import numpy as np
+
+from .errors import BuilderError
+from .sql import SQL, execute_sql, create_indexed_table, delete_table, table_exists
+from .sanitize import Sanitizer, _sanitize_tile
+
+HASH_TABLE='input_hashes'
+UPDATE_TABLE='input_update'
+
+
+def _feature_hashes( cur, table ):
+    """ Return a list of (fid, hash, xmin, ymin, xmax, ymax) for
+        each feature of a table
+    """
+    rows = cur.execute(SQL("""SELECT OGC_FID, AsBinary(GEOMETRY),
+            MbrMinX(GEOMETRY), MbrMinY(GEOMETRY), MbrMaxX(GEOMETRY), MbrMaxY(GEOMETRY)
+        FROM {table}""", table=table)).fetchall()
+    return [(fid, hashlib.md5(bytes(wkb or b'')).hexdigest(), xmin, ymin, xmax, ymax)
+            for [fid, wkb, xmin, ymin, xmax, ymax] in rows]
+
+
+def store_input_hashes( conn, table ):
+    """ Store the hash and the bounding box of input features
+
+        :param table: the table holding input features
+    """
+    logging.info("Storing hashes of input features from {}".format(table))
+    cur = conn.cursor()
+    cur.execute(SQL("DROP TABLE IF EXISTS {hash_table}", hash_table=HASH_TABLE))
+    cur.execute(SQL("""CREATE TABLE {hash_table}(
+        FID  integer PRIMARY KEY,
+        HASH text,
+        MINX real, MINY real, MAXX real, MAXY real)""", hash_table=HASH_TABLE))
+    cur.executemany(SQL("INSERT INTO {hash_table} VALUES (?,?,?,?,?,?)", hash_table=HASH_TABLE),
+                    _feature_hashes(cur, table))
+    conn.commit()
+
+
+def _cluster_boxes( boxes, halo ):
+    """ Group boxes overlapping each other when extended by halo
+
+        Clustering is repeated until the bounding boxes of the groups
+        do not overlap.
+
+        :return: the list of the bounding boxes of each group
+    """
+    from .angles import create_partition, resolve_pairs
+
+    if not boxes:
+        return []
+    boxes = np.array(boxes, dtype=float)
+    while True:
+        lo = boxes[:,:2] - halo
+        hi = boxes[:,2:] + halo
+        overlap = np.all((lo[:,None,:] <= hi[None,:,:]) & (lo[None,:,:] <= hi[:,None,:]), axis=2)
+        part = create_partition(len(boxes))
+        resolve_pairs(part, *np.nonzero(np.triu(overlap, 1)))
+        labels = np.unique(part)
+        if len(labels) == len(boxes):
+            return [tuple(float(v) for v in b) for b in boxes]
+        boxes = np.array([(boxes[part==l,0].min(), boxes[part==l,1].min(),
+                           boxes[part==l,2].max(), boxes[part==l,3].max()) for l in labels])
+
+
+class GraphUpdater(object):
+    """ Patch the topological graph from an updated input table
+
+        :param conn: spatialite connection
+        :param dbname: path of the database
+        :param input_table: name of the table holding the input features of the graph
+        :param update_table: name of the table holding the updated input features
+    """
+
+    def __init__(self, conn, dbname, input_table, update_table=UPDATE_TABLE):
+        self._conn   = conn
+        self._dbname = dbname
+        self._input  = input_table
+        self._table  = update_table
+
+    def update(self, snap_distance, min_edge_length, buffer_size=None, attribute=None,
+               halo=None, workers=1):
+        """ Update the graph with changed features
+
+            :param snap_distance: Snap distance used for building the graph
+            :param min_edge_length: Minimum length for small edges
+            :param buffer_size: Buffer size used for building places
+            :param attribute: Attribute to import from input data as edge name
+            :param halo: Extent around changed features which is sanitized again,
+                         default to 2*snap_distance+min_edge_length
+            :param workers: The number of worker processes for sanitizing regions
+
+            The table of updated features is dropped once the update is done.
+
+            :return: True if the graph has been updated
+        """
+        cur = self._conn.cursor()
+        if not table_exists(cur, HASH_TABLE):
+            raise BuilderError("No input hashes found: the graph must be rebuilt from scratch")
+
+        margin = snap_distance + min_edge_length
+        halo   = halo if halo is not None else 2*snap_distance + min_edge_length
+
+        if not self.diff_features(cur):
+            logging.info("Update: no changes found")
+            self._drop_update_tables(cur)
+            return False
+
+        zones = self.find_updated_edges(cur, margin)
+        tiles = self.sanitize_regions(cur, snap_distance, _cluster_boxes(zones, halo), halo, workers)
+        try:
+            self.patch_edges(cur, snap_distance, min_edge_length, tiles, attribute)
+        finally:
+            for tiledb, _ in tiles:
+                shutil.rmtree(os.path.dirname(tiledb), ignore_errors=True)
+
+        [places] = cur.execute(SQL("SELECT Count(1) FROM places")).fetchone()
+        if places > 0:
+            self.patch_places(cur, buffer_size or 0)
+
+        # Updated input becomes the new reference
+        self.replace_input(cur)
+        self._conn.commit()
+        store_input_hashes(self._conn, self._input)
+        self._drop_update_tables(cur)
+        return True
+
+    def _drop_update_tables(self, cur):
+        """ Drop the updated features and the temporary update tables
+        """
+        for table in ('update_boxes', 'update_edges', 'update_vtx'):
+            cur.execute(SQL("DROP TABLE IF EXISTS {table}", table=table))
+        self._conn.commit()
+        delete_table(cur, self._table)
+        self._conn.commit()
+
+    def diff_features(self, cur):
+        """ Compare updated features to stored hashes
+
+            Bounding boxes of added, deleted and modified features
+            are stored in the table 'update_boxes'.
+
+            :return: The number of changed features
+        """
+        old = dict((r[0], r[1:]) for r in cur.execute(SQL(
+                   "SELECT FID, HASH, MINX, MINY, MAXX, MAXY FROM {hash_table}",
+                   hash_table=HASH_TABLE)).fetchall())
+        boxes = []
+        added = modified = 0
+        for row in _feature_hashes(cur, self._table):
+            fid, digest, box = row[0], row[1], row[2:]
+            prev = old.pop(fid, None)
+            if prev is None:
+                added += 1
+                boxes.append(box)
+            elif prev[0] != digest:
+                modified += 1
+                boxes.append(box)
+                boxes.append(prev[1:])
+        # Remaining features have been deleted
+        boxes.extend(prev[1:] for prev in old.values())
+
+        logging.info("Update: {} added, {} modified, {} deleted features".format(
+                     added, modified, len(old)))
+
+        cur.execute(SQL("DROP TABLE IF EXISTS update_boxes"))
+        cur.execute(SQL("CREATE TABLE update_boxes(MINX real, MINY real, MAXX real, MAXY real)"))
+        cur.executemany(SQL("INSERT INTO update_boxes VALUES (?,?,?,?)"),
+                        [b for b in boxes if b[0] is not None])
+        return added + modified + len(old)
+
+    def find_updated_edges(self, cur, margin):
+        """ Find edges to be replaced
+
+            Edges whose bounding box is closer than margin to a changed feature
+            are stored in 'update_edges' together with the edges sharing a
+            vertex with them, so that lines may be merged again at these vertices.
+
+            :return: the list of the bounding boxes of changed features and updated edges
+        """
+        cur.execute(SQL("DROP TABLE IF EXISTS update_edges"))
+        cur.execute(SQL("CREATE TABLE update_edges(FID integer PRIMARY KEY)"))
+        cur.execute(SQL("""INSERT OR IGNORE INTO update_edges(FID)
+            SELECT e.OGC_FID FROM edges AS e, update_boxes AS b
+            WHERE e.ROWID IN (
+                SELECT ROWID FROM SpatialIndex
+                WHERE f_table_name='edges'
+                AND search_frame=BuildMbr(b.MINX-{m}, b.MINY-{m}, b.MAXX+{m}, b.MAXY+{m}))
+            """, m=margin))
+        cur.execute(SQL("""INSERT OR IGNORE INTO update_edges(FID)
+            SELECT e.OGC_FID FROM edges AS e, edges AS u
+            WHERE u.OGC_FID IN (SELECT FID FROM update_edges)
+            AND (e.START_VTX IN (u.START_VTX, u.END_VTX) OR e.END_VTX IN (u.START_VTX, u.END_VTX))
+            """))
+
+        zones = cur.execute(SQL("SELECT MINX, MINY, MAXX, MAXY FROM update_boxes")).fetchall()
+        zones.extend(cur.execute(SQL("""
+            SELECT MbrMinX(GEOMETRY), MbrMinY(GEOMETRY), MbrMaxX(GEOMETRY), MbrMaxY(GEOMETRY)
+            FROM edges WHERE OGC_FID IN (SELECT FID FROM update_edges)""")).fetchall())
+
+        [count] = cur.execute(SQL("SELECT Count(1) FROM update_edges")).fetchone()
+        logging.info("Update: {} edges to update".format(count))
+        return zones
+
+    def sanitize_regions(self, cur, snap_distance, regions, halo, workers=1):
+        """ Snap and cut updated input features in each region
+
+            Regions are processed like tiles (see Sanitizer.sanitize_tiles)
+
+            :return: list of (tile database, region bbox)
+        """
+        [srid, dim] = cur.execute(SQL("""SELECT CAST(srid AS integer), coord_dimension
+            FROM geometry_columns WHERE f_table_name='{table}'""", table=self._table)).fetchone()
+
+        logging.info("Update: sanitizing {} regions".format(len(regions)))
+
+        # Workers read the main database
+        self._conn.commit()
+
+        tasks = [(self._dbname, self._table,
+                  os.path.join(tempfile.mkdtemp(prefix='morpheo_update_'), 'region.sqlite'),
+                  bbox, halo, srid, dim, snap_distance, False, False) for bbox in regions]
+        if workers > 1:
+            from multiprocessing import Pool
+            pool = Pool(workers)
+            try:
+                results = pool.map(_sanitize_tile, tasks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [_sanitize_tile(task) for task in tasks]
+
+        for task, result in zip(tasks, results):
+            if result is None:
+                shutil.rmtree(os.path.dirname(task[2]), ignore_errors=True)
+        return [r for r in results if r is not None]
+
+    def patch_edges(self, cur, snap_distance, min_edge_length, tiles, attribute=None):
+        """ Replace updated edges with lines from sanitized regions
+
+            Lines are kept if their middle point is inside a changed feature bbox
+            or close to an updated edge. Lines are then merged at vertices of degree 2,
+            small edges are removed and lines are connected to the graph vertices:
+            vertices touched by updated edges are stored in 'update_vtx'.
+            Updated edges are replaced in the sanitized table as well.
+        """
+        logging.info("Update: patching edges")
+
+        precision = snap_distance/2.0
+        sanitizer = Sanitizer(self._conn, self._table)
+        sanitizer._create_indexed_table(cur, 'crossing_points', 'POINT')
+        sanitizer._create_split_lines(cur)
+        sanitizer._collect_tiles(cur, tiles)
+
+        cur.execute(SQL("UPDATE split_lines SET GEOMETRY = ST_SnapToGrid(GEOMETRY, {prec})",
+                        prec=precision))
+
+        # Remove lines unchanged by the update
+        cur.execute(SQL("""DELETE FROM split_lines WHERE OGC_FID IN (
+            SELECT OGC_FID FROM (
+                SELECT OGC_FID, Line_Interpolate_Point(GEOMETRY, 0.5) AS m FROM split_lines
+            ) AS l
+            WHERE NOT EXISTS (
+                SELECT 1 FROM update_boxes AS b
+                WHERE X(l.m) >= b.MINX AND X(l.m) <= b.MAXX AND Y(l.m) >= b.MINY AND Y(l.m) <= b.MAXY)
+            AND NOT EXISTS (
+                SELECT 1 FROM edges AS e
+                WHERE e.OGC_FID IN (SELECT FID FROM update_edges)
+                AND PtDistWithin(e.GEOMETRY, l.m, {snap})
+                AND e.ROWID IN (
+                    SELECT ROWID FROM SpatialIndex
+                    WHERE f_table_name='edges' AND search_frame=BuildCircleMbr(X(l.m), Y(l.m), {snap})))
+            )""", snap=snap_distance))
+
+        # Remaining degree of vertices touched by updated edges
+        cur.execute(SQL("DROP TABLE IF EXISTS update_vtx"))
+        cur.execute(SQL("""CREATE TABLE update_vtx(ID integer PRIMARY KEY, DEGREE integer DEFAULT 0)"""))
+        cur.execute(SQL("""INSERT INTO update_vtx(ID, DEGREE)
+            SELECT v.OGC_FID, v.DEGREE - u.VALUE FROM vertices AS v, (
+                SELECT VTX, Count(1) AS VALUE FROM (
+                    SELECT START_VTX AS VTX FROM edges WHERE OGC_FID IN (SELECT FID FROM update_edges)
+                    UNION ALL
+                    SELECT END_VTX AS VTX FROM edges WHERE OGC_FID IN (SELECT FID FROM update_edges))
+                GROUP BY VTX) AS u
+            WHERE v.OGC_FID = u.VTX"""))
+
+        cur.execute(SQL("""CREATE TEMP TABLE vertices_xy AS
+            SELECT OGC_FID AS ID, X(GEOMETRY) AS X, Y(GEOMETRY) AS Y FROM vertices"""))
+        cur.execute(SQL("CREATE UNIQUE INDEX vertices_xy_idx ON vertices_xy(X,Y)"))
+
+        [count] = cur.execute(SQL("SELECT Count(1) FROM split_lines")).fetchone()
+        if count > 0:
+            sanitizer._connect_split_lines(cur, snap_distance)
+            # Do not merge lines at vertices connected to unchanged edges
+            cur.execute(SQL("""UPDATE crossing_points SET DEGREE = -1 WHERE OGC_FID IN (
+                SELECT c.OGC_FID FROM crossing_points AS c, vertices_xy AS v, update_vtx AS u
+                WHERE v.X = X(c.GEOMETRY) AND v.Y = Y(c.GEOMETRY) AND u.ID = v.ID AND u.DEGREE > 0)
+                """))
+            sanitizer._4_merge_lines(cur)
+            sanitizer._5_remove_small_edges(cur, min_edge_length)
+            self.snap_to_vertices(cur, snap_distance)
+
+        [max_vtx]  = cur.execute(SQL("SELECT Max(OGC_FID) FROM vertices")).fetchone()
+        [max_edge] = cur.execute(SQL("SELECT Max(OGC_FID) FROM edges")).fetchone()
+
+        cur.execute(SQL("DELETE FROM edges WHERE OGC_FID IN (SELECT FID FROM update_edges)"))
+
+        # Insert new vertices
+        cur.execute(SQL("""INSERT INTO vertices(GEOMETRY)
+            SELECT c.GEOMETRY FROM crossing_points AS c
+            WHERE c.OGC_FID IN (SELECT START_VTX FROM split_lines UNION SELECT END_VTX FROM split_lines)
+            AND NOT EXISTS (SELECT 1 FROM vertices_xy WHERE X = X(c.GEOMETRY) AND Y = Y(c.GEOMETRY))
+            """))
+        cur.execute(SQL("""INSERT INTO vertices_xy(ID, X, Y)
+            SELECT OGC_FID, X(GEOMETRY), Y(GEOMETRY) FROM vertices WHERE OGC_FID > {max_vtx}
+            """, max_vtx=max_vtx or 0))
+
+        # Insert new edges
+        cur.execute(SQL("""INSERT INTO edges(GEOMETRY, LENGTH, START_VTX, END_VTX)
+            SELECT GEOMETRY, GLength(GEOMETRY),
+                (SELECT ID FROM vertices_xy
+                 WHERE X = X(StartPoint(split_lines.GEOMETRY)) AND Y = Y(StartPoint(split_lines.GEOMETRY))),
+                (SELECT ID FROM vertices_xy
+                 WHERE X = X(EndPoint(split_lines.GEOMETRY)) AND Y = Y(EndPoint(split_lines.GEOMETRY)))
+            FROM split_lines"""))
+        cur.execute(SQL("DROP TABLE vertices_xy"))
+
+        if attribute:
+            cur.execute(SQL("""UPDATE edges SET NAME = (
+                SELECT {attribute} FROM {table} AS b
+                WHERE Covers(b.GEOMETRY, edges.GEOMETRY)
+                AND b.ROWID IN (
+                    SELECT ROWID FROM SpatialIndex
+                    WHERE f_table_name='{table}' AND search_frame=edges.GEOMETRY))
+                WHERE OGC_FID > {max_edge}""", attribute=attribute, table=self._table, max_edge=max_edge))
+
+        # Replace updated lines in the sanitized table
+        if table_exists(cur, sanitizer.work_table):
+            cur.execute(SQL("DELETE FROM {work_table} WHERE OGC_FID IN (SELECT FID FROM update_edges)",
+                            work_table=sanitizer.work_table))
+            columns = "OGC_FID, GEOMETRY" + (", "+attribute if attribute else "")
+            cur.execute(SQL("""INSERT INTO {work_table}({columns})
+                SELECT OGC_FID, GEOMETRY{name} FROM edges WHERE OGC_FID > {max_edge}""",
+                work_table=sanitizer.work_table, columns=columns, name=", NAME" if attribute else "",
+                max_edge=max_edge))
+
+        for table in ('split_lines', 'crossing_points'):
+            sanitizer._drop_indexed_table(cur, table)
+
+        # Update degrees of touched vertices
+        cur.execute(SQL("""INSERT OR IGNORE INTO update_vtx(ID)
+            SELECT START_VTX FROM edges WHERE OGC_FID > {max_edge}
+            UNION
+            SELECT END_VTX FROM edges WHERE OGC_FID > {max_edge}""", max_edge=max_edge))
+
+        execute_sql(self._conn, "degrees.sql", quiet=True, vertices="SELECT ID FROM update_vtx")
+        cur.execute(SQL("""DELETE FROM vertices
+            WHERE OGC_FID IN (SELECT ID FROM update_vtx) AND DEGREE = 0"""))
+
+        # Sanity check
+        [bug] = cur.execute(SQL("""SELECT Count(1) FROM edges
+            WHERE OGC_FID > {max_edge} AND (START_VTX IS NULL OR END_VTX IS NULL)""",
+            max_edge=max_edge)).fetchone()
+        if bug:
+            raise BuilderError("Graph update error: NULL vertices in new edges")
+
+    def snap_to_vertices(self, cur, snap_distance):
+        """ Move end points of split lines to the graph vertices kept by the update
+
+            End points closer than snap_distance to a vertex still connected to
+            unchanged edges are moved to this vertex, so that new edges are
+            connected to it instead of creating a new vertex.
+        """
+        from .geometry import parse_linestring, format_linestring, cluster_seeds
+
+        kept = cur.execute(SQL("""SELECT X(v.GEOMETRY), Y(v.GEOMETRY) FROM vertices AS v, update_vtx AS u
+            WHERE v.OGC_FID = u.ID AND u.DEGREE > 0""")).fetchall()
+        points = cur.execute(SQL("""SELECT OGC_FID, X(GEOMETRY), Y(GEOMETRY) FROM crossing_points
+            WHERE OGC_FID IN (SELECT START_VTX FROM split_lines UNION SELECT END_VTX FROM split_lines)
+            """)).fetchall()
+        if not kept or not points:
+            return
+
+        # Kept vertices come first so that they are the seeds
+        xy = np.array(kept + [p[1:] for p in points], dtype=float)
+        groups = np.concatenate((np.zeros(len(kept), dtype=int), np.ones(len(points), dtype=int)))
+        seeds  = cluster_seeds(xy, snap_distance, groups=groups)[len(kept):]
+        moved  = dict((pid, xy[s]) for (pid, x, y), s in zip(points, seeds)
+                      if s < len(kept) and (xy[s,0], xy[s,1]) != (x, y))
+        if not moved:
+            return
+
+        [srid] = cur.execute(SQL("SELECT srid FROM geometry_columns WHERE f_table_name='split_lines'")).fetchone()
+        updates = []
+        for [fid, start_vtx, end_vtx, wkt] in cur.execute(SQL(
+                "SELECT OGC_FID, START_VTX, END_VTX, AsText(GEOMETRY) FROM split_lines")).fetchall():
+            if start_vtx not in moved and end_vtx not in moved:
+                continue
+            linetype, coords = parse_linestring(wkt)
+            if start_vtx in moved:
+                coords[0,:2] = moved[start_vtx]
+            if end_vtx in moved:
+                coords[-1,:2] = moved[end_vtx]
+            updates.append((format_linestring(linetype, coords), fid))
+
+        logging.info("Update: moving {} vertices to graph vertices".format(len(moved)))
+        cur.executemany(SQL("UPDATE split_lines SET GEOMETRY = GeomFromText(?, {srid}) WHERE OGC_FID = ?",
+                            srid=srid), updates)
+
+    def replace_input(self, cur):
+        """ Replace the input features with the updated features
+
+            Only the columns present in both tables are copied.
+        """
+        logging.info("Update: replacing input features in {}".format(self._input))
+        updated = set(r[1] for r in cur.execute(SQL("PRAGMA table_info({table})", table=self._table)).fetchall())
+        columns = ', '.join(r[1] for r in cur.execute(SQL("PRAGMA table_info({table})",
+                            table=self._input)).fetchall() if r[1] in updated)
+        cur.execute(SQL("DELETE FROM {input_table}", input_table=self._input))
+        cur.execute(SQL("INSERT INTO {input_table}({columns}) SELECT {columns} FROM {table}",
+                        input_table=self._input, table=self._table, columns=columns))
+
+    def patch_places(self, cur, buffer_size):
+        """ Rebuild places holding updated vertices
+
+            Computed places holding an updated vertex are removed and rebuilt from
+            the buffers of their vertices, together with computed places that would
+            have been merged with them; user places are kept. Place edges attached to
+            updated places are cut again.
+
+            When buffer_size is 0, places have been imported from file and only
+            the places of terminal vertices are rebuilt.
+        """
+        from .places import BUFFER_TABLE, update_edge_ends
+
+        logging.info("Update: patching places")
+
+        # Places from file are not flagged as user places
+        if buffer_size > 0:
+            computed = "p.USER_PL=0"
+        else:
+            computed = "(p.USER_PL=0 AND p.END_VTX IS NOT NULL)"
+
+        if not any(r[1]=='DIRTY' for r in cur.execute(SQL("PRAGMA table_info(ways)")).fetchall()):
+            cur.execute(SQL("ALTER TABLE ways ADD COLUMN DIRTY integer DEFAULT 0"))
+
+        # Updated computed places
+        cur.execute(SQL("CREATE TEMP TABLE update_pl(ID integer PRIMARY KEY)"))
+        cur.execute(SQL("""INSERT OR IGNORE INTO update_pl(ID)
+            SELECT pv.PLACE FROM place_vtx AS pv, places AS p
+            WHERE pv.VERTEX IN (SELECT ID FROM update_vtx) AND p.OGC_FID=pv.PLACE AND {computed}
+            """, computed=computed))
+
+        # Add places with vertices whose buffers overlap buffers of updated vertices
+        while True:
+            cur.execute(SQL("""INSERT OR IGNORE INTO update_vtx(ID)
+                SELECT VERTEX FROM place_vtx WHERE PLACE IN (SELECT ID FROM update_pl)"""))
+            if buffer_size <= 0:
+                break
+            [count] = cur.execute(SQL("SELECT Count(1) FROM update_pl")).fetchone()
+            cur.execute(SQL("""INSERT OR IGNORE INTO update_pl(ID)
+                SELECT pv.PLACE FROM vertices AS v, vertices AS w, place_vtx AS pv, places AS p
+                WHERE v.OGC_FID IN (SELECT ID FROM update_vtx) AND v.DEGREE > 1 AND w.DEGREE > 1
+                AND w.ROWID IN (
+                    SELECT ROWID FROM SpatialIndex
+                    WHERE f_table_name='vertices'
+                    AND search_frame=BuildCircleMbr(X(v.GEOMETRY), Y(v.GEOMETRY), {dist}))
+                AND Distance(v.GEOMETRY, w.GEOMETRY) <= {dist}
+                AND pv.VERTEX=w.OGC_FID AND p.OGC_FID=pv.PLACE AND {computed}
+                """, dist=2*buffer_size, computed=computed))
+            if cur.execute(SQL("SELECT Count(1) FROM update_pl")).fetchone()[0] == count:
+                break
+
+        # Mark ways going through updated places or updated edges
+        cur.execute(SQL("""UPDATE ways SET DIRTY=1 WHERE WAY_ID IN (
+            SELECT WAY FROM place_edges
+            WHERE OGC_FID IN (SELECT FID FROM update_edges)
+            OR START_VTX IN (SELECT ID FROM update_vtx) OR END_VTX IN (SELECT ID FROM update_vtx)
+            UNION
+            SELECT WAY_ID FROM way_places WHERE PLACE IN (SELECT ID FROM update_pl))
+            """))
+
+        # Places touched by removed place edges
+        cur.execute(SQL("CREATE TEMP TABLE touched_pl(ID integer PRIMARY KEY)"))
+        cur.execute(SQL("""INSERT OR IGNORE INTO touched_pl(ID)
+            SELECT START_PL FROM place_edges
+            WHERE START_VTX IN (SELECT ID FROM update_vtx) OR END_VTX IN (SELECT ID FROM update_vtx)
+            OR OGC_FID IN (SELECT FID FROM update_edges)
+            UNION
+            SELECT END_PL FROM place_edges
+            WHERE START_VTX IN (SELECT ID FROM update_vtx) OR END_VTX IN (SELECT ID FROM update_vtx)
+            OR OGC_FID IN (SELECT FID FROM update_edges)"""))
+
+        cur.execute(SQL("""DELETE FROM place_edges
+            WHERE START_VTX IN (SELECT ID FROM update_vtx) OR END_VTX IN (SELECT ID FROM update_vtx)
+            OR OGC_FID IN (SELECT FID FROM update_edges)"""))
+        cur.execute(SQL("""DELETE FROM place_vtx
+            WHERE VERTEX IN (SELECT ID FROM update_vtx) OR PLACE IN (SELECT ID FROM update_pl)"""))
+        cur.execute(SQL("DELETE FROM places WHERE OGC_FID IN (SELECT ID FROM update_pl)"))
+
+        [max_pl] = cur.execute(SQL("SELECT Max(OGC_FID) FROM places")).fetchone()
+        max_pl = max_pl or 0
+
+        # Attach vertices to user places
+        cur.execute(SQL("""INSERT INTO place_vtx(VERTEX, PLACE)
+            SELECT v.OGC_FID, p.OGC_FID FROM vertices AS v, places AS p
+            WHERE v.OGC_FID IN (SELECT ID FROM update_vtx) AND NOT {computed}
+            AND ST_Within(v.GEOMETRY, p.GEOMETRY)
+            AND p.ROWID IN (
+                SELECT ROWID FROM SpatialIndex
+                WHERE f_table_name='places' AND search_frame=v.GEOMETRY)""", computed=computed))
+
+        # Rebuild places from buffers
+        if buffer_size > 0:
+            create_indexed_table(cur, BUFFER_TABLE, 'MULTIPOLYGON', 'vertices')
+            cur.execute(SQL("""INSERT INTO {buffer_table}(GEOMETRY)
+                SELECT ST_Multi(ST_Union(ST_Buffer(v.GEOMETRY, {buffer_size})))
+                FROM vertices AS v
+                WHERE v.OGC_FID IN (SELECT ID FROM update_vtx) AND v.DEGREE > 1
+                AND v.OGC_FID NOT IN (SELECT VERTEX FROM place_vtx)
+                """, buffer_table=BUFFER_TABLE, buffer_size=buffer_size))
+            [rowid] = cur.execute(SQL("SELECT OGC_FID FROM {buffer_table}",
+                                      buffer_table=BUFFER_TABLE)).fetchone()
+            cur.execute(SQL("""INSERT INTO places(GEOMETRY)
+                SELECT ST_ConvexHull(GEOMETRY) FROM ElementaryGeometries
+                WHERE f_table_name='{buffer_table}' AND origin_rowid={rowid}
+                """, buffer_table=BUFFER_TABLE, rowid=rowid))
+            delete_table(cur, BUFFER_TABLE)
+
+            cur.execute(SQL("""INSERT INTO place_vtx(VERTEX, PLACE)
+                SELECT v.OGC_FID, p.OGC_FID FROM vertices AS v, places AS p
+                WHERE p.OGC_FID > {max_pl} AND v.DEGREE > 1
+                AND v.OGC_FID IN (SELECT ID FROM update_vtx)
+                AND v.OGC_FID NOT IN (SELECT VERTEX FROM place_vtx)
+                AND ST_Within(v.GEOMETRY, p.GEOMETRY)
+                AND v.ROWID IN (
+                    SELECT ROWID FROM SpatialIndex
+                    WHERE f_table_name='vertices' AND search_frame=p.GEOMETRY)
+                """, max_pl=max_pl))
+
+        # Add places for all left vertices
+        cur.execute(SQL("""INSERT INTO places(GEOMETRY,END_VTX)
+            SELECT ST_Buffer(v.GEOMETRY, 1), v.OGC_FID FROM vertices AS v
+            WHERE v.OGC_FID IN (SELECT ID FROM update_vtx)
+            AND v.OGC_FID NOT IN (SELECT VERTEX FROM place_vtx)"""))
+        cur.execute(SQL("""INSERT INTO place_vtx(VERTEX, PLACE)
+            SELECT END_VTX, OGC_FID FROM places WHERE OGC_FID > {max_pl} AND END_VTX IS NOT NULL
+            """, max_pl=max_pl))
+        cur.execute(SQL("""UPDATE places SET NB_VTX = (SELECT Count(1) FROM place_vtx WHERE PLACE=places.OGC_FID)
+            WHERE OGC_FID > {max_pl}""", max_pl=max_pl))
+
+        # Rebuild place edges of updated vertices
+        cur.execute(SQL("""INSERT INTO place_edges(OGC_FID, NAME, GEOMETRY, START_VTX, END_VTX, START_PL, END_PL)
+            SELECT e.OGC_FID, e.NAME, e.GEOMETRY, e.START_VTX, e.END_VTX,
+                (SELECT PLACE FROM place_vtx WHERE VERTEX=e.START_VTX),
+                (SELECT PLACE FROM place_vtx WHERE VERTEX=e.END_VTX)
+            FROM edges AS e
+            WHERE e.START_VTX IN (SELECT ID FROM update_vtx) OR e.END_VTX IN (SELECT ID FROM update_vtx)
+            """))
+        cur.execute(SQL("""DELETE FROM place_edges
+            WHERE OGC_FID IN (SELECT e.OGC_FID
+                FROM places AS p, place_edges AS e
+                WHERE (e.START_VTX IN (SELECT ID FROM update_vtx) OR e.END_VTX IN (SELECT ID FROM update_vtx))
+                AND (e.START_PL=p.OGC_FID OR e.END_PL=p.OGC_FID) AND ST_Within(e.GEOMETRY, p.GEOMETRY))
+            """))
+
+        # Update degree of touched places
+        cur.execute(SQL("""INSERT OR IGNORE INTO touched_pl(ID)
+            SELECT OGC_FID FROM places WHERE OGC_FID > {max_pl}
+            UNION
+            SELECT START_PL FROM place_edges
+            WHERE START_VTX IN (SELECT ID FROM update_vtx) OR END_VTX IN (SELECT ID FROM update_vtx)
+            UNION
+            SELECT END_PL FROM place_edges
+            WHERE START_VTX IN (SELECT ID FROM update_vtx) OR END_VTX IN (SELECT ID FROM update_vtx)
+            """, max_pl=max_pl))
+        cur.execute(SQL("""UPDATE places SET DEGREE =
+                (SELECT Count(1) FROM place_edges WHERE START_PL = places.OGC_FID)
+               +(SELECT Count(1) FROM place_edges WHERE END_PL = places.OGC_FID)
+            WHERE OGC_FID IN (SELECT ID FROM touched_pl)"""))
+        cur.execute(SQL("""DELETE FROM place_vtx WHERE PLACE IN (
+            SELECT OGC_FID FROM places WHERE OGC_FID IN (SELECT ID FROM touched_pl) AND DEGREE=0)"""))
+        cur.execute(SQL("DELETE FROM places WHERE OGC_FID IN (SELECT ID FROM touched_pl) AND DEGREE=0"))
+
+        # Cut again all place edges attached to touched places
+        cur.execute(SQL("""UPDATE place_edges SET
+            GEOMETRY = (SELECT e.GEOMETRY FROM edges AS e WHERE e.OGC_FID=place_edges.OGC_FID),
+            STATUS   = 0
+            WHERE START_PL IN (SELECT ID FROM touched_pl) OR END_PL IN (SELECT ID FROM touched_pl)"""))
+        self._conn.commit()
+        selection = ("(place_edges.START_PL IN (SELECT ID FROM touched_pl)"
+                     " OR place_edges.END_PL IN (SELECT ID FROM touched_pl))")
+        execute_sql(self._conn, "place_edges.sql", quiet=True, selection=selection)
+        update_edge_ends(self._conn, selection=selection)
+
+        cur.execute(SQL("""UPDATE ways SET DIRTY=1 WHERE WAY_ID IN (
+            SELECT WAY FROM place_edges
+            WHERE START_PL IN (SELECT ID FROM touched_pl) OR END_PL IN (SELECT ID FROM touched_pl))
+            """))
+
+        cur.execute(SQL("DROP TABLE update_pl"))
+        cur.execute(SQL("DROP TABLE touched_pl"))
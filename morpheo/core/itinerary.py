@@ -9,7 +9,7 @@ from .logger import Progress
 from .errors import BuilderError
 from .sql    import connect_database, SQL, execute_sql, attr_table, table_exists
 from .layers import export_shapefile
-from .places import load_edge_graph
+from .places import load_edge_graph, require_edge_ends
 from .mesh   import features_from_geometry
 
 from math import atan2, pi
@@ -189,6 +189,7 @@ def naive_azimuth_path(dbname, path, source, target, output=None, conn=None, sto
         return a
 
     conn = conn or connect_database(dbname)
+    require_edge_ends(conn)
     cur  = conn.cursor()
 
     # Compute the reference  azimuth
@@ -209,22 +210,15 @@ def naive_azimuth_path(dbname, path, source, target, output=None, conn=None, sto
         az_dest = azimuth( *(get_coordinates(n)+get_coordinates(target)) )
 
         rows = cur.execute(SQL("""SELECT
-            fid, next, ST_X(p1), ST_Y(p1), ST_X(p2), ST_Y(p2)
-            FROM (
-                SELECT OGC_FID AS fid, END_PL AS next,
-                ST_StartPoint(GEOMETRY) AS p1,
-                ST_PointN(GEOMETRY,2) AS p2
-                FROM place_edges WHERE START_PL={node} AND OGC_FID<>{edgeid}
-                UNION ALL
-                SELECT OGC_FID AS fid, START_PL AS next,
-                ST_EndPoint(GEOMETRY) AS p1,
-                ST_PointN(GEOMETRY, ST_NumPoints(GEOMETRY)-1) AS p2
-                FROM place_edges WHERE END_PL={node} AND OGC_FID<>{edgeid})
+            e.EDGE, CASE WHEN e.IS_START THEN p.END_PL ELSE p.START_PL END, e.AZIMUTH
+            FROM edge_ends AS e, place_edges AS p
+            WHERE e.PLACE={node} AND e.EDGE<>{edgeid} AND p.OGC_FID=e.EDGE
+            ORDER BY e.ROWID
             """,node=n, edgeid=edgeid)).fetchall()
 
         # Select the next node from the the edge that mininize the
         # difference between azimuth
-        edgeid,n = min(rows,key=lambda r:angle(azimuth(*r[2:]),az_dest))[0:2]
+        edgeid,n = min(rows,key=lambda r:angle(r[2],az_dest))[0:2]
 
         if edgeid not in edges:
             edges[edgeid]=level
@@ -275,6 +269,7 @@ def azimuth_path(dbname, path, source, target, output=None, conn=None, store_pat
     G = load_edge_graph(path)
 
     conn = conn or connect_database(dbname)
+    require_edge_ends(conn)
     cur  = conn.cursor()
 
     # Compute the reference  azimuth
@@ -286,30 +281,18 @@ def azimuth_path(dbname, path, source, target, output=None, conn=None, store_pat
         return x,y
 
     def get_edge_azimuth(node, edge):
-        row = cur.execute(SQL("""SELECT
-            ST_X(p1), ST_Y(p1), ST_X(p2), ST_Y(p2)
-            FROM (
-                SELECT ST_StartPoint(GEOMETRY) AS p1, ST_PointN(GEOMETRY,2) AS p2
-                FROM place_edges WHERE START_PL={node} AND OGC_FID={fid}
-                UNION ALL
-                SELECT ST_EndPoint(GEOMETRY) AS p1, ST_PointN(GEOMETRY, ST_NumPoints(GEOMETRY)-1) AS p2
-                FROM place_edges WHERE END_PL={node} AND OGC_FID={fid})
+        [az] = cur.execute(SQL("""SELECT AZIMUTH FROM edge_ends 
+            WHERE PLACE={node} AND EDGE={fid}
+            ORDER BY IS_START DESC
         """,node=node,fid=edge)).fetchone()
-        return azimuth(*row)
+        return az
 
     def get_edge_candidates(node, edgeid=-1):
         rows = cur.execute(SQL("""SELECT
-            fid, next, ST_X(p1), ST_Y(p1), ST_X(p2), ST_Y(p2)
-            FROM (
-                SELECT OGC_FID AS fid, END_PL AS next,
-                ST_StartPoint(GEOMETRY) AS p1,
-                ST_PointN(GEOMETRY,2) AS p2
-                FROM place_edges WHERE START_PL={node} AND OGC_FID<>{edgeid} AND START_PL<>END_PL
-                UNION ALL
-                SELECT OGC_FID AS fid, START_PL AS next,
-                ST_EndPoint(GEOMETRY) AS p1,
-                ST_PointN(GEOMETRY, ST_NumPoints(GEOMETRY)-1) AS p2
-                FROM place_edges WHERE END_PL={node} AND OGC_FID<>{edgeid} AND START_PL<>END_PL)
+            e.EDGE, CASE WHEN e.IS_START THEN p.END_PL ELSE p.START_PL END, e.AZIMUTH
+            FROM edge_ends AS e, place_edges AS p
+            WHERE e.PLACE={node} AND e.EDGE<>{edgeid} AND p.OGC_FID=e.EDGE AND p.START_PL<>p.END_PL
+            ORDER BY e.ROWID
             """,node=node, edgeid=edgeid)).fetchall()
         return rows
 
@@ -325,15 +308,14 @@ def azimuth_path(dbname, path, source, target, output=None, conn=None, store_pat
             a = 2*pi - a
         return a
 
-    def angle_diff(coords, dst, ref):
-        az = azimuth(*coords)
+    def angle_diff(az, dst, ref):
         return abs(angle_rel(az,ref)-angle_rel(dst,ref))
 
     n = source
 
     # Get starting edge
     az_dst = azimuth( *(get_coordinates(n)+get_coordinates(target)) )
-    edgeid,n = min(get_edge_candidates(n),key=lambda r:angle_abs(azimuth(*r[2:]),az_dst))[0:2]
+    edgeid,n = min(get_edge_candidates(n),key=lambda r:angle_abs(r[2],az_dst))[0:2]
 
     level = 0
     edges = { edgeid: level }
@@ -354,7 +336,7 @@ def azimuth_path(dbname, path, source, target, output=None, conn=None, store_pat
 
             # Select the next node from the the edge that mininize the
             # difference benween angles
-            edgeid,n = min(rows,key=lambda r:angle_diff(r[2:],az_dst,az_ref))[0:2]
+            edgeid,n = min(rows,key=lambda r:angle_diff(r[2],az_dst,az_ref))[0:2]
 
         if edgeid not in edges:
             edges[edgeid]=level
@@ -0,0 +1,134 @@
+-- Cut place edges geometries at places
+-- 
+-- The 'selection' parameter is a condition restricting the place edges
+-- to update: use '1' for updating all place edges
+
+-- Compute the difference with both end places once for each edge
+-- Edges with a single place (places from file or null buffer) are 
+-- cut at this place only, loops are cut once at their place
+
+CREATE TEMP TABLE place_edge_cuts(
+    ID         integer PRIMARY KEY,
+    START_PL   integer,
+    END_PL     integer,
+    LOOP       integer,
+    START_DEG  integer,
+    END_DEG    integer,
+    GEOMETRY   blob,
+    DIFF       blob,
+    STATUS     integer,
+    CUT        blob
+);
+
+INSERT INTO place_edge_cuts(ID, START_PL, END_PL, LOOP, START_DEG, END_DEG, GEOMETRY, DIFF)
+SELECT place_edges.OGC_FID, place_edges.START_PL, place_edges.END_PL,
+       COALESCE(place_edges.START_PL=place_edges.END_PL, 0),
+       ps.DEGREE, pe.DEGREE,
+       place_edges.GEOMETRY,
+       ST_Difference(place_edges.GEOMETRY, CASE
+            WHEN pe.OGC_FID IS NULL OR pe.OGC_FID=ps.OGC_FID THEN ps.GEOMETRY
+            WHEN ps.OGC_FID IS NULL THEN pe.GEOMETRY
+            ELSE ST_Union(ps.GEOMETRY, pe.GEOMETRY)
+            END)
+FROM place_edges
+LEFT JOIN places AS ps ON ps.OGC_FID=place_edges.START_PL
+LEFT JOIN places AS pe ON pe.OGC_FID=place_edges.END_PL
+WHERE $selection
+;
+
+-- Mark invalid geometries
+-- Invalid geometries are geometries that crosses start or end places
+-- multiple times - this may happends with places wich are not convex 
+-- such as digitalized places
+
+UPDATE place_edge_cuts SET
+STATUS = ST_NumGeometries(DIFF)=1
+;
+
+-- Cut geometry at start and end
+-- The difference with both places is the cut when all existing end places 
+-- are cut, otherwise the edge is cut at the single place with DEGREE>1
+
+UPDATE place_edge_cuts SET
+CUT = CASE
+    WHEN COALESCE(START_DEG>1, END_DEG>1) AND COALESCE(END_DEG>1 OR LOOP, START_DEG>1) THEN DIFF
+    WHEN START_DEG>1 THEN ST_Difference(GEOMETRY, (SELECT GEOMETRY FROM places WHERE OGC_FID=place_edge_cuts.START_PL))
+    WHEN END_DEG>1 AND NOT LOOP THEN ST_Difference(GEOMETRY, (SELECT GEOMETRY FROM places WHERE OGC_FID=place_edge_cuts.END_PL))
+    ELSE GEOMETRY
+    END
+WHERE STATUS=1
+;
+
+-- Handle invalid geometries: keep the last part after the start cut
+-- and the first part after the end cut
+
+UPDATE place_edge_cuts SET
+CUT = CASE WHEN START_DEG>1 
+           THEN ST_Difference(GEOMETRY, (SELECT GEOMETRY FROM places WHERE OGC_FID=place_edge_cuts.START_PL))
+           ELSE GEOMETRY
+      END
+WHERE STATUS=0
+;
+
+UPDATE place_edge_cuts SET
+CUT = ST_GeometryN(CUT, ST_NumGeometries(CUT))
+WHERE STATUS=0 AND ST_NumGeometries(CUT)>1
+;
+
+UPDATE place_edge_cuts SET
+CUT = ST_Difference(CUT, (SELECT GEOMETRY FROM places WHERE OGC_FID=place_edge_cuts.END_PL))
+WHERE STATUS=0 AND END_DEG>1
+;
+
+UPDATE place_edge_cuts SET
+CUT = ST_GeometryN(CUT, 1)
+WHERE STATUS=0 AND ST_NumGeometries(CUT)>1
+;
+
+-- Update place edges
+
+UPDATE place_edges SET
+STATUS = (SELECT STATUS FROM place_edge_cuts WHERE ID=place_edges.OGC_FID)
+WHERE $selection
+;
+
+UPDATE place_edges SET
+GEOMETRY = (SELECT CUT FROM place_edge_cuts WHERE ID=place_edges.OGC_FID)
+WHERE OGC_FID IN (SELECT ID FROM place_edge_cuts WHERE STATUS IS NOT NULL)
+;
+
+DROP TABLE place_edge_cuts;
+
+-- In some cases, convex hull overlaps non-connected places
+-- This leads in situation where place edges geometries are null when 
+-- computed from differences from places geometries
+-- In those case restore the original edge geometry
+-- We mark those edges with a special status code  
+
+UPDATE place_edges SET
+GEOMETRY = (SELECT e.GEOMETRY FROM edges AS e WHERE place_edges.OGC_FID=e.OGC_FID),
+STATUS   = 2
+WHERE GEOMETRY IS NULL AND $selection
+;
+
+-- Update place_edges degree
+
+UPDATE place_edges
+SET DEGREE = CASE
+    WHEN place_edges.START_PL != place_edges.END_PL THEN
+        (SELECT DEGREE FROM places WHERE places.OGC_FID = place_edges.START_PL)
+       +(SELECT DEGREE FROM places WHERE places.OGC_FID = place_edges.END_PL)
+       - 2
+    WHEN place_edges.START_VTX == place_edges.END_VTX THEN
+        (SELECT DEGREE FROM places WHERE places.OGC_FID = place_edges.START_PL)
+       - 2
+    ELSE place_edges.DEGREE
+    END
+WHERE $selection
+;
+
+-- Update place_edges length
+
+UPDATE place_edges SET LENGTH = (SELECT ST_Length(place_edges.GEOMETRY))
+WHERE $selection
+;
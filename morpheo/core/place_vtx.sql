@@ -0,0 +1,15 @@
+-- Create an association table between places and graph vertices
+-- This is much faster than using subqueries/join with edge table
+
+-- Do not clusterize cul-de-sac vertices (ie DEGREE=1)
+-- This will prevent artificially connecting dead-end with other edges
+
+INSERT INTO place_vtx(VERTEX, PLACE)
+SELECT v.OGC_FID, p.OGC_FID
+FROM vertices AS v, places AS p
+WHERE ST_Within( v.GEOMETRY, p.GEOMETRY ) 
+AND v.OGC_FID NOT IN (SELECT OGC_FID FROM left_vertices)
+AND v.ROWID IN (
+    SELECT ROWID FROM Spatialindex
+    WHERE f_table_name='vertices' AND search_frame=p.GEOMETRY)
+;
@@ -2,6 +2,7 @@
 """
 import os
 import logging
+import numpy as np
 import networkx as nx
 
 from .logger import log_progress
@@ -15,6 +16,9 @@ from .layers import export_shapefile
 
 BUFFER_TABLE='temp_buffer'
 
+# Number of geometries merged at each level of the union tree
+UNION_FANIN=16
+
 
 def _edge_graph_path( output ):
     """ Build edge graph path
@@ -55,11 +59,97 @@ def load_edge_graph( path ):
                 "Error while reading graph {}: {}".format(graph_path,e))
 
 
+def update_edge_ends( conn, selection='1' ):
+    """ Update the 'edge_ends' table from place edges
+
+        Start and end points of place edges and their azimuths are
+        computed once, so that geometries are not decoded again when
+        pairing edges or computing angles.
+
+        :param selection: a condition restricting the place edges to update
+    """
+    from .angles import azimuths
+
+    cur = conn.cursor()
+    if not table_exists(cur, 'edge_ends'):
+        execute_sql(conn, "edge_ends.sql", quiet=True)
+
+    cur.execute(SQL("""DELETE FROM edge_ends
+        WHERE EDGE NOT IN (SELECT OGC_FID FROM place_edges)
+        OR EDGE IN (SELECT OGC_FID FROM place_edges WHERE {selection})""", selection=selection))
+
+    rows = cur.execute(SQL("""SELECT
+        pl, fid, start, ST_X(p1), ST_Y(p1), ST_X(p2), ST_Y(p2)
+        FROM (
+            SELECT
+            OGC_FID AS fid,
+            START_PL AS pl,
+            1 AS start,
+            ST_StartPoint(GEOMETRY) AS p1,
+            ST_PointN(GEOMETRY,2) AS p2
+            FROM place_edges WHERE {selection}
+        UNION ALL
+            SELECT
+            OGC_FID AS fid,
+            END_PL AS pl,
+            0 AS start,
+            ST_EndPoint(GEOMETRY) AS p1,
+            ST_PointN(GEOMETRY, ST_NumPoints(GEOMETRY)-1) AS p2
+            FROM place_edges WHERE {selection})
+    """, selection=selection)).fetchall()
+    if not rows:
+        return
+
+    coords = np.array([r[3:7] for r in rows], dtype=float)
+    az = azimuths(*coords.T)
+    cur.executemany(SQL("INSERT INTO edge_ends(PLACE,EDGE,IS_START,X,Y,AZIMUTH) VALUES (?,?,?,?,?,?)"),
+                    [r[:5]+(float(a),) for r, a in zip(rows, az)])
+
+
+def require_edge_ends( conn ):
+    """ Create and fill the 'edge_ends' table if it does not exist
+
+        Databases built before the 'edge_ends' table was introduced
+        get it computed from place edges on first use.
+    """
+    cur = conn.cursor()
+    if not table_exists(cur, 'edge_ends'):
+        logging.info("Places: computing edge ends")
+        update_edge_ends(conn)
+        conn.commit()
+
+
+def _union_geometries( blobs ):
+    """ Compute the union of spatialite geometry blobs
+
+        This function is run in worker processes
+    """
+    from .sql import spatialite_connect
+    conn = spatialite_connect(':memory:')
+    try:
+        cur = conn.cursor()
+        cur.execute("CREATE TABLE geoms(GEOMETRY blob)")
+        cur.executemany("INSERT INTO geoms(GEOMETRY) VALUES (?)", ((b,) for b in blobs))
+        [geom] = cur.execute("SELECT ST_Union(GEOMETRY) FROM geoms").fetchone()
+    finally:
+        conn.close()
+    return bytes(geom) if geom is not None else None
+
+
 class PlaceBuilder(object):
+    """ Build places and place edges
 
-    def __init__(self, conn, chunks=100):
-       self._conn   = conn
-       self._chunks = chunks
+        :param conn: spatialite connection
+        :param chunks: number of chunks for computing the union of buffers
+        :param workers: if > 1, the union of buffers is computed as a tree of
+                        unions of spatially close buffers run in a pool of 
+                        worker processes
+    """
+
+    def __init__(self, conn, chunks=100, workers=1):
+       self._conn    = conn
+       self._chunks  = chunks
+       self._workers = workers
 
     def export(self, dbname, output, export_graph=False ):
        logging.info("Places: Saving places to %s" % output)
@@ -74,7 +164,7 @@ class PlaceBuilder(object):
               logging.info("Places: cleaning existing edge graph")
               os.remove(path)
    
-    def build_places( self, buffer_size, input_places=None):
+    def build_places( self, buffer_size, input_places=None, cluster_vertices=False, bulk_place_vtx=False):
         """ Build places
 
             Build places from buffer and/or external places definition.
@@ -86,16 +176,68 @@ class PlaceBuilder(object):
 
             :param buffer_size: buffer size applied to vertices
             :param input_places: path of an external shapefile containing places definitions
+            :param cluster_vertices: when no places definition is used, build places by clustering
+                                     vertices instead of computing the union of buffers
+            :param bulk_place_vtx: assign vertices to places in memory (see assign_place_vertices)
         """
         # Use a minimum buffer_size
         buffer_size = buffer_size or 0
 
-        if buffer_size > 0:
-            self.creates_places_from_buffer(buffer_size, input_places )
+        self._clean_places()
+
+        if cluster_vertices and input_places is not None:
+            logging.warn("Places: vertex clustering is not used with input places")
+
+        if buffer_size > 0 and cluster_vertices and input_places is None:
+            self.creates_places_from_clusters(buffer_size)
         else:
-            self.creates_places_from_file(input_places)
+            if buffer_size > 0:
+                self.creates_places_from_buffer(buffer_size, input_places )
+            else:
+                self.creates_places_from_file(input_places)
+            if bulk_place_vtx:
+                self.assign_place_vertices()
+            else:
+                execute_sql(self._conn, "place_vtx.sql")
+        self._build_place_edges()
+
+    def sweep_places( self, buffer_sizes ):
+        """ Build places from vertex clusters for an increasing list of buffer sizes
+
+            Vertices are read once and clusters are merged incrementally from
+            one buffer size to the next (see geometry.cluster_sweep).
+
+            :param buffer_sizes: list of buffer sizes applied to vertices
+            :return: an iterator over the buffer sizes in increasing order, places
+                     and place edges are built for the current size at each step
+        """
+        from .geometry import cluster_sweep
+
+        rows   = self._cluster_vertices()
+        points = np.array([r[1:] for r in rows])
+        for distance, part in cluster_sweep(points, [2*b for b in buffer_sizes]):
+            buffer_size = distance/2.0
+            logging.info("Places: building places for buffer size {}".format(buffer_size))
+            self._clean_places()
+            self._create_cluster_places(rows, part, buffer_size)
+            self._build_place_edges()
+            yield buffer_size
+
+    def _clean_places(self):
+        """ Clean up tables depending on places
+        """
+        cur = self._conn.cursor()
+        for table in ('place_vtx', 'place_edges', 'ways', 'way_places'):
+            cur.execute(SQL("DELETE FROM {table}", table=table))
+
+    def _build_place_edges(self):
+        """ Build place edges from places and 'place_vtx'
+        """
         logging.info("Places: building edges")
         execute_sql(self._conn, "places.sql")
+        execute_sql(self._conn, "place_edges.sql", selection='1')
+        update_edge_ends(self._conn)
+        self._conn.cursor().execute(SQL("VACUUM"))
         self._conn.commit()
 
     def creates_places_from_file(self, input_places):
@@ -106,11 +248,135 @@ class PlaceBuilder(object):
         cur.execute(SQL("INSERT INTO places(GEOMETRY) SELECT GEOMETRY FROM {input_table}",
                     input_table=input_places))
 
+    def tree_union(self, cur, table):
+        """ Replace the geometries of table by their union
+
+            Geometries are sorted along a Z-order curve and merged by groups
+            of UNION_FANIN consecutive geometries: each level of the tree
+            is run in a pool of worker processes, so that only spatially 
+            close geometries are merged until a single geometry remains.
+
+            :return: False if the table is empty
+        """
+        from multiprocessing import Pool
+        from .geometry import morton_order
+
+        rows = cur.execute(SQL("""SELECT GEOMETRY,
+            (MbrMinX(GEOMETRY)+MbrMaxX(GEOMETRY))/2, (MbrMinY(GEOMETRY)+MbrMaxY(GEOMETRY))/2
+            FROM {table} WHERE GEOMETRY IS NOT NULL""", table=table)).fetchall()
+        if not rows:
+            logging.warn("No items in buffer_table !")
+            return False
+
+        order = morton_order([r[1] for r in rows], [r[2] for r in rows])
+        blobs = [bytes(rows[i][0]) for i in order]
+        del rows
+
+        logging.info("Places: Building union of {} geometries ({} workers)".format(
+                     len(blobs), self._workers))
+        pool = Pool(self._workers)
+        try:
+            level = 0
+            while len(blobs) > 1:
+                level += 1
+                groups = [blobs[i:i+UNION_FANIN] for i in range(0, len(blobs), UNION_FANIN)]
+                blobs  = [b for b in pool.map(_union_geometries, groups) if b is not None]
+                logging.info("Places: union level {}: {} geometries".format(level, len(blobs)))
+        finally:
+            pool.close()
+            pool.join()
+
+        cur.execute(SQL("DELETE FROM {table}", table=table))
+        cur.execute(SQL("INSERT INTO {table}(OGC_FID, GEOMETRY) SELECT 1, ST_Multi(?)", table=table),
+                    (blobs[0],))
+        return True
+
+    def assign_place_vertices(self):
+        """ Fill 'place_vtx' with vertices included in places
+
+            This is the equivalent of place_vtx.sql: vertices and places are
+            read once and point in polygon tests are computed in memory.
+        """
+        from .geometry import parse_polygon, points_in_polygons
+
+        logging.info("Places: assigning vertices to places")
+
+        cur = self._conn.cursor()
+        vertices = cur.execute(SQL("""SELECT OGC_FID, X(GEOMETRY), Y(GEOMETRY) FROM vertices
+            WHERE OGC_FID NOT IN (SELECT OGC_FID FROM left_vertices)""")).fetchall()
+        places = cur.execute(SQL("SELECT OGC_FID, AsText(GEOMETRY) FROM places WHERE GEOMETRY IS NOT NULL")).fetchall()
+        if not vertices or not places:
+            return
+
+        points = np.array([r[1:] for r in vertices])
+        vtx, pl = points_in_polygons(points, [parse_polygon(r[1]) for r in places])
+        cur.executemany(SQL("INSERT INTO place_vtx(VERTEX, PLACE) VALUES (?,?)"),
+                        ((vertices[i][0], places[j][0]) for i, j in zip(vtx, pl)))
+
+    def creates_places_from_clusters(self, buffer_size):
+        """ Creates places from clusters of vertices
+
+            Vertices with DEGREE > 1 closer than 2*buffer_size are clustered
+            together, which gives the same connected components as the union
+            of buffers: each place is the convex hull of the buffers of
+            a cluster. 'place_vtx' is filled directly from clusters.
+        """
+        from .geometry import cluster_points
+
+        logging.info("Places: building places from vertex clusters (buffer size={})".format(buffer_size))
+
+        rows   = self._cluster_vertices()
+        points = np.array([r[1:] for r in rows])
+        self._create_cluster_places(rows, cluster_points(points, 2*buffer_size), buffer_size)
+
+    def _cluster_vertices(self):
+        """ Return the vertices to cluster as (OGC_FID, X, Y) rows
+
+            Terminal vertices are stored in 'left_vertices' and are
+            handled in places.sql
+        """
+        cur = self._conn.cursor()
+        cur.execute(SQL("CREATE TABLE IF NOT EXISTS left_vertices(OGC_FID integer PRIMARY KEY)"))
+        cur.execute(SQL("DELETE FROM left_vertices"))
+        cur.execute(SQL("INSERT INTO left_vertices(OGC_FID) SELECT OGC_FID FROM vertices WHERE DEGREE<=1"))
+
+        rows = cur.execute(SQL("SELECT OGC_FID, X(GEOMETRY), Y(GEOMETRY) FROM vertices WHERE DEGREE>1")).fetchall()
+        if not rows:
+            raise BuilderError("No places created ! please check input data !")
+        return rows
+
+    def _create_cluster_places(self, rows, part, buffer_size):
+        """ Create places and fill 'place_vtx' from a partition of vertices
+        """
+        _, labels = np.unique(part, return_inverse=True)
+
+        cur = self._conn.cursor()
+        cur.execute(SQL("DELETE FROM places"))
+        cur.execute(SQL("CREATE TEMP TABLE vertex_cluster(VERTEX integer PRIMARY KEY, CLUSTER integer)"))
+        cur.executemany(SQL("INSERT INTO vertex_cluster(VERTEX, CLUSTER) VALUES (?,?)"),
+                        ((r[0], int(l)+1) for r, l in zip(rows, labels)))
+        cur.execute(SQL("CREATE INDEX vertex_cluster_idx ON vertex_cluster(CLUSTER)"))
+
+        logging.info("Places: computing convex hulls")
+        cur.execute(SQL("""
+            INSERT INTO places(OGC_FID, GEOMETRY)
+            SELECT c.CLUSTER, ST_ConvexHull(ST_Collect(ST_Buffer(v.GEOMETRY, {buffer_size})))
+            FROM vertex_cluster AS c, vertices AS v
+            WHERE v.OGC_FID=c.VERTEX
+            GROUP BY c.CLUSTER
+        """, buffer_size=buffer_size))
+        cur.execute(SQL("INSERT INTO place_vtx(VERTEX, PLACE) SELECT VERTEX, CLUSTER FROM vertex_cluster"))
+        cur.execute(SQL("DROP TABLE vertex_cluster"))
+
+        logging.info("Places: created {} places".format(labels.max()+1))
+
     def creates_places_from_buffer(self, buffer_size, input_places ):
         """ Creates places from buffer
         """
         logging.info("Places: building places from buffers (buffer size={})".format(buffer_size))
         def union_buffers():
+            if self._workers > 1:
+                return self.tree_union(cur, BUFFER_TABLE)
             count = cur.execute(SQL("SELECT Max(OGC_FID) FROM {buffer_table}", buffer_table=BUFFER_TABLE)).fetchone()[0]
             if count is None:
                 logging.warn("No items in buffer_table !")
@@ -260,54 +526,73 @@ class PlaceBuilder(object):
                             WHERE f_table_name='places' AND search_frame=b.GEOMETRY
                         )""")).fetchall()
 
-                to_merge = {place:[] for _,place in rows}
+                # Bulk read of the vertices included in candidate buffers and places
+                cur.execute(SQL("CREATE TEMP TABLE merge_candidates(BUFFER integer, PLACE integer)"))
+                cur.executemany(SQL("INSERT INTO merge_candidates(BUFFER,PLACE) VALUES (?,?)"), rows)
 
-                for buf, place in rows:
-                    # Fetch all vertices included in buffer
-                    vertices=cur.execute(SQL("""
-                        SELECT v.OGC_FID FROM vertices AS v, places AS b
-                            WHERE ST_Within( v.GEOMETRY, b.GEOMETRY )
-                            AND b.OGC_FID={buffer}
-                            AND v.ROWID IN (
-                                SELECT ROWID FROM SpatialIndex
-                                WHERE f_table_name='vertices' AND search_frame=b.GEOMETRY)
-                            """, buffer=buf)).fetchall()
-
-                    # Test that they are connected to vertex in place
-                    [rv] = cur.execute(SQL("""
-                        SELECT Count(v.OGC_FID) FROM tmp_places AS p, vertices AS v
-                        WHERE v.OGC_FID IN (
-                            SELECT vtx FROM (
-                                SELECT START_VTX AS vtx FROM edges WHERE END_VTX IN ({vertices})
-                                UNION
-                                SELECT END_VTX AS vtx FROM edges WHERE START_VTX IN ({vertices})
-                            )
-                        ) 
-                        AND p.OGC_FID={place}
+                buffer_vtx = {}
+                for buf, vtx in cur.execute(SQL("""
+                    SELECT b.OGC_FID, v.OGC_FID FROM vertices AS v, places AS b
+                        WHERE b.OGC_FID IN (SELECT BUFFER FROM merge_candidates)
+                        AND ST_Within( v.GEOMETRY, b.GEOMETRY )
+                        AND v.ROWID IN (
+                            SELECT ROWID FROM SpatialIndex
+                            WHERE f_table_name='vertices' AND search_frame=b.GEOMETRY)
+                    """)).fetchall():
+                    buffer_vtx.setdefault(buf,[]).append(vtx)
+
+                place_vtx = {}
+                for place, vtx in cur.execute(SQL("""
+                    SELECT p.OGC_FID, v.OGC_FID FROM vertices AS v, tmp_places AS p
+                        WHERE p.OGC_FID IN (SELECT PLACE FROM merge_candidates)
                         AND ST_Within( v.GEOMETRY, p.GEOMETRY )
                         AND v.ROWID IN (
                             SELECT ROWID FROM SpatialIndex
                             WHERE f_table_name='vertices' AND search_frame=p.GEOMETRY)
-                        """, place=place, vertices=','.join(str(s[0]) for s in vertices))).fetchone()
-
-                    if rv:
-                        to_merge[place].append(buf)
+                    """)).fetchall():
+                    place_vtx.setdefault(place,set()).add(vtx)
+
+                # Neighbours of buffer vertices from edge endpoints
+                cur.execute(SQL("CREATE TEMP TABLE merge_vtx(ID integer PRIMARY KEY)"))
+                cur.executemany(SQL("INSERT OR IGNORE INTO merge_vtx(ID) VALUES (?)"),
+                                ((v,) for vertices in buffer_vtx.values() for v in vertices))
+                neighbours = {}
+                for vtx, other in cur.execute(SQL("""
+                    SELECT END_VTX, START_VTX FROM edges WHERE END_VTX IN (SELECT ID FROM merge_vtx)
+                    UNION
+                    SELECT START_VTX, END_VTX FROM edges WHERE START_VTX IN (SELECT ID FROM merge_vtx)
+                    """)).fetchall():
+                    neighbours.setdefault(vtx,set()).add(other)
+
+                cur.execute(SQL("DROP TABLE merge_candidates"))
+                cur.execute(SQL("DROP TABLE merge_vtx"))
+
+                # Merge a buffer into every place having one of its vertices
+                # connected to a vertex of the buffer
+                merged = []
+                for buf, place in rows:
+                    inner = place_vtx.get(place,())
+                    if any(not neighbours.get(v,set()).isdisjoint(inner) for v in buffer_vtx.get(buf,())):
+                        merged.append((buf, place))
 
                 # Merge buffers into places
-                for place, buffers in to_merge.items():
-                    if buffers:
-                        bufstr = ','.join(str(b) for b in buffers)
-                        cur.execute(SQL("""INSERT INTO places(GEOMETRY,USER_PL)
-                            SELECT ST_Union(geom),1 FROM (
-                                SELECT GEOMETRY AS geom FROM tmp_places WHERE OGC_FID={place}
-                                UNION ALL
-                                SELECT GEOMETRY AS geom FROM places WHERE OGC_FID in ({buffers})
-                            )""",place=place, buffers=bufstr))
-                    
-                        # Clean up merged buffers
-                        cur.execute(SQL("DELETE FROM tmp_places WHERE OGC_FID={place}",place=place))
-                        cur.execute(SQL("DELETE FROM places WHERE OGC_FID in ({buffers})",
-                                        buffers=bufstr))
+                if merged:
+                    cur.execute(SQL("CREATE TEMP TABLE place_merge(BUFFER integer, PLACE integer)"))
+                    cur.executemany(SQL("INSERT INTO place_merge(BUFFER,PLACE) VALUES (?,?)"), merged)
+                    cur.execute(SQL("""INSERT INTO places(GEOMETRY,USER_PL)
+                        SELECT ST_Union(geom),1 FROM (
+                            SELECT OGC_FID AS place, GEOMETRY AS geom FROM tmp_places
+                            WHERE OGC_FID IN (SELECT PLACE FROM place_merge)
+                            UNION ALL
+                            SELECT m.PLACE AS place, b.GEOMETRY AS geom FROM places AS b, place_merge AS m
+                            WHERE b.OGC_FID=m.BUFFER
+                        ) GROUP BY place"""))
+
+                    # Clean up merged buffers
+                    cur.execute(SQL("DELETE FROM tmp_places WHERE OGC_FID IN (SELECT PLACE FROM place_merge)"))
+                    cur.execute(SQL("DELETE FROM places WHERE OGC_FID IN (SELECT BUFFER FROM place_merge)"))
+                    cur.execute(SQL("DROP TABLE place_merge"))
+
                 # Add remaining places
                 cur.execute("INSERT INTO places(GEOMETRY,USER_PL) SELECT GEOMETRY,1 FROM tmp_places")
             finally:
@@ -1,31 +1,6 @@
 -- Build edges between places
 
 
--- Clean up things 
-
-DELETE FROM place_vtx;
-DELETE FROM place_edges;
-DELETE FROM ways;
-DELETE FROM way_places;
-DELETE FROM way_angles;
-
--- Create an association table between places and graph vertices
--- This is much faster than using subqueries/join with edge table
-
--- Do not clusterize cul-de-sac vertices (ie DEGREE=1)
--- This will prevent artificially connecting dead-end with other edges
-
-INSERT INTO place_vtx(VERTEX, PLACE)
-SELECT v.OGC_FID, p.OGC_FID
-FROM vertices AS v, places AS p
-WHERE ST_Within( v.GEOMETRY, p.GEOMETRY ) 
-AND v.OGC_FID NOT IN (SELECT OGC_FID FROM left_vertices)
-AND v.ROWID IN (
-    SELECT ROWID FROM Spatialindex
-    WHERE f_table_name='vertices' AND search_frame=p.GEOMETRY)
-;
-
-
 -- Add 'places' for all left vertices
 INSERT INTO places(GEOMETRY,END_VTX)
 SELECT ST_Buffer(v.GEOMETRY, 1), v.OGC_FID
@@ -96,6 +71,7 @@ WHERE OGC_FID IN (SELECT e.OGC_FID
 ;
 
 -- Compute place's degree
+-- Degrees are counted from edge end places: loops are counted twice
 
 -- Create temporary table
 CREATE TABLE IF NOT EXISTS place_degree(ID integer, VALUE integer);
@@ -104,29 +80,18 @@ CREATE INDEX IF NOT EXISTS place_degree_idx ON place_degree(ID);
 DELETE FROM place_degree;
 
 INSERT INTO place_degree(ID,VALUE) 
-    SELECT pl.OGC_FID, Count(pl.OGC_FID) FROM place_edges AS pe, places AS pl 
-        WHERE pl.OGC_FID=pe.START_PL OR pl.OGC_FID=pe.END_PL
-        GROUP BY pl.OGC_FID
+    SELECT PL, Count(1) FROM (
+        SELECT START_PL AS PL FROM place_edges
+        UNION ALL
+        SELECT END_PL AS PL FROM place_edges
+    )
+    WHERE PL IS NOT NULL
+    GROUP BY PL
 ;
 
-UPDATE places SET DEGREE = (SELECT VALUE FROM place_degree WHERE place_degree.ID=places.OGC_FID)
-WHERE OGC_FID IN (SELECT ID FROM place_degree)
+UPDATE places SET DEGREE = COALESCE((SELECT VALUE FROM place_degree WHERE place_degree.ID=places.OGC_FID), 0)
 ;
 
--- Add one for each loop
-DELETE FROM place_degree;
-
-INSERT INTO place_degree(ID,VALUE) 
-    SELECT pl.OGC_FID, Count(pl.OGC_FID) FROM place_edges AS pe, places AS pl 
-        WHERE pl.OGC_FID=pe.START_PL AND pl.OGC_FID=pe.END_PL
-        GROUP BY pl.OGC_FID;
- 
-UPDATE places SET DEGREE = 
-    places.DEGREE + (SELECT VALUE FROM place_degree WHERE place_degree.ID=places.OGC_FID) 
-WHERE OGC_FID IN (SELECT ID FROM place_degree)
-;
-
-
 -- Clean up
 DROP INDEX place_degree_idx;
 DROP TABLE place_degree;
@@ -135,137 +100,3 @@ DROP TABLE place_degree;
 
 DELETE FROM places WHERE DEGREE=0
 ;
-
--- Mark invalid geometries
--- Invalid geometries are geometries that crosses start or end places
--- multiple times - this may happends with places wich are not convex 
--- such as digitalized places
-
-UPDATE place_edges SET
-STATUS = (
-    SELECT Min(t.status) FROM (
-        SELECT ST_NumGeometries(ST_Difference(place_edges.GEOMETRY, p.GEOMETRY))=1
-        AS status
-        FROM places as p
-        WHERE (p.OGC_FID=place_edges.START_PL OR p.OGC_FID=place_edges.END_PL)
-            AND place_edges.ROWID IN (
-            SELECT ROWID FROM Spatialindex
-            WHERE f_table_name='place_edges' AND search_frame=p.GEOMETRY)
-) AS t);
-
--- Update geometries
-
--- Cut geometry at start 
-
-UPDATE place_edges SET
-GEOMETRY = 
-(
-    SELECT CASE WHEN p.DEGREE>1 THEN ST_Difference(place_edges.GEOMETRY, p.GEOMETRY)
-           ELSE place_edges.GEOMETRY
-           END
-    FROM places AS p 
-    WHERE p.OGC_FID=place_edges.START_PL
-    AND place_edges.ROWID IN (
-        SELECT ROWID FROM Spatialindex
-        WHERE f_table_name='place_edges' AND search_frame=p.GEOMETRY)
-) WHERE STATUS=1
-;
-
--- Cut geometry at end
--- Exclude loop because they have already been handled in the previous statement
-
-UPDATE place_edges SET
-GEOMETRY = 
-(
-    SELECT CASE WHEN (p.DEGREE>1 AND place_edges.END_PL<>place_edges.START_PL)
-         THEN ST_Difference(place_edges.GEOMETRY, p.GEOMETRY)
-         ELSE place_edges.GEOMETRY
-         END
-  FROM places AS p 
-  WHERE p.OGC_FID=place_edges.END_PL
-  AND place_edges.ROWID IN (
-      SELECT ROWID FROM Spatialindex
-      WHERE f_table_name='place_edges' AND search_frame=p.GEOMETRY)
-) WHERE STATUS=1
-;
-
--- Handle invalid geometries
-
-UPDATE place_edges SET
-GEOMETRY = (
-  SELECT CASE WHEN ST_NumGeometries(geom)>1 THEN  ST_GeometryN(geom, ST_NumGeometries(geom))
-         ELSE geom
-         END
-  FROM (
-    SELECT CASE WHEN p.DEGREE>1 THEN ST_Difference(place_edges.GEOMETRY, p.GEOMETRY)
-           ELSE place_edges.GEOMETRY
-           END
-    AS geom
-    FROM places AS p
-    WHERE p.OGC_FID=place_edges.START_PL
-    AND place_edges.ROWID IN (
-          SELECT ROWID FROM Spatialindex
-          WHERE f_table_name='place_edges' AND search_frame=p.GEOMETRY)
-  )
-) WHERE STATUS=0
-;
-
-UPDATE place_edges SET
-GEOMETRY = (
-  SELECT CASE WHEN ST_NumGeometries(geom)>1 THEN ST_GeometryN(geom, 1)
-         ELSE geom
-         END
-  FROM (
-    SELECT CASE WHEN p.DEGREE>1 THEN ST_Difference(place_edges.GEOMETRY, p.GEOMETRY)
-           ELSE place_edges.GEOMETRY
-           END
-    AS geom
-    FROM places AS p
-    WHERE p.OGC_FID=place_edges.END_PL
-    AND place_edges.ROWID IN (
-        SELECT ROWID FROM Spatialindex
-        WHERE f_table_name='place_edges' AND search_frame=p.GEOMETRY)
-  )
-) WHERE STATUS=0
-;
-
--- In some cases, convex hull overlaps non-connected places
--- This leads in situation where place edges geometries are null when 
--- computed from differences from places geometries
--- In those case restore the original edge geometry
--- We mark those edges with a special status code  
-
-UPDATE place_edges SET
-GEOMETRY = (SELECT e.GEOMETRY FROM edges AS e WHERE place_edges.OGC_FID=e.OGC_FID),
-STATUS   = 2
-WHERE GEOMETRY IS NULL
-;
-
--- Update place_edges degree
-
-UPDATE place_edges
-SET DEGREE =
-        (SELECT DEGREE FROM places WHERE places.OGC_FID = place_edges.START_PL)
-       +(SELECT DEGREE FROM places WHERE places.OGC_FID = place_edges.END_PL)
-       - 2
-    WHERE place_edges.START_PL != place_edges.END_PL
-;
-
-UPDATE place_edges
-SET DEGREE =
-        (SELECT DEGREE FROM places WHERE places.OGC_FID = place_edges.START_PL)
-       - 2
-    WHERE place_edges.START_VTX == place_edges.END_VTX
-;
-
--- Update place_edges length
-
-UPDATE place_edges SET LENGTH = (SELECT ST_Length(place_edges.GEOMETRY))
-;
-
-
--- Clean up
-VACUUM
-;
-
-
@@ -1,10 +1,12 @@
 # -*- encoding=utf-8 -*-
 
+import os
 import sys
 import logging
+import numpy as np
 
 from .errors import BuilderError
-from .sql import SQL
+from .sql import SQL, attr_table, table_exists, create_database, connect_database
 
 class Sanitizer(object):
     """ Helper for sanitizing geometries to a valid topological
@@ -17,6 +19,7 @@ class Sanitizer(object):
     def __init__(self, conn, input_table):
         self._table  = input_table
         self._conn   = conn
+        self._resume = False
 
     @property
     def work_table(self):
@@ -25,7 +28,8 @@ class Sanitizer(object):
         return "sanitized"
 
 
-    def sanitize(self, snap_distance, min_edge_length, attribute=None):
+    def sanitize(self, snap_distance, min_edge_length, attribute=None, in_memory_cut=False,
+                 grid_snap=False, tile_size=None, tile_halo=None, workers=1, resume=False):
         """ Sanitize input data
 
             The method will compute the following:
@@ -35,12 +39,28 @@ class Sanitizer(object):
                 - Resolve intersection
                 - Remove small edges
 
+            Each stage is run in its own transaction and records a checkpoint
+            in the table 'sanitizer_checkpoints' on completion.
+
            :param snap_distance: Snap minimum distance
            :param min_edge_length: Minimum length for small edges
            :param attribute: Attribute to import from original data
+           :param in_memory_cut: Cut lines at crossing points in memory
+           :param grid_snap: Snap vertices with a hash grid instead of spatialite Snap()
+           :param tile_size: If set, snapping and intersections are computed by tiles
+                             of the given size (see resolve_intersections_by_tiles),
+                             this cannot be used with 'attribute' 
+           :param tile_halo: The overlap between tiles, default to the largest line extent
+                             plus twice the snap distance (see sanitize_tiles)
+           :param workers: The number of worker processes for computing tiles
+           :param resume: Skip stages completed by a previous run with the same parameters
         """
         if snap_distance <= 0:
             raise BuilderError("Invalid snap distance {}".format(snap_distance))
+        if tile_size and attribute:
+            # Tiles are snapped in their own database: lines are no longer 
+            # covered by input features for importing the attribute
+            raise BuilderError("Attribute {} cannot be imported when sanitizing by tiles".format(attribute))
              
 
         logging.info(("Sanitizer: snap_distance={}"
@@ -48,14 +68,79 @@ class Sanitizer(object):
                                                                     min_edge_length,
                                                                     attribute))
         cur = self._conn.cursor()
-        self.delete_unconnected_features(cur)
-        self.snap_geometries(cur, snap_distance)
-        self.resolve_intersections(cur, min_edge_length, attribute)
+
+        params = _hash_parameters(snap_distance=snap_distance, min_edge_length=min_edge_length,
+                                  attribute=attribute, in_memory_cut=in_memory_cut,
+                                  grid_snap=grid_snap, tile_size=tile_size, tile_halo=tile_halo)
+        self._init_checkpoints(cur, params, resume)
+        self._resume = resume
+
+        stages = [('delete_unconnected_features', self.delete_unconnected_features, ())]
+        if tile_size:
+            stages.append(('sanitize_tiles', self.sanitize_tiles, 
+                           (snap_distance, tile_size, tile_halo, workers, in_memory_cut, grid_snap)))
+        else:
+            stages.append(('snap_geometries', self.snap_geometries, (snap_distance, grid_snap)))
+            stages.extend(self._cut_stages(in_memory_cut))
+        stages.extend(self._resolve_stages(min_edge_length, attribute))
+
+        for name, stage, args in stages:
+            self._run_stage(cur, name, params, stage, *args)
+
+        cur.execute("VACUUM")
 
         self.fix_bug21(cur);
 
         self._conn.commit()
 
+    def _init_checkpoints(self, cur, params, resume):
+        """ Create the checkpoints table
+
+            When resuming, check that completed stages have been run with the same
+            parameters and that the input data has not changed since the last one.
+            Otherwise checkpoints from previous runs are discarded.
+        """
+        cur.execute(SQL("""CREATE TABLE IF NOT EXISTS sanitizer_checkpoints(
+            STAGE text PRIMARY KEY,
+            PARAMS text,
+            ROWCOUNT integer)"""))
+        if not resume:
+            cur.execute(SQL("DELETE FROM sanitizer_checkpoints"))
+            return
+
+        rows = cur.execute(SQL("SELECT STAGE, PARAMS, ROWCOUNT FROM sanitizer_checkpoints ORDER BY ROWID")).fetchall()
+        for stage, stage_params, _ in rows:
+            if stage_params != params:
+                raise BuilderError("Cannot resume sanitizer: stage '{}' was completed with different parameters".format(stage))
+        if rows:
+            [count] = cur.execute(SQL("SELECT Count(1) FROM {input_table}", input_table=self._table)).fetchone()
+            if count != rows[-1][2]:
+                raise BuilderError("Cannot resume sanitizer: table {} has changed since stage '{}'".format(
+                                   self._table, rows[-1][0]))
+            logging.info("Sanitizer: resuming after stage '{}'".format(rows[-1][0]))
+
+    def _run_stage(self, cur, name, params, stage, *args):
+        """ Run a sanitizer stage in a transaction and record its checkpoint
+
+            The stage is skipped if a checkpoint exists for it.
+        """
+        [done] = cur.execute(SQL("SELECT Count(1) FROM sanitizer_checkpoints WHERE STAGE='{stage}'",
+                                 stage=name)).fetchone()
+        if done:
+            logging.info("Sanitizer: skipping completed stage '{}'".format(name))
+            return
+
+        cur.execute("BEGIN")
+        try:
+            stage(cur, *args)
+            [count] = cur.execute(SQL("SELECT Count(1) FROM {input_table}", input_table=self._table)).fetchone()
+            cur.execute(SQL("INSERT INTO sanitizer_checkpoints(STAGE, PARAMS, ROWCOUNT) VALUES (?,?,?)"),
+                        (name, params, count))
+            cur.execute("COMMIT")
+        except:
+            cur.execute("ROLLBACK")
+            raise
+
     def fix_bug21( self, cur ):
         # Fix https://projects.3liz.org/clients/morpheo/issues/21
         cur.execute(SQL("SELECT Count(OGC_FID) from {table} WHERE GEOMETRY IS NULL", table=self.work_table))
@@ -80,35 +165,293 @@ class Sanitizer(object):
                 )
                 """,input_table=self._table))
 
-    def snap_geometries(self, cur, snap_distance):
+    def snap_geometries(self, cur, snap_distance, grid_snap=False):
         """ Snap close geometries 
 
             :param snap_distance: minimum snap distance
+            :param grid_snap: If True, use snap_vertices() instead of 
+                              spatialite Snap()
         """
-        logging.info("Sanitizer: Snapping geometries")
-        cur.execute(SQL("""UPDATE {input_table}
-            SET GEOMETRY = Snap({input_table}.GEOMETRY,
-                (
-                SELECT Collect(o.GEOMETRY) FROM {input_table} AS o
-                WHERE o.ROWID IN (
-                      SELECT ROWID FROM SpatialIndex
-                      WHERE f_table_name='{input_table}' AND search_frame=Buffer({input_table}.GEOMETRY, {snap_distance}))
-                AND o.OGC_FID != {input_table}.OGC_FID
-                )
-                , {snap_distance})
-            """, snap_distance=snap_distance, input_table=self._table))
+        from time import time
 
+        start = time()
+        if grid_snap:
+            self.snap_vertices(cur, snap_distance)
+        else:
+            logging.info("Sanitizer: Snapping geometries")
+            cur.execute(SQL("""UPDATE {input_table}
+                SET GEOMETRY = Snap({input_table}.GEOMETRY,
+                    (
+                    SELECT Collect(o.GEOMETRY) FROM {input_table} AS o
+                    WHERE o.ROWID IN (
+                          SELECT ROWID FROM SpatialIndex
+                          WHERE f_table_name='{input_table}' AND search_frame=Buffer({input_table}.GEOMETRY, {snap_distance}))
+                    AND o.OGC_FID != {input_table}.OGC_FID
+                    )
+                    , {snap_distance})
+                """, snap_distance=snap_distance, input_table=self._table))
+
+        logging.info("Sanitizer: snapping done in {:.3f} s".format(time()-start))
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            # Report figures for comparing snapping methods
+            [nodes] = cur.execute(SQL("""SELECT Count(1) FROM (
+                SELECT StartPoint(GEOMETRY) FROM {input_table}
+                UNION
+                SELECT EndPoint(GEOMETRY) FROM {input_table})""", input_table=self._table)).fetchone()
+            logging.debug("Sanitizer: {} distinct end points after snapping".format(nodes))
+
+    def snap_vertices(self, cur, snap_distance):
+        """ Snap close vertices 
+
+            Vertices from all geometries are assigned with a hash grid to
+            seed vertices closer than the snap distance (see geometry.cluster_seeds)
+            and moved to their seed, so that a vertex never moves by more than
+            the snap distance. Only modified geometries are written back.
+
+            Note that unlike spatialite Snap(), vertices are not snapped
+            to segments.
 
-    def resolve_intersections(self, cur, min_edge_length, attribute):
+            :param snap_distance: minimum snap distance
+        """
+        from .geometry import parse_linestring, format_linestring, cluster_seeds
+
+        logging.info("Sanitizer: Snapping vertices")
+
+        [srid] = cur.execute(SQL("SELECT CAST(srid AS integer) FROM geometry_columns WHERE f_table_name='{input_table}'",
+                                 input_table=self._table)).fetchone()
+
+        features = [(fid, parse_linestring(wkt)) for fid, wkt in cur.execute(SQL(
+                    "SELECT OGC_FID, AsText(GEOMETRY) FROM {input_table} ORDER BY OGC_FID",
+                    input_table=self._table)).fetchall() if wkt is not None]
+        if not features:
+            return
+
+        coords  = np.concatenate([c for _,(_,c) in features])
+        owners  = np.concatenate([np.full(len(c), n) for n,(_,(_,c)) in enumerate(features)])
+        offsets = np.cumsum([0]+[len(c) for _,(_,c) in features])
+
+        seeds = cluster_seeds(coords, snap_distance, groups=owners)
+        snapped = coords.copy()
+        snapped[:,:2] = coords[seeds,:2]
+
+        updates = []
+        for n, (fid, (linetype, c)) in enumerate(features):
+            s = snapped[offsets[n]:offsets[n+1]]
+            if np.array_equal(s, c):
+                continue
+            # Remove repeated vertices
+            keep = np.concatenate(([True], np.any(s[1:,:2] != s[:-1,:2], axis=1)))
+            s = s[keep]
+            if len(s) < 2:
+                continue
+            updates.append((format_linestring(linetype, s), fid))
+
+        logging.info("Sanitizer: snapped {} geometries".format(len(updates)))
+        cur.executemany(SQL("UPDATE {input_table} SET GEOMETRY = GeomFromText(?, {srid}) WHERE OGC_FID = ?",
+                            input_table=self._table, srid=srid), updates)
+
+    def resolve_intersections(self, cur, min_edge_length, attribute, in_memory_cut=False):
         """ Resolve intersections
 
         """
-        self._1_find_overlapping_lines(cur)
-        self._2_find_crossing_points(cur)
-        self._3_cut_lines_at_nodes(cur)
-        self._4_merge_lines(cur)
-        self._5_remove_small_edges(cur, min_edge_length)
-        self._6_remove_unconnected_elements(cur, attribute)
+        for _, stage, args in self._cut_stages(in_memory_cut) + self._resolve_stages(min_edge_length, attribute):
+            stage(cur, *args)
+
+    def _cut_stages(self, in_memory_cut):
+        """ Stages computing lines cut at crossing points
+        """
+        return [('find_overlapping_lines', self._1_find_overlapping_lines, ()),
+                ('find_crossing_points', self._2_find_crossing_points, ()),
+                ('cut_lines_at_nodes', self._3_cut_lines_at_nodes, (in_memory_cut,))]
+
+    def _resolve_stages(self, min_edge_length, attribute):
+        """ Stages computing the graph from cut lines
+        """
+        return [('merge_lines', self._4_merge_lines, ()),
+                ('remove_small_edges', self._5_remove_small_edges, (min_edge_length,)),
+                ('remove_unconnected_elements', self._6_remove_unconnected_elements, (attribute,))]
+
+    def resolve_intersections_by_tiles(self, cur, snap_distance, min_edge_length, attribute,
+                                       tile_size, tile_halo=None, workers=1, in_memory_cut=False,
+                                       grid_snap=False):
+        """ Resolve intersections by tiles
+
+            See sanitize_tiles()
+        """
+        if attribute:
+            raise BuilderError("Attribute {} cannot be imported when sanitizing by tiles".format(attribute))
+        self.sanitize_tiles(cur, snap_distance, tile_size, tile_halo, workers, in_memory_cut, grid_snap)
+        for _, stage, args in self._resolve_stages(min_edge_length, attribute):
+            stage(cur, *args)
+
+    def sanitize_tiles(self, cur, snap_distance, tile_size, tile_halo=None, workers=1, 
+                       in_memory_cut=False, grid_snap=False):
+        """ Snap and cut lines by tiles
+
+            The input extent is split into tiles of size 'tile_size': features
+            intersecting a tile extended with a halo are snapped and cut at crossing 
+            points in a separate database, possibly in a separate process.
+
+            Results are stitched back by keeping for each tile only the lines 
+            whose middle point lies in the tile (without the halo), which removes
+            duplicated lines at seams, and by merging line end points closer
+            than the snap distance into the same crossing point.
+            
+            Lines merging, small edges and unconnected elements have then
+            to be resolved on the whole data. Input features are not snapped, 
+            so attributes cannot be imported from them afterwards.
+
+            All features snapped to or crossing a line kept in a tile must be
+            computed in this tile: the halo must be larger than the largest
+            extent of input lines plus twice the snap distance. This is the
+            default value, a smaller halo raises a BuilderError.
+        """
+        import shutil
+        import tempfile
+
+        [xmin, ymin, xmax, ymax, extent] = cur.execute(SQL("""
+            SELECT Min(MbrMinX(GEOMETRY)), Min(MbrMinY(GEOMETRY)), Max(MbrMaxX(GEOMETRY)), Max(MbrMaxY(GEOMETRY)),
+                   Max(Max(MbrMaxX(GEOMETRY)-MbrMinX(GEOMETRY), MbrMaxY(GEOMETRY)-MbrMinY(GEOMETRY)))
+            FROM {input_table}""", input_table=self._table)).fetchone()
+        if xmin is None:
+            raise BuilderError("No elements in table {}: check your input is valid !".format(self._table))
+
+        min_halo = extent + 2*snap_distance
+        if tile_halo is None:
+            tile_halo = min_halo
+        elif tile_halo < min_halo:
+            raise BuilderError("Tile halo {} is smaller than the largest line extent plus twice "
+                               "the snap distance ({})".format(tile_halo, min_halo))
+
+        [srid, dim] = cur.execute(SQL("""SELECT CAST(srid AS integer), coord_dimension
+            FROM geometry_columns WHERE f_table_name='{input_table}'""", 
+            input_table=self._table)).fetchone()
+        dbname = next(r[2] for r in cur.execute("PRAGMA database_list").fetchall() if r[1]=='main')
+
+        nx = int((xmax-xmin)/tile_size)+1
+        ny = int((ymax-ymin)/tile_size)+1
+        tiles = [(xmin+i*tile_size, ymin+j*tile_size, xmin+(i+1)*tile_size, ymin+(j+1)*tile_size)
+                 for i in range(nx) for j in range(ny)]
+
+        logging.info("Sanitizer: processing {} tiles (tile size={}, halo={}, workers={})".format(
+                     len(tiles), tile_size, tile_halo, workers))
+
+        workdir = tempfile.mkdtemp(prefix='morpheo_tiles_')
+        try:
+            tasks = [(dbname, self._table, os.path.join(workdir,'tile_%d.sqlite' % n), bbox, tile_halo,
+                      srid, dim, snap_distance, in_memory_cut, grid_snap) for n, bbox in enumerate(tiles)]
+            if workers > 1:
+                from multiprocessing import Pool
+                pool = Pool(workers)
+                try:
+                    results = pool.map(_sanitize_tile, tasks)
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                results = [_sanitize_tile(task) for task in tasks]
+
+            self._stitch_tiles(cur, [r for r in results if r is not None], snap_distance)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    def _stitch_tiles(self, cur, tiles, snap_distance):
+        """ Collect split lines computed in tiles
+
+            :param tiles: list of (tile database, tile bbox)
+            :param snap_distance: the distance for merging line end points
+        """
+        logging.info("Sanitizer: Resolving intersections: stitching tiles")
+
+        # Create tables for the remaining stages
+        self._create_indexed_table(cur, 'overlaping_lines', 'MULTILINESTRING')
+        self._create_indexed_table(cur, 'crossings', 'MULTIPOINT')
+        self._create_indexed_table(cur, 'crossing_points', 'POINT')
+        self._create_split_lines(cur)
+        self._collect_tiles(cur, tiles)
+        self._connect_split_lines(cur, snap_distance)
+
+    def _collect_tiles(self, cur, tiles):
+        """ Copy into split_lines the lines of each tile whose middle point
+            lies in the tile bbox
+
+            :param tiles: list of (tile database, tile bbox)
+        """
+        # Tile databases are read from their own connection since
+        # databases cannot be attached within a transaction
+        for tiledb, (x0, y0, x1, y1) in tiles:
+            tile = connect_database(tiledb)
+            try:
+                rows = tile.execute(SQL("""SELECT GEOMETRY FROM (
+                        SELECT GEOMETRY, Line_Interpolate_Point(GEOMETRY, 0.5) AS m
+                        FROM split_lines)
+                    WHERE X(m) >= {x0} AND X(m) < {x1} AND Y(m) >= {y0} AND Y(m) < {y1}
+                    """, x0=x0, y0=y0, x1=x1, y1=y1)).fetchall()
+            finally:
+                tile.close()
+            cur.executemany(SQL("INSERT INTO split_lines(GEOMETRY) VALUES (?)"), rows)
+
+    def _connect_split_lines(self, cur, snap_distance):
+        """ Rebuild crossing points from the end points of split lines
+
+            Lines computed in different tiles may not end at the exact
+            same location at seams: end points closer than the snap distance
+            are merged into the same crossing point and moved to its location.
+        """
+        from .angles import get_index_table
+        from .geometry import parse_linestring, format_linestring, cluster_points
+
+        [srid] = cur.execute(SQL("SELECT srid FROM geometry_columns WHERE f_table_name='crossing_points'")).fetchone()
+
+        lines = [(fid,)+parse_linestring(wkt) for fid, wkt in cur.execute(SQL(
+                 "SELECT OGC_FID, AsText(GEOMETRY) FROM split_lines")).fetchall() if wkt is not None]
+        if lines:
+            # Start point of line k at index 2k, end point at index 2k+1
+            ends = np.array([c for _, _, coords in lines for c in (coords[0], coords[-1])])
+            part = cluster_points(ends[:,:2], snap_distance)
+            index = get_index_table(part)
+
+            pointtype = lines[0][1].replace('LINESTRING','POINT')
+            points = [(int(index[k])+1, format_linestring(pointtype, [ends[k]]))
+                      for k in np.nonzero(part == np.arange(len(part)))[0]]
+            cur.executemany(SQL("INSERT INTO crossing_points(OGC_FID, GEOMETRY) SELECT ?, GeomFromText(?, {srid})",
+                                srid=srid), points)
+
+            updates = []
+            for k, (fid, linetype, coords) in enumerate(lines):
+                start, end = part[2*k], part[2*k+1]
+                wkt = None
+                if start != 2*k or end != 2*k+1:
+                    coords[0], coords[-1] = ends[start], ends[end]
+                    wkt = format_linestring(linetype, coords)
+                updates.append((wkt, int(index[start])+1, int(index[end])+1, fid))
+
+            cur.executemany(SQL("""UPDATE split_lines
+                SET GEOMETRY = COALESCE(GeomFromText(?, {srid}), GEOMETRY), START_VTX = ?, END_VTX = ?
+                WHERE OGC_FID = ?""", srid=srid), updates)
+
+        self._compute_vertex_degree(cur)
+
+    def _compute_intersections(self, cur):
+        """ Compute intersections between input geometries
+
+            Intersections are computed once for each pair of intersecting
+            geometries and stored in the 'line_intersections' table, from which
+            overlapping lines and crossing points are then selected by 
+            geometry type.
+        """
+        logging.info("Sanitizer: Resolving intersections: computing intersections")
+        cur.execute(SQL("DROP TABLE IF EXISTS line_intersections"))
+        cur.execute(SQL("CREATE TABLE line_intersections(FID1 integer, FID2 integer, GEOMETRY blob)"))
+        cur.execute(SQL("""INSERT INTO line_intersections(FID1, FID2, GEOMETRY)
+            SELECT w1.OGC_FID, w2.OGC_FID, Intersection(w1.GEOMETRY, w2.GEOMETRY)
+            FROM {input_table} AS w1, {input_table} AS w2
+            WHERE w1.OGC_FID < w2.OGC_FID
+            AND Intersects(w1.GEOMETRY, w2.GEOMETRY)
+            AND  w1.ROWID IN (
+                  SELECT ROWID FROM SpatialIndex
+                  WHERE f_table_name='{input_table}' AND search_frame=w2.GEOMETRY)
+            """,input_table=self._table))
 
     def _1_find_overlapping_lines(self, cur):
         """ Find overlapping lines
@@ -118,18 +461,14 @@ class Sanitizer(object):
         """
         logging.info("Sanitizer: Resolving intersections: find overlapping lines")
 
+        self._compute_intersections(cur)
+
         self._create_indexed_table(cur, 'overlaping_lines', 'MULTILINESTRING')
         cur.execute(SQL("""INSERT INTO overlaping_lines(GEOMETRY)
-            SELECT CastToMulti(Intersection(w1.GEOMETRY, w2.GEOMETRY))
-            FROM {input_table} AS w1, {input_table} AS w2
-            WHERE w1.OGC_FID != w2.OGC_FID
-            AND Intersects(w1.GEOMETRY, w2.GEOMETRY)
-            AND  w1.ROWID IN (
-                  SELECT ROWID FROM SpatialIndex
-                  WHERE f_table_name='{input_table}' AND search_frame=w2.GEOMETRY)
-            AND GeometryType(Intersection(w1.GEOMETRY, w2.GEOMETRY))
+            SELECT CastToMulti(GEOMETRY) FROM line_intersections
+            WHERE GeometryType(GEOMETRY)
                 IN ('LINESTRING', 'MULTILINESTRING', 'LINESTRING Z', 'MULTILINESTRING Z')
-            """,input_table=self._table))
+            """))
 
         cur.execute(SQL("SELECT COUNT(1) FROM overlaping_lines WHERE NumGeometries(GEOMETRY)>1"))
         [count] = cur.fetchone()
@@ -169,18 +508,15 @@ class Sanitizer(object):
         # Adding crossings, skipping bridge
         logging.info("Sanitizer: Resolving intersections: adding crossing points")
         cur.execute(SQL("""INSERT INTO crossings(GEOMETRY)
-            SELECT CastToMulti(Intersection(w1.GEOMETRY, w2.GEOMETRY))
-            FROM {input_table} AS w1, {input_table} AS w2
-            WHERE w1.OGC_FID != w2.OGC_FID
-            AND Intersects(w1.GEOMETRY, w2.GEOMETRY)
-            AND  w1.ROWID IN (
-                  SELECT ROWID FROM SpatialIndex
-                  WHERE f_table_name='{input_table}' AND search_frame=w2.GEOMETRY)
-            AND GeometryType(Intersection(w1.GEOMETRY, w2.GEOMETRY))
+            SELECT CastToMulti(i.GEOMETRY)
+            FROM line_intersections AS i, {input_table} AS w1
+            WHERE w1.OGC_FID = i.FID1
+            AND GeometryType(i.GEOMETRY)
                 IN ('POINT', 'MULTIPOINT', 'POINT Z', 'MULTIPOINT Z')""" +
            ("""AND ABS(0.5*(Z(StartPoint(w1.GEOMETRY))+Z(EndPoint(w1.GEOMETRY)))
                    -0.5*(Z(StartPoint(w1.GEOMETRY))+Z(EndPoint(w1.GEOMETRY)))) < 3""" if dim == 'XYZ' else ""),
            input_table=self._table))
+        cur.execute(SQL("DROP TABLE line_intersections"))
 
         # Sanity check
         cur.execute(SQL("SELECT COUNT(1) FROM overlaping_lines WHERE NumGeometries(GEOMETRY)>1"))
@@ -215,18 +551,73 @@ class Sanitizer(object):
             WHERE counter.VALUE <= NumGeometries(crossings.GEOMETRY)
             """))
 
+        self._create_split_lines(cur)
+
+    def _create_split_lines(self, cur):
+        """ Create the table holding lines cut at crossing points
+        """
         self._create_indexed_table(cur, 'split_lines', 'LINESTRING')
         cur.execute(SQL("ALTER TABLE split_lines ADD COLUMN START_VTX integer REFERENCES crossing_points(OGC_FID)"))
         cur.execute(SQL("ALTER TABLE split_lines ADD COLUMN END_VTX   integer REFERENCES crossing_points(OGC_FID)"))
         cur.execute(SQL("CREATE INDEX split_lines_start_vtx_idx ON split_lines(START_VTX)"))
         cur.execute(SQL("CREATE INDEX split_lines_end_vtx_idx   ON split_lines(END_VTX)"))
 
-
-    def _3_cut_lines_at_nodes(self, cur):
+    def _3_cut_lines_at_nodes(self, cur, in_memory=False):
         """ Cut lines 
 
+            :param in_memory: If True, locate crossing points along lines in memory
+                              instead of issuing queries for each line
         """
         logging.info("Sanitizer: Resolving intersections: cut lines")
+        if in_memory:
+            splits = self._locate_splits_in_memory(cur)
+        else:
+            splits = self._locate_splits(cur)
+
+        # Split lines
+        cur.executemany(SQL("""
+            INSERT INTO split_lines(GEOMETRY, START_VTX, END_VTX)
+            SELECT Line_Substring(o.GEOMETRY, ?, ?), ?, ?
+            FROM {input_table} AS o
+            WHERE o.OGC_FID = ?""",input_table=self._table), splits)
+
+        # Remove duplicated lines
+        deleted_dupes = [(fid,) for fid in self._find_duplicated_lines(cur)]
+        cur.executemany(SQL("DELETE FROM split_lines WHERE OGC_FID = ?"), deleted_dupes)
+        logging.info("Sanitizer: Deleted {} duplicates in split_lines".format(len(deleted_dupes)))
+
+        # Sanity check ?
+        cur.execute(SQL("SELECT COUNT(1) FROM split_lines WHERE END_VTX IS NULL OR START_VTX IS NULL"))
+        [bug] = cur.fetchone()
+        if bug: 
+            raise BuilderError("Graph build error: NULL vertices in 'cut_lines_at_nodes'") 
+
+        self._compute_vertex_degree(cur)
+
+    def _compute_vertex_degree(self, cur):
+        """ Compute the degree of crossing points
+        """
+        cur.execute(SQL("ALTER TABLE crossing_points ADD COLUMN DEGREE integer"))
+        # Count end points of lines: loops are counted twice
+        cur.execute(SQL("CREATE TEMP TABLE vertex_degree(ID integer PRIMARY KEY, VALUE integer)"))
+        cur.execute(SQL("""
+            INSERT INTO vertex_degree(ID, VALUE)
+            SELECT VTX, Count(1) FROM (
+                SELECT START_VTX AS VTX FROM split_lines
+                UNION ALL
+                SELECT END_VTX AS VTX FROM split_lines)
+            GROUP BY VTX"""))
+        cur.execute(SQL("""
+            UPDATE crossing_points
+            SET DEGREE = COALESCE((SELECT VALUE FROM vertex_degree WHERE ID=crossing_points.OGC_FID), 0)
+            """))
+        cur.execute(SQL("DROP TABLE vertex_degree"))
+
+    def _locate_splits(self, cur):
+        """ Compute line segments between crossing points
+
+            :return: a list of (start location, end location, start vertex, end vertex, line id)
+        """
         # since LinesCutAtNodes in not available in pyspatialite
         # we have to cut lines one segment at a time
         cur.execute(SQL("SELECT ROWID, OGC_FID FROM {input_table} ORDER BY OGC_FID",input_table=self._table))
@@ -260,188 +651,186 @@ class Sanitizer(object):
             [isLoop] = cur.fetchone()
             if isLoop:
                 splits.append((locations[-1][0], 1, locations[-1][1], locations[0][1], line_id))
+        return splits
 
-        # Split lines
-        cur.executemany(SQL("""
-            INSERT INTO split_lines(GEOMETRY, START_VTX, END_VTX)
-            SELECT Line_Substring(o.GEOMETRY, ?, ?), ?, ?
-            FROM {input_table} AS o
-            WHERE o.OGC_FID = ?""",input_table=self._table), splits)
+    def _locate_splits_in_memory(self, cur, tolerance=1e-2):
+        """ Compute line segments between crossing points in memory
 
-        # Remove duplicated lines
-        cur.execute(SQL("""SELECT l1.OGC_FID, l2.OGC_FID
-            FROM split_lines AS l1, split_lines AS l2
-            WHERE Equals(l1.GEOMETRY, l2.GEOMETRY)
-            AND l1.OGC_FID < l2.OGC_FID
-            AND l1.ROWID IN (
-                      SELECT ROWID FROM SpatialIndex 
-                      WHERE f_table_name='split_lines' AND search_frame=l2.GEOMETRY)
-            ORDER BY l1.OGC_FID
-            """))
-        equivalent = []
-        for [l1_id, l2_id] in cur.fetchall():
-            found = False
-            for eq in equivalent:
-                if l1_id in eq:
-                    eq.add(l2_id)
-                    found = True
-                if l2_id in eq:
-                    eq.add(l1_id)
-                    found = True
-            if not found:
-                equivalent.append(set([l1_id, l2_id]))
-        # merge equivalent
-        for i in range(len(equivalent)):
-            for j in range(len(equivalent), i+1):
-                if equivalent[i].intersection(equivalent[j]):
-                    equivalent[i] = equivalent[i].union(equivalent[j])
-                    equivalent[j] = set()
-
-        deleted_dupes = []
-        for eq in equivalent:
-            if len(eq):
-                for id_ in list(eq)[1:]:
-                    deleted_dupes.append((id_,))
-        cur.executemany(SQL("DELETE FROM split_lines WHERE OGC_FID = ?"), deleted_dupes)
-        logging.info("Sanitizer: Deleted {} duplicates in split_lines".format(len(deleted_dupes)))
+            Lines and crossing points are read at once, crossing points
+            are indexed in a grid and located along each line with numpy.
+            This gives the same results as _locate_splits() without
+            issuing queries for each line.
 
-        # Sanity check ?
-        cur.execute(SQL("SELECT COUNT(1) FROM split_lines WHERE END_VTX IS NULL OR START_VTX IS NULL"))
-        [bug] = cur.fetchone()
-        if bug: 
-            raise BuilderError("Graph build error: NULL vertices in 'cut_lines_at_nodes'") 
+            :return: a list of (start location, end location, start vertex, end vertex, line id)
+        """
+        from .geometry import parse_linestring, locate_points, GridIndex
 
-        cur.execute(SQL("ALTER TABLE crossing_points ADD COLUMN DEGREE integer"))
-        cur.execute(SQL("""
-            UPDATE crossing_points
-            SET DEGREE = 
-            (
-                SELECT COUNT(1) 
-                FROM split_lines
-                WHERE split_lines.END_VTX = crossing_points.OGC_FID 
-                OR split_lines.START_VTX = crossing_points.OGC_FID
-            ) """))
+        lines = [(fid, parse_linestring(wkt)[1]) for fid, wkt in cur.execute(SQL(
+                 "SELECT OGC_FID, AsText(GEOMETRY) FROM {input_table} ORDER BY OGC_FID",
+                 input_table=self._table)).fetchall()]
+        rows = cur.execute(SQL("SELECT OGC_FID, X(GEOMETRY), Y(GEOMETRY) FROM crossing_points")).fetchall()
+        if not lines or not rows:
+            return []
 
-        cur.execute(SQL("""
-            UPDATE crossing_points
-            SET DEGREE = crossing_points.DEGREE + -- add one to the count for each loops
-            (
-                SELECT COUNT(1) 
-                FROM split_lines
-                WHERE split_lines.END_VTX = crossing_points.OGC_FID 
-                AND split_lines.START_VTX = crossing_points.OGC_FID
-            )"""))
+        pids   = np.array([r[0] for r in rows])
+        points = np.array([(r[1],r[2]) for r in rows])
 
+        # Use the mean extent of lines as grid cell size
+        extent = np.mean([np.ptp(c[:,:2],axis=0).max() for _,c in lines])
+        index  = GridIndex(max(extent, tolerance))
+        for i,(x,y) in enumerate(points):
+            index.insert(i, x, y, x, y)
+
+        logging.info("Sanitizer: locating crossing points on {} lines".format(len(lines)))
+        splits = []
+        for line_id, coords in lines:
+            (xmin, ymin), (xmax, ymax) = coords[:,:2].min(axis=0), coords[:,:2].max(axis=0)
+            candidates = np.array(sorted(index.query(xmin-tolerance, ymin-tolerance,
+                                                     xmax+tolerance, ymax+tolerance)), dtype=int)
+            if len(candidates) == 0:
+                continue
+            loc, dist = locate_points(coords, points[candidates])
+            keep = dist <= tolerance
+            loc, vtx = loc[keep], pids[candidates[keep]]
+            order = np.argsort(loc, kind='stable')
+            locations = [(float(loc[k]), int(vtx[k])) for k in order]
+
+            # Store segments
+            for i in range(1,len(locations)):
+                splits.append((locations[i-1][0], locations[i][0], 
+                    locations[i-1][1], locations[i][1], line_id))
+
+            # Check if line is a loop and add segment closing loop
+            d = coords[-1,:2] - coords[0,:2]
+            if locations and np.sqrt((d*d).sum()) <= tolerance:
+                splits.append((locations[-1][0], 1, locations[-1][1], locations[0][1], line_id))
+        return splits
+
+    def _find_duplicated_lines(self, cur):
+        """ Find duplicated lines in split_lines
+
+            Lines are grouped by a key built from their bounding box and
+            end points (see geometry.linestring_key), which is shared by all
+            equal lines. Lines of a group are then checked with Equals() against
+            the first line of each class of equal lines found so far.
+
+            :return: the list of fids of duplicates, the line with the lowest
+                     fid of each class is kept.
+        """
+        from .geometry import parse_linestring, linestring_key
+
+        groups = {}
+        for fid, wkt in cur.execute(SQL("SELECT OGC_FID, AsText(GEOMETRY) FROM split_lines ORDER BY OGC_FID")).fetchall():
+            if wkt is None:
+                continue
+            groups.setdefault(linestring_key(parse_linestring(wkt)[1]),[]).append(fid)
+
+        duplicates = []
+        for fids in groups.values():
+            classes = []
+            for fid in fids:
+                for first in classes:
+                    [equals] = cur.execute(SQL("""SELECT Equals(l1.GEOMETRY, l2.GEOMETRY)
+                        FROM split_lines AS l1, split_lines AS l2
+                        WHERE l1.OGC_FID = ? AND l2.OGC_FID = ?"""), (first, fid)).fetchone()
+                    if equals == 1:
+                        duplicates.append(fid)
+                        break
+                else:
+                    classes.append(fid)
+        return duplicates
 
     def _4_merge_lines(self, cur):
         """ join lines that are simply touching 
         
             since several segment can be joined, we need to do that in
-            python and not simply SQL
+            python and not simply SQL: chains of lines joined at nodes of
+            DEGREE=2 are computed from one read of split_lines and merged
+            geometries are built by concatenating coordinates.
         """
-        logging.info("Sanitizer: Resolving intersections: merge lines")
+        from .angles import create_partition, resolve, update
+        from .geometry import parse_linestring, format_linestring
 
-        def collect_lines():
-            # Merge all touching segments joined with nodes of DEGREE=2
-            from .angles import create_partition, update, resolve
-            [max_lines] = cur.execute("SELECT Max(OGC_FID) FROM split_lines").fetchone()      
-            if max_lines is None:
-                raise BuilderError("No elements in table split_lines: check your input is valid !") 
-            part = create_partition(max_lines+1) 
-            cur.execute(SQL("SELECT OGC_FID FROM crossing_points WHERE DEGREE = 2"))
-            for [pid] in cur.fetchall():
-                touching_lines = cur.execute(SQL("""
-                    SELECT OGC_FID FROM split_lines 
-                    WHERE {pid} IN (END_VTX, START_VTX)""",pid=pid)).fetchall()
-                try:
-                    [[l1],[l2]] = touching_lines
-                    resolve(part,l1,l2)
-                except Exception as e:
-                    logging.error("%s: crossing point: %s, split_lines: %s", e, pid, touching_lines)
-                    raise
-
-            update(part)
+        logging.info("Sanitizer: Resolving intersections: merge lines")
 
-            merges = [[] for i in range(len(part))]
-            for i in range(len(part)):
-                merges[part[i]].append(i)
-            return merges    
+        [max_lines] = cur.execute("SELECT Max(OGC_FID) FROM split_lines").fetchone()      
+        if max_lines is None:
+            raise BuilderError("No elements in table split_lines: check your input is valid !") 
+
+        lines = {}
+        touching_lines = {}
+        for [fid, start_vtx, end_vtx, wkt] in cur.execute(SQL(
+                "SELECT OGC_FID, START_VTX, END_VTX, AsText(GEOMETRY) FROM split_lines")).fetchall():
+            lines[fid] = (start_vtx, end_vtx, wkt)
+            touching_lines.setdefault(start_vtx,[]).append(fid)
+            touching_lines.setdefault(end_vtx,[]).append(fid)
+
+        # Merge all touching segments joined with nodes of DEGREE=2
+        nodes = set(pid for [pid] in cur.execute(SQL(
+                    "SELECT OGC_FID FROM crossing_points WHERE DEGREE = 2")).fetchall())
+        part = create_partition(max_lines+1) 
+        for pid in nodes:
+            try:
+                [l1, l2] = touching_lines[pid]
+                if l1 == l2:
+                    raise BuilderError("Isolated loop")
+                resolve(part,l1,l2)
+            except Exception as e:
+                logging.error("%s: crossing point: %s, split_lines: %s", e, pid, touching_lines.get(pid))
+                raise
+
+        update(part)
+
+        merges = {}
+        for fid in lines:
+            merges.setdefault(part[fid],[]).append(fid)
+
+        [srid] = cur.execute(SQL("SELECT srid FROM geometry_columns WHERE f_table_name='split_lines'")).fetchone()
+
+        def merge_chain( m ):
+            """ Walk the chain from a node which is not merged and
+                concatenate coordinates
+            """
+            ends = [v for fid in m for v in lines[fid][:2]]
+            start = next((v for v in ends if v not in nodes), None)
+            if start is None:
+                # The chain is a ring unconnected to the graph
+                return None
+            left = set(m)
+            vtx  = start
+            coords = []
+            linetype = None
+            while left:
+                fid = next(f for f in touching_lines[vtx] if f in left)
+                left.remove(fid)
+                start_vtx, end_vtx, wkt = lines[fid]
+                linetype, c = parse_linestring(wkt)
+                if start_vtx != vtx:
+                    c = c[::-1]
+                    vtx = start_vtx
+                else:
+                    vtx = end_vtx
+                coords.extend(c if not coords else c[1:])
+            return format_linestring(linetype, coords), start, vtx
+
+        merged  = []
+        deleted = []
+        for m in merges.values():
+            if len(m) < 2: continue
+            line = merge_chain(m)
+            if line is not None:
+                merged.append(line)
+            deleted.extend((fid,) for fid in m)
 
-        merges = collect_lines()
+        logging.info("Sanitizer: merging {} lines into {} lines".format(len(deleted), len(merged)))
 
         # Clean up all crossing points with degree=2
         cur.execute(SQL("DELETE FROM crossing_points WHERE DEGREE = 2"))
 
-        for m in merges:
-            if len(m) < 2: continue
-            cur.execute(SQL("""
-                INSERT INTO split_lines(GEOMETRY)
-                SELECT LineMerge(Collect(l.GEOMETRY)) AS geom
-                FROM split_lines AS l
-                WHERE l.OGC_FID IN ("""+','.join([str(i) for i in m])+")"))
-
-            # If the line segment form a ring, there is no guaranty that
-            # the merge endpoint is actually the one belonging to the graph
-            # so we have to deal with that case
-
-            cur.execute(SQL("SELECT MAX(OGC_FID), AsText(GEOMETRY) FROM split_lines"))
-            [lid, s] = cur.fetchone()
-            cur.execute(SQL("""SELECT COUNT(1) 
-                FROM split_lines WHERE OGC_FID = """+str(lid)+"""
-                AND PtDistWithin(StartPoint(GEOMETRY), EndPoint(GEOMETRY), 1e-2)"""))
-            [isLoop] = cur.fetchone()
-            if isLoop:
-                cur.execute(SQL("""SELECT Line_Locate_Point(l.GEOMETRY, p.GEOMETRY) 
-                    FROM split_lines AS l, crossing_points AS p
-                    WHERE l.OGC_FID = """+str(lid)+"""
-                    AND PtDistWithin(l.GEOMETRY, p.GEOMETRY, 1e-2)
-                    """))
-                alpha = cur.fetchone()
-                if not alpha: # no point found, the loop is unconnected, remove it
-                    cur.execute(SQL("DELETE FROM split_lines WHERE OGC_FID = "+str(lid)))
-                elif 0 < alpha[0] < 0.999999:
-                    # get the tow segments and invert their order
-                    cur.execute(SQL("""
-                        SELECT AsText(Line_Substring(GEOMETRY, 0,"""+str(alpha[0])+""")), 
-                               AsText(Line_Substring(GEOMETRY,"""+str(alpha[0])+""", 1)),
-                               SRID(GEOMETRY)
-                        FROM split_lines WHERE OGC_FID = """+str(lid)))
-                    [l1, l2, srid] = cur.fetchone()
-                    linetype = l1.split('(')[0]
-                    l1 = l1.split('(')[1].split(')')[0].split(',')
-                    l2 = l2.split('(')[1].split(')')[0].split(',')
-                    cur.execute(SQL("""
-                        UPDATE split_lines SET GEOMETRY = GeomFromText('"""
-                        +linetype+'('+','.join(l2)+','+','.join(l1[1:])+")', "+str(srid)+")"
-                        +" WHERE OGC_FID = "+str(lid)))
-
-            # remove joined lines 
-            cur.execute(SQL("""
-                DELETE FROM split_lines
-                WHERE OGC_FID IN ("""+','.join([str(i) for i in m])+")"))
-
-        # Set end vtx for merged lines
-        cur.execute(SQL("""
-            UPDATE split_lines
-            SET START_VTX =
-            (
-                SELECT v.OGC_FID FROM crossing_points AS v, split_lines AS l
-                WHERE PtDistWithin(StartPoint(l.GEOMETRY), v.GEOMETRY, 1e-2)
-                AND l.OGC_FID = split_lines.OGC_FID
-                AND v.ROWID IN (
-                      SELECT ROWID FROM SpatialIndex 
-                      WHERE f_table_name='crossing_points' AND search_frame=l.GEOMETRY)
-            ),
-            END_VTX = 
-            (
-                SELECT v.OGC_FID FROM crossing_points AS v, split_lines AS l
-                WHERE PtDistWithin(EndPoint(l.GEOMETRY), v.GEOMETRY, 1e-2)
-                AND l.OGC_FID = split_lines.OGC_FID
-                AND v.ROWID IN (
-                      SELECT ROWID FROM SpatialIndex 
-                      WHERE f_table_name='crossing_points' AND search_frame=l.GEOMETRY)
-            )
-            WHERE START_VTX IS NULL OR END_VTX IS NULL"""))
+        # remove joined lines and insert merged lines
+        cur.executemany(SQL("DELETE FROM split_lines WHERE OGC_FID = ?"), deleted)
+        cur.executemany(SQL("""INSERT INTO split_lines(GEOMETRY, START_VTX, END_VTX)
+            SELECT GeomFromText(?, {srid}), ?, ?""", srid=srid), merged)
 
         # Sanity check ?
         cur.execute(SQL("SELECT COUNT(1) FROM split_lines WHERE END_VTX IS NULL OR START_VTX IS NULL"))
@@ -454,91 +843,112 @@ class Sanitizer(object):
 
             All edges below min_edge_length will be removed an connected vertices
             will be merged at the centroid position of the removed geometry.
+
+            Vertices joined by small edges are grouped with a partition, so
+            that a chain of consecutive small edges collapses into a single
+            vertex located at the mean of the middle points of the removed edges.
+            End points of the lines connected to merged vertices are then 
+            moved to the new vertex.
+
+            Small edges touching a crossing point with a negative degree are
+            kept: these are vertices held fixed by incremental updates.
     
             :param min_edge_length: the minimun length for edges
         """
+        from .angles import create_partition, resolve_pairs
+        from .geometry import parse_linestring, format_linestring
+
         # remove small edges and merge extremities at centroid
         logging.info("Sanitizer: Resolving intersections: remove arcs smaller than {}".format(min_edge_length))
 
-        cur.execute(SQL("SELECT MAX(OGC_FID) FROM crossing_points"))
-        [max_fid] = cur.fetchone()
-        cur.execute(SQL("""SELECT OGC_FID, START_VTX, END_VTX 
+        cur.execute(SQL("""SELECT OGC_FID, START_VTX, END_VTX, AsText(Line_Interpolate_Point(GEOMETRY,0.5))
             FROM split_lines
-            WHERE GLength(GEOMETRY) < """+str(min_edge_length)))
-
-        for [ogc_fid, start_vtx, end_vtx] in cur.fetchall():
-            max_fid += 1
-            cur.execute(SQL("""INSERT INTO crossing_points(OGC_FID, GEOMETRY)
-                SELECT """+str(max_fid)+""", Line_Interpolate_Point(GEOMETRY,0.5)
-                FROM split_lines WHERE OGC_FID = """+str(ogc_fid)))
-
-            cur.execute(SQL("""UPDATE split_lines
-                SET GEOMETRY = Snap(GEOMETRY, 
-                    (SELECT v.GEOMETRY FROM crossing_points AS v 
-                    WHERE v.OGC_FID="""+str(max_fid)+"), "+str(1.1*min_edge_length/2)+")"
-                "WHERE START_VTX = "+str(start_vtx)+" "
-                "OR START_VTX = "+str(end_vtx)+" "
-                "OR END_VTX = "+str(start_vtx)+" "
-                "OR END_VTX = "+str(end_vtx)))
-
-            cur.execute(SQL("""UPDATE split_lines
-                SET START_VTX = """+str(max_fid)+"""
-                WHERE START_VTX = """+str(start_vtx)+"""
-                OR START_VTX = """+str(end_vtx)))
-
-            cur.execute(SQL("""UPDATE split_lines
-                SET END_VTX = """+str(max_fid)+"""
-                WHERE END_VTX = """+str(start_vtx)+"""
-                OR END_VTX = """+str(end_vtx)))
-
-            cur.execute(SQL("""DELETE FROM crossing_points
-                WHERE OGC_FID IN ("""+str(start_vtx)+", "+str(end_vtx)+")"))
-
-            cur.execute(SQL("""DELETE FROM split_lines
-                WHERE OGC_FID="""+str(ogc_fid)))
+            WHERE GLength(GEOMETRY) < {min_edge_length}
+            AND NOT EXISTS (
+                SELECT 1 FROM crossing_points
+                WHERE OGC_FID IN (split_lines.START_VTX, split_lines.END_VTX) AND DEGREE < 0)
+            """, min_edge_length=min_edge_length))
+        small_edges = cur.fetchall()
+        if not small_edges:
+            return
+
+        [max_fid] = cur.execute(SQL("SELECT MAX(OGC_FID) FROM crossing_points")).fetchone()
+        [srid]    = cur.execute(SQL("SELECT srid FROM geometry_columns WHERE f_table_name='crossing_points'")).fetchone()
+
+        # Group vertices connected by small edges
+        max_vtx = max(max(r[1],r[2]) for r in small_edges)
+        part = create_partition(max_vtx+1)
+        resolve_pairs(part, [r[1] for r in small_edges], [r[2] for r in small_edges])
+
+        # Compute the location of merged vertices
+        middles = {}
+        for [_, start_vtx, _, wkt] in small_edges:
+            pointtype, coords = parse_linestring(wkt)
+            middles.setdefault(part[start_vtx],[]).append(coords[0])
+
+        vertices = {}
+        points   = []
+        for n, (root, coords) in enumerate(middles.items()):
+            vtx, location = max_fid+n+1, np.mean(coords, axis=0)
+            vertices[root] = (vtx, location)
+            points.append((vtx, format_linestring(pointtype, [location])))
+
+        merged = dict((v, vertices[part[v]]) for r in small_edges for v in r[1:3])
+
+        logging.info("Sanitizer: merging {} vertices into {} vertices".format(len(merged),len(vertices)))
+
+        cur.executemany(SQL("DELETE FROM split_lines WHERE OGC_FID = ?"), [(r[0],) for r in small_edges])
+        cur.executemany(SQL("INSERT INTO crossing_points(OGC_FID, GEOMETRY) SELECT ?, GeomFromText(?, {srid})",
+                            srid=srid), points)
+
+        # Move end points of connected lines
+        updates = []
+        for [fid, start_vtx, end_vtx, wkt] in cur.execute(SQL(
+                "SELECT OGC_FID, START_VTX, END_VTX, AsText(GEOMETRY) FROM split_lines")).fetchall():
+            if start_vtx not in merged and end_vtx not in merged:
+                continue
+            linetype, coords = parse_linestring(wkt)
+            if start_vtx in merged:
+                start_vtx, coords[0] = merged[start_vtx]
+            if end_vtx in merged:
+                end_vtx, coords[-1] = merged[end_vtx]
+            updates.append((format_linestring(linetype, coords), start_vtx, end_vtx, fid))
+
+        cur.executemany(SQL("""UPDATE split_lines
+            SET GEOMETRY = GeomFromText(?, {srid}), START_VTX = ?, END_VTX = ?
+            WHERE OGC_FID = ?""", srid=srid), updates)
+
+        cur.executemany(SQL("DELETE FROM crossing_points WHERE OGC_FID = ?"), [(v,) for v in merged])
 
     def _6_remove_unconnected_elements(self, cur, attribute):
         """ Remove unconnected elements
 
-            TODO: Elaborate logic
+            Connected components are computed from a partition of the 
+            vertices of split lines: only the largest component is kept.
         """
         logging.info("Sanitizer: Resolving intersections: remove unconnected elements")
 
+        from .angles import create_partition, resolve_pairs
+
         cur.execute(SQL("ALTER TABLE split_lines ADD COLUMN COMPONENT integer"))
-        component = 0
-        while True:
-            component += 1
-            cur.execute(SQL("SELECT OGC_FID, START_VTX, END_VTX FROM split_lines "
-                "WHERE COMPONENT IS NULL LIMIT 1"))
-            res = cur.fetchone()
-            if not res:
-                break;
-            [ogc_fid, start_vtx, end_vtx] = res
-            cur.execute(SQL("UPDATE split_lines SET COMPONENT = "+str(component)+" "
-                "WHERE OGC_FID = "+str(ogc_fid)))
-            boundary = set([start_vtx, end_vtx])
-            finished = False
-
-            while len(boundary):
-                # get all connected vtx
-                cur.execute(SQL("SELECT OGC_FID, START_VTX, END_VTX FROM split_lines "
-                    "WHERE COMPONENT IS NULL AND (START_VTX IN ("+','.join([str(v) for v in boundary])+") "
-                    "OR END_VTX IN ("+','.join([str(v) for v in boundary])+"))"))
-                old_boundary = boundary
-                boundary = set()
-                fids = []
-                for [ogc_fid, start_vtx, end_vtx] in cur.fetchall():
-                    fids.append((ogc_fid,))
-                    if start_vtx not in old_boundary:
-                        boundary.add(start_vtx)
-                    if end_vtx not in old_boundary:
-                        boundary.add(end_vtx)
-                cur.executemany(SQL("UPDATE split_lines SET COMPONENT = "+str(component)+" "
-                    "WHERE OGC_FID = ?"), fids)
-
-        cur.execute(SQL("SELECT MAX(CT), COMPONENT FROM (SELECT COUNT(1) AS CT, COMPONENT FROM split_lines GROUP BY COMPONENT)"))
-        [count, component] = cur.fetchone()
-        cur.execute("DELETE FROM split_lines WHERE COMPONENT != "+str(component))
+
+        # Label connected components with a partition over vertices
+        rows = cur.execute(SQL("SELECT OGC_FID, START_VTX, END_VTX FROM split_lines")).fetchall()
+        if not rows:
+            raise BuilderError("No elements in table split_lines: check your input is valid !")
+        max_vtx = max(max(r[1],r[2]) for r in rows)
+        part = create_partition(max_vtx+1)
+        resolve_pairs(part, [r[1] for r in rows], [r[2] for r in rows])
+
+        components = [(ogc_fid, int(part[start_vtx])) for [ogc_fid, start_vtx, _] in rows]
+        with attr_table(cur, "line_component", dtype='integer', vacuum=False) as attrs:
+            attrs.update('split_lines', 'OGC_FID', 'COMPONENT', components)
+
+        # Keep the largest component
+        labels, counts = np.unique([c for _,c in components], return_counts=True)
+        component = labels[np.argmax(counts)]
+        logging.info("Sanitizer: found {} connected components".format(len(labels)))
+        cur.execute(SQL("DELETE FROM split_lines WHERE COMPONENT != {component}", component=component))
 
         if attribute:
             cur.execute(SQL("ALTER TABLE split_lines ADD COLUMN "+attribute))
@@ -567,7 +977,6 @@ class Sanitizer(object):
         self._drop_indexed_table(cur, "crossing_points")
         self._drop_indexed_table(cur, "crossings")
         self._drop_indexed_table(cur, "overlaping_lines")
-        cur.execute("VACUUM")
 
     def _drop_indexed_table(self, cur, table):
         """ Drop a table and its index
@@ -578,8 +987,13 @@ class Sanitizer(object):
         cur.execute(SQL("DROP TABLE %s" % table))
 
     def _create_indexed_table(self, cur, table, geomtype):
+        """ Create a table with an indexed geometry column
+
+            When resuming, any existing table left over from an interrupted run
+            is dropped
         """
-        """
+        if self._resume and table_exists(cur, table):
+            self._drop_indexed_table(cur, table)
         cur.execute(SQL("CREATE TABLE {table}(OGC_FID integer PRIMARY KEY)",table=table))
         cur.execute(SQL("""
             SELECT AddGeometryColumn(
@@ -600,11 +1014,60 @@ class Sanitizer(object):
         cur.execute(SQL("SELECT CreateSpatialIndex('{table}', 'GEOMETRY')",table=table))
 
 
-def sanitize( conn, table, snap_distance, min_edge_length, attribute=None ):
+def _sanitize_tile( task ):
+    """ Snap and cut lines of a tile in its own database
+
+        This function is run in worker processes
+
+        :return: a tuple (tile database, tile bbox) or None if the tile is empty
+    """
+    (dbname, table, tiledb, bbox, halo, srid, dim, snap_distance, in_memory_cut, grid_snap) = task
+    (x0, y0, x1, y1) = bbox
+
+    create_database(tiledb)
+    conn = connect_database(tiledb)
+    try:
+        cur = conn.cursor()
+        cur.execute(SQL("CREATE TABLE tile_input(OGC_FID integer PRIMARY KEY)"))
+        cur.execute(SQL("SELECT AddGeometryColumn('tile_input', 'GEOMETRY', ?, 'LINESTRING', ?)"),
+                    (srid, dim))
+        cur.execute(SQL("ATTACH DATABASE '{dbname}' AS src", dbname=dbname))
+        cur.execute(SQL("""INSERT INTO tile_input(OGC_FID, GEOMETRY)
+            SELECT OGC_FID, GEOMETRY FROM src.{table} WHERE OGC_FID IN (
+                SELECT pkid FROM src.idx_{table}_GEOMETRY
+                WHERE xmin <= {x1} AND xmax >= {x0} AND ymin <= {y1} AND ymax >= {y0})
+            """, table=table, x0=x0-halo, y0=y0-halo, x1=x1+halo, y1=y1+halo))
+        cur.execute(SQL("DETACH DATABASE src"))
+
+        [count] = cur.execute(SQL("SELECT Count(1) FROM tile_input")).fetchone()
+        if count == 0:
+            return None
+        cur.execute(SQL("SELECT CreateSpatialIndex('tile_input', 'GEOMETRY')"))
+
+        sanitizer = Sanitizer(conn, 'tile_input')
+        sanitizer.snap_geometries(cur, snap_distance, grid_snap=grid_snap)
+        sanitizer._1_find_overlapping_lines(cur)
+        sanitizer._2_find_crossing_points(cur)
+        sanitizer._3_cut_lines_at_nodes(cur, in_memory=in_memory_cut)
+        conn.commit()
+    finally:
+        conn.close()
+    return tiledb, bbox
+
+
+def _hash_parameters( **params ):
+    """ Return a digest of sanitizer parameters
+    """
+    import hashlib
+    return hashlib.md5(repr(sorted(params.items())).encode('utf-8')).hexdigest()
+
+
+def sanitize( conn, table, snap_distance, min_edge_length, attribute=None, **kwargs ):
     """ Wrap sanitizer call
+
+        Extra keyword arguments are passed to Sanitizer.sanitize
     """
     sanitizer = Sanitizer(conn, table)
-    sanitizer.sanitize(snap_distance, min_edge_length, attribute=attribute)
+    sanitizer.sanitize(snap_distance, min_edge_length, attribute=attribute, **kwargs)
 
     return sanitizer.work_table
-
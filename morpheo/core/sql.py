@@ -235,13 +235,17 @@ def fill_attribute_table( cur, name, rows ):
     cur.executemany(SQL("INSERT INTO %s(ID,VALUE) SELECT ?,?" % name),rows)
 
 
-def delete_attr_table( cur, name):
+def delete_attr_table( cur, name, vacuum=True):
     """ Delete attribute table
+
+        :param vacuum: Vacuum the database after deletion, must be False
+                       when called within a transaction
     """
     if table_exists(cur, name):
         cur.execute(SQL("DROP INDEX %s_ID_idx" % name))
         cur.execute(SQL("DROP TABLE %s" % name))
-        cur.execute(SQL("VACUUM"))
+        if vacuum:
+            cur.execute(SQL("VACUUM"))
 
 
 class AttrTable(object):
@@ -267,11 +271,11 @@ class AttrTable(object):
 
 
 @contextmanager
-def attr_table( cur, name, dtype='real'):
+def attr_table( cur, name, dtype='real', vacuum=True):
     attr_tab = AttrTable(cur, name, dtype=dtype) 
     try:
         yield attr_tab
     finally:
-        delete_attr_table(cur, name)
+        delete_attr_table(cur, name, vacuum=vacuum)
 
 
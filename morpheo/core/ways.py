@@ -13,7 +13,8 @@ from .errors import BuilderError, ErrorGraphNotFound
 from .sql import SQL, execute_sql, attr_table, table_exists
 from .classes import compute_classes
 from .layers import export_shapefile
-from .edge_properties import iter_places, compute_angles
+from .edge_properties import iter_places
+from .places import require_edge_ends
 
 
 def compute_way_classes(attr_table, cur, attribute, classes):
@@ -75,6 +76,12 @@ def read_ways_graph( path ):
                 "Error while reading graph {}: {}".format(graph_path,e))
 
 
+def way_partition_table( degrees ):
+    """ Return the name of the way partition table for a threshold in degrees
+    """
+    return "way_partition_{:g}".format(degrees).replace('.','_').replace('-','m')
+
+
 def distance(x1,y1,x2,y2):
     return np.sqrt((x2-x1)*(x2-x1)+(y2-y1)*(y2-y1))
 
@@ -89,9 +96,13 @@ class WayBuilder(object):
 
     def build_ways_from_attribute( self, name ):
         """ Compute ways using attribute name on edges
+
+            At each place, edges with the same name are chained in edge id
+            order and half the distance between the entry points of consecutive
+            edges is added to the distance correction of both edges, so that 
+            the result does not depend on the order of the rows.
         """
-        from itertools import combinations
-        from .angles import (create_partition, resolve, update, num_partitions)
+        from .angles import create_partition, resolve_pairs, num_partitions, group_offsets
  
         # Invalidate current line graph
         self._line_graph = None
@@ -103,61 +114,48 @@ class WayBuilder(object):
         # Get the (max) number of edges and places
         max_edges = cur.execute(SQL("SELECT Max(OGC_FID) FROM place_edges")).fetchone()[0]
 
-        # Get the entry vector for edges in each place
+        # Get the entry point of edges in each place
+        require_edge_ends(self._conn)
         rows = cur.execute(SQL("""SELECT 
-            pl, fid, name, ST_X(p1), ST_Y(p1)
-            FROM (
-                SELECT 
-                OGC_FID AS fid,
-                START_PL AS pl,
-                NAME AS name,
-                ST_StartPoint(GEOMETRY) AS p1
-                FROM place_edges
-                WHERE name NOT NULL
-            UNION ALL
-                SELECT 
-                OGC_FID AS fid,
-                END_PL AS pl,
-                NAME AS name,
-                ST_EndPoint(GEOMETRY) AS p1
-                FROM place_edges)
-                WHERE name NOT NULL
-            ORDER BY pl
+            e.PLACE, e.EDGE, p.NAME, e.X, e.Y, e.IS_START
+            FROM edge_ends AS e, place_edges AS p
+            WHERE p.OGC_FID=e.EDGE AND p.NAME NOT NULL
+            ORDER BY e.PLACE, e.ROWID
         """)).fetchall()
- 
-        # Array to store distance corrections for ways
-        distances = np.zeros(max_edges+1)
-  
+
+        logging.info("Ways: Pairing edges by name")
+
+        # Group edge ends by place and name: ends of each group
+        # are chained together in the same way
+        starts, sizes = group_offsets([r[0] for r in rows])
+        count_places  = len(starts)
+        codes  = {}
+        names  = np.array([codes.setdefault(r[2], len(codes)) for r in rows], dtype=int)
+        places = np.repeat(np.arange(count_places), sizes)
+        fids   = np.array([r[1] for r in rows], dtype=int)
+        coords = np.array([r[3:5] for r in rows], dtype=float).reshape(-1,2)
+        ends   = np.array([r[5] for r in rows], dtype=int)
+
+        # Chain ends by edge id (then start/end for loops) in each group
+        order = np.lexsort((ends, fids, names, places))
+        same  = (places[order[1:]] == places[order[:-1]]) & (names[order[1:]] == names[order[:-1]])
+        i, j  = order[:-1][same], order[1:][same]
+
         # Way partition: resolve each pair by assigning them
         # to the same equivalent class. Partition are computed 
         # by resolving transitive relationship. 
         ways = create_partition(max_edges+1)
-        def add_pair( e1, e2 ):
-            resolve(ways,e1[1],e2[1])
-            # Compute distance correction
-            # Split the distance between the two paired edges
-            # The correction will be the sum of all values for the same way
-            d = distance(e1[3],e1[4],e2[3],e2[4])
-            distances[e1[1]] = distances[e1[1]] + d/2.0
-            distances[e2[1]] = distances[e2[1]] + d/2.0
-
-        logging.info("Ways: Pairing edges by name")
-
-        progress = Progress(len(rows))
-        count_places = 0
-        for place, edges in iter_places(rows):
-            count_places = count_places+1
-            n = len(edges)
-            progress(n)
-            for (e1,e2) in combinations(edges,2):
-                if e1[2] == e2[2]:
-                    add_pair(e1,e2)
-
-        # Update partition
-        logging.info("Ways: updating partition")
-        update(ways)
+        resolve_pairs(ways, fids[i], fids[j])
         num_ways = num_partitions(ways)
 
+        # Compute distance correction
+        # Split the distance between the two paired edges
+        # The correction will be the sum of all values for the same way
+        d = distance(coords[i,0],coords[i,1],coords[j,0],coords[j,1])/2.0
+        distances = np.zeros(max_edges+1)
+        np.add.at(distances, fids[i], d)
+        np.add.at(distances, fids[j], d)
+
         logging.info("Ways: computed {} ways (num places={}, num edges={})".format(num_ways,count_places,max_edges))
       
         cur.execute(SQL("DELETE FROM way_partition"))
@@ -171,119 +169,116 @@ class WayBuilder(object):
         return num_ways
 
 
-    def build_ways(self, threshold):
-        """ Compute ways
+    def _pairing_candidates(self, cur):
+        """ Compute candidate pairs of edges at places
 
-            Pair edges for each place then resolve pairing as a partitioning
-            set: each resulting classes will be a way.
+            Edge ends are read once and candidate pairs for places with
+            more than 2 edges are sorted by deviation coefficient, so that
+            pairing can be replayed for any angle threshold (see _pair_edges).
 
-            :param threshold: The angle threshold (in radian) for pairing edges at each place.
+            :return: a tuple (max_edges, count_places, fids, x, y, pairs, angles, 
+                     couples) where pairs is a tuple (i,j) of sorted candidate pairs
+                     with their angles and couples the pairs of edges from places 
+                     with 2 edges, both as indices of edge ends
         """
-        from .angles import (create_partition, resolve, update, num_partitions, get_index_table,
-                             create_matrix, next_argmin, get_value, pop_args, get_remaining_elements,
-                             azimuth, angle_from_azimuth)
-      
-        # Invalidate current line graph
-        self._line_graph = None
-        cur = self._conn.cursor()
-
-        # Clean up way id on edges
-        cur.execute(SQL("UPDATE place_edges SET WAY = NULL"))
+        from .angles import group_offsets, group_pairs, sort_pairs, azimuths, angles_from_azimuths
 
         # Get the (max) number of edges and places
         max_edges  = cur.execute(SQL("SELECT Max(OGC_FID) FROM place_edges")).fetchone()[0]
 
         # Get the entry vector for edges in each place
-        rows = cur.execute(SQL("""SELECT 
-            pl, fid, ST_X(p1), ST_Y(p1), ST_X(p2), ST_Y(p2)
-            FROM (
-                SELECT 
-                OGC_FID AS fid,
-                START_PL AS pl,
-                ST_StartPoint(GEOMETRY) AS p1, 
-                ST_PointN(GEOMETRY,2) AS p2
-                FROM place_edges
-            UNION ALL
-                SELECT 
-                OGC_FID AS fid,
-                END_PL AS pl,
-                ST_EndPoint(GEOMETRY) AS p1, 
-                ST_PointN(GEOMETRY, ST_NumPoints(GEOMETRY)-1) AS p2
-                FROM place_edges)
-            ORDER BY pl
+        require_edge_ends(self._conn)
+        rows = cur.execute(SQL("""SELECT PLACE, EDGE, X, Y, AZIMUTH 
+            FROM edge_ends ORDER BY PLACE, ROWID
         """)).fetchall()
         
         def deviation( az1, x1, y1, az2, x2, y2 ):
-            """ Computei deviation  coefficient 
+            """ Compute deviation coefficients
 
                 C.Lagesse, ph.d thesis, p. 151
             """
-            a1 = azimuth(x1,y1,x2,y2)
-            a2 = azimuth(x2,y2,x1,y1)
+            a1 = azimuths(x1,y1,x2,y2)
+            a2 = azimuths(x2,y2,x1,y1)
             d  = distance(x1,y1,x2,y2)
-            return (abs( sin(angle_from_azimuth(az1,a1))) +
-                    abs( sin(angle_from_azimuth(az2,a2)))) * d 
-
-        logging.info("Ways: computing azimuth")
-        edges_az = [(r[0],r[1],azimuth(*r[2:6]),r[2],r[3]) for r in rows]
+            return (np.abs( sin(angles_from_azimuths(az1,a1))) +
+                    np.abs( sin(angles_from_azimuths(az2,a2)))) * d 
 
-        def compute_angles( edges ):
-            return create_matrix(edges, lambda e1,e2: angle_from_azimuth(e1[2],e2[2]))
-
-        def compute_coeffs( edges ):
-            return create_matrix(edges, lambda e1,e2: deviation(e1[2], e1[3], e1[4],
-                                                                e2[2], e2[3], e2[4]))
+        places = [r[0] for r in rows]
+        fids   = np.array([r[1] for r in rows], dtype=int)
+        coords = np.array([r[2:5] for r in rows], dtype=float).reshape(-1,3)
+        x, y, az = coords.T
 
         # Compute candidates pair for each places
-        # Each edge is given a way number, 
         # Places with degree=2 are automatically paired together
 
-        # Array to store distance corrections for ways
-        distances = np.zeros(max_edges+1)
-  
+        starts, sizes = group_offsets(places)
+
+        # For places with more than 2 edges, candidate pairs are visited
+        # by increasing deviation coefficient
+        g, i, j = group_pairs(starts, sizes, min_size=3)
+        order   = sort_pairs(g, i, j, deviation(az[i], x[i], y[i], az[j], x[j], y[j]))
+        i, j    = i[order], j[order]
+        couples = (starts[sizes==2], starts[sizes==2]+1)
+
+        return (max_edges, len(starts), fids, x, y, (i,j), angles_from_azimuths(az[i], az[j]), couples)
+
+    def _pair_edges(self, candidates, threshold):
+        """ Pair edges from candidate pairs for the given threshold
+
+            Candidate pairs are paired greedily if their angle is below the threshold.
+
+            :param candidates: candidates pairs as returned by _pairing_candidates
+            :param threshold: The angle threshold (in radian)
+            :return: a tuple (ways, distances) of the way partition and the distance
+                     corrections for each edge
+        """
+        from .angles import create_partition, resolve_pairs, greedy_pairing
+
+        max_edges, _, fids, x, y, (i,j), angles, (i2,j2) = candidates
+
+        below  = angles < threshold
+        i, j   = i[below], j[below]
+        paired = greedy_pairing(i, j, len(fids))
+        i = np.concatenate((i[paired], i2))
+        j = np.concatenate((j[paired], j2))
+
         # Way partition: resolve each pair by assigning them
         # to the same equivalent class. Partition are computed 
         # by resolving transitive relationship. 
         ways = create_partition(max_edges+1)
-        def add_pair( e1, e2 ):
-            resolve(ways,e1[1],e2[1])
-            # Compute distance correction
-            # Split the distance between the two paired edges
-            # The correction will be the sum of all values for the same way
-            d = distance(e1[3],e1[4],e2[3],e2[4])
-            distances[e1[1]] = distances[e1[1]] + d/2.0
-            distances[e2[1]] = distances[e2[1]] + d/2.0
+        resolve_pairs(ways, fids[i], fids[j])
 
-        logging.info("Ways: Pairing edges")
+        # Compute distance correction
+        # Split the distance between the two paired edges
+        # The correction will be the sum of all values for the same way
+        d = distance(x[i],y[i],x[j],y[j])/2.0
+        distances = np.zeros(max_edges+1)
+        np.add.at(distances, fids[i], d)
+        np.add.at(distances, fids[j], d)
+        return ways, distances
+
+    def build_ways(self, threshold):
+        """ Compute ways
+
+            Pair edges for each place then resolve pairing as a partitioning
+            set: each resulting classes will be a way.
+
+            :param threshold: The angle threshold (in radian) for pairing edges at each place.
+        """
+        from .angles import num_partitions
+      
+        # Invalidate current line graph
+        self._line_graph = None
+        cur = self._conn.cursor()
+
+        # Clean up way id on edges
+        cur.execute(SQL("UPDATE place_edges SET WAY = NULL"))
 
-        progress     = Progress(len(edges_az))
-        count_places = 0
-        for place, edges in iter_places(edges_az):
-            count_places = count_places+1
-            n = len(edges)
-            progress(n)
-            if n>2:
-                # Compute angles between edges
-                angles = compute_angles(edges)
-                # compute coeffs between edges
-                coeffs = compute_coeffs(edges)
-                for e1,e2 in next_argmin(coeffs):
-                    if get_value(angles,e1,e2) < threshold: 
-                        add_pair(edges[e1],edges[e2])
-                        pop_args(coeffs,e1,e2)
-                # Store end places from lonely edges
-                for e in get_remaining_elements(coeffs):
-                    pass
-            elif n==2:
-                # pair those 2 edge
-                add_pair(edges[0],edges[1]) 
-            else:
-                # No pairing: place has only one edge.
-                pass
-
-        # Update partition
-        logging.info("Ways: updating partition")
-        update(ways)
+        candidates = self._pairing_candidates(cur)
+        max_edges, count_places = candidates[:2]
+
+        logging.info("Ways: Pairing edges")
+        ways, distances = self._pair_edges(candidates, threshold)
         num_ways = num_partitions(ways)
 
         logging.info("Ways: computed {} ways (num places={}, num edges={})".format(num_ways,count_places,max_edges))
@@ -298,6 +293,61 @@ class WayBuilder(object):
         self._conn.commit()
         return num_ways
 
+    def sweep_ways(self, thresholds):
+        """ Compute way partitions for a list of thresholds
+
+            Candidate pairs are computed once and pairing is replayed
+            for each threshold: the partition for each threshold is stored 
+            in the table 'way_partition_<degrees>' (see way_partition_table)
+            and a summary of way counts and lengths is stored in 'way_sweep'.
+            The 'ways' table is not modified.
+
+            :param thresholds: list of angle thresholds (in radian)
+            :return: the list of summary rows as dicts
+        """
+        cur = self._conn.cursor()
+
+        candidates = self._pairing_candidates(cur)
+        edges   = cur.execute(SQL("SELECT OGC_FID, LENGTH FROM place_edges")).fetchall()
+        efids   = np.array([r[0] for r in edges], dtype=int)
+        lengths = np.array([r[1] or 0.0 for r in edges], dtype=float)
+
+        cur.execute(SQL("""CREATE TABLE IF NOT EXISTS way_sweep(
+            THRESHOLD real PRIMARY KEY, PARTITION text, NUM_WAYS integer,
+            MIN_LENGTH real, Q1_LENGTH real, MEDIAN_LENGTH real, Q3_LENGTH real,
+            MAX_LENGTH real, MEAN_LENGTH real)"""))
+
+        summary = []
+        for threshold in sorted(thresholds):
+            degrees = round(threshold*180.0/pi, 6)
+            table   = way_partition_table(degrees)
+            logging.info("Ways: pairing edges for threshold {:g}".format(degrees))
+            ways, distances = self._pair_edges(candidates, threshold)
+
+            cur.execute(SQL("DROP TABLE IF EXISTS {table}", table=table))
+            cur.execute(SQL("CREATE TABLE {table}(EDGE integer PRIMARY KEY, WAY integer, DIST real)",
+                            table=table))
+            cur.execute(SQL("CREATE INDEX {table}_WAY_idx ON {table}(WAY)", table=table))
+            cur.executemany(SQL("INSERT INTO {table}(EDGE,WAY,DIST) VALUES (?,?,?)", table=table),
+                    [(fid,int(way),distances[fid]) for fid,way in enumerate(ways)])
+
+            # Way lengths from edge lengths and distance corrections
+            _, labels = np.unique(ways[efids], return_inverse=True)
+            way_lengths = np.bincount(labels, weights=lengths+distances[efids])
+            q = np.percentile(way_lengths, [0,25,50,75,100]) if len(way_lengths) else [None]*5
+            row = dict(THRESHOLD=degrees, PARTITION=table, NUM_WAYS=len(way_lengths),
+                       MIN_LENGTH=q[0], Q1_LENGTH=q[1], MEDIAN_LENGTH=q[2], Q3_LENGTH=q[3], MAX_LENGTH=q[4],
+                       MEAN_LENGTH=way_lengths.mean() if len(way_lengths) else None)
+            cur.execute(SQL("""INSERT OR REPLACE INTO way_sweep({columns}) VALUES ({values})""",
+                            columns=','.join(row.keys()), values=','.join('?'*len(row))),
+                        [v if v is None or isinstance(v, str) else float(v) for v in row.values()])
+            logging.info("Ways: threshold {:g}: {} ways, median length {}".format(
+                         degrees, row['NUM_WAYS'], row['MEDIAN_LENGTH']))
+            summary.append(row)
+
+        self._conn.commit()
+        return summary
+
     def compute_local_attributes(self,  orthogonality=False, classes=0 ):
         """ Compute local way attributes
 
@@ -325,25 +375,27 @@ class WayBuilder(object):
 
     def compute_orthogonality(self):
         """ Compute orthogonality on ways
+
+            Angles between edges are computed in memory (see edge_properties.angle_rows)
         """
-        from .edge_properties import compute_angles
-        compute_angles(self._conn)   
+        from .angles import orthogonality_sums
+        from .edge_properties import angle_rows
 
-        # Update orthogonality
         logging.info("Ways: computing orthogonality")
-
-        cur = self._conn.cursor()
-        cur.execute(SQL("UPDATE ways SET ORTHOG = NULL"))
-        cur.execute(SQL("""UPDATE ways SET ORTHOG = (
-            SELECT Sum(inner)/ways.CONN FROM (
-            SELECT Min(a) AS inner FROM (
-                SELECT PLACE AS p, ANGLE AS a, WAY2 AS w, EDGE2 AS e
-                FROM way_angles WHERE WAY1=ways.WAY_ID
-                UNION ALL
-                SELECT PLACE AS p, ANGLE AS a, WAY1 AS w, EDGE1 AS e
-                FROM way_angles WHERE WAY2=ways.WAY_ID)
-                GROUP BY p,e
-           ))"""))
+        places, angles, ways1, edges1, ways2, edges2 = angle_rows(self._conn)
+
+        owners = np.concatenate((ways1, ways2))
+        keep   = owners >= 0
+        ways, sums = orthogonality_sums(owners[keep],
+                                        np.concatenate((places, places))[keep],
+                                        np.concatenate((edges2, edges1))[keep],
+                                        np.concatenate((angles, angles))[keep])
+
+        cur  = self._conn.cursor()
+        conn = dict(cur.execute(SQL("SELECT WAY_ID, CONN FROM ways")).fetchall())
+        with attr_table(cur, "way_orthogonality") as attrs:
+            attrs.update('ways', 'WAY_ID', 'ORTHOG',
+                         [(w, s/conn[w]) for w, s in zip(ways.tolist(), sums.tolist()) if conn.get(w)])
 
 
     def compute_global_attributes(self, betweenness=False, closeness=False, stress=False, 
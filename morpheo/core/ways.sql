@@ -5,7 +5,9 @@
 
 DELETE FROM ways;
 DELETE FROM way_places;
-DELETE FROM way_angles;
+
+-- Angles between edges are computed in memory: drop the table of older databases
+DROP TABLE IF EXISTS way_angles;
 
 -- Update place edges with way index
 
@@ -52,28 +54,57 @@ UPDATE ways SET LENGTH = (
 
 -- Degree
 -- Number of other intersecting ways
-UPDATE ways SET DEGREE = (
-    SELECT Count(DISTINCT WAY_ID) FROM way_places 
-    WHERE PLACE IN (SELECT PLACE FROM way_places WHERE WAY_ID=ways.WAY_ID) 
-    AND WAY_ID<>ways.WAY_ID 
-)
+
+-- Create temporary table
+CREATE TABLE IF NOT EXISTS way_degree(ID integer, VALUE integer);
+CREATE INDEX IF NOT EXISTS way_degree_idx ON way_degree(ID);
+
+DELETE FROM way_degree;
+
+INSERT INTO way_degree(ID,VALUE)
+    SELECT w.WAY_ID, Count(DISTINCT o.WAY_ID)
+    FROM way_places AS w, way_places AS o
+    WHERE o.PLACE=w.PLACE AND o.WAY_ID<>w.WAY_ID
+    GROUP BY w.WAY_ID
+;
+
+UPDATE ways SET DEGREE = COALESCE((SELECT VALUE FROM way_degree WHERE way_degree.ID=ways.WAY_ID), 0)
 ;
 
+-- Clean up
+DROP INDEX way_degree_idx;
+DROP TABLE way_degree;
+
 -- Connectivity
 -- Number of arcs in the viary graph intersected by a way wich are
 -- not part of that way (sum by place)
- 
-UPDATE ways SET CONN = (SELECT Count(1) FROM (
-    SELECT OGC_FID, START_PL FROM place_edges
-    WHERE START_PL IN (SELECT PLACE FROM way_places WHERE WAY_ID=ways.WAY_ID)
-    AND WAY<>ways.WAY_ID
-    UNION
-    SELECT OGC_FID, END_PL FROM place_edges
-    WHERE END_PL IN (SELECT PLACE FROM way_places WHERE WAY_ID=ways.WAY_ID)
-    AND WAY<>ways.WAY_ID)
-)
+
+-- Create temporary table
+CREATE TABLE IF NOT EXISTS way_conn(ID integer, VALUE integer);
+CREATE INDEX IF NOT EXISTS way_conn_idx ON way_conn(ID);
+
+DELETE FROM way_conn;
+
+INSERT INTO way_conn(ID,VALUE)
+    SELECT way, Count(1) FROM (
+        SELECT w.WAY_ID AS way, e.OGC_FID AS fid, e.START_PL AS pl
+        FROM way_places AS w, place_edges AS e
+        WHERE e.START_PL=w.PLACE AND e.WAY<>w.WAY_ID
+        UNION
+        SELECT w.WAY_ID AS way, e.OGC_FID AS fid, e.END_PL AS pl
+        FROM way_places AS w, place_edges AS e
+        WHERE e.END_PL=w.PLACE AND e.WAY<>w.WAY_ID
+    )
+    GROUP BY way
 ;
 
+UPDATE ways SET CONN = COALESCE((SELECT VALUE FROM way_conn WHERE way_conn.ID=ways.WAY_ID), 0)
+;
+
+-- Clean up
+DROP INDEX way_conn_idx;
+DROP TABLE way_conn;
+
 -- Spacing
 
 UPDATE ways SET SPACING = (SELECT ways.LENGTH/ways.CONN)
@@ -1,7 +1,8 @@
 # -*- coding: utf-8 -*-
 
 from __future__ import print_function
-import os 
+import os
+import logging
 import sys
 import pytest
 
@@ -68,6 +69,39 @@ def conn(request):
     request.addfinalizer(done)
     return Sql()
 
+
+@pytest.fixture
+def workdb(request, tmpdir):
+    """ Return a connection to a copy of the test database
+
+        The input table of the copy is named after the database basename,
+        as for databases created by the builder. Other copies may be opened
+        with 'connect_copy()'.
+    """
+    import shutil
+    from morpheo.core.sql import connect_database
+
+    connections = []
+
+    def connect_copy():
+        path = tmpdir.mkdir('copy_%d' % len(connections)).join(os.path.basename(database))
+        shutil.copy(database, str(path))
+        connections.append(connect_database(str(path)))
+        return connections[-1]
+
+    def done():
+        for connection in connections:
+            connection.close()
+
+    request.addfinalizer(done)
+
+    class WorkDb(object):
+        conn        = connect_copy()
+        input_table = os.path.basename(os.path.splitext(database)[0]).lower()
+
+    WorkDb.connect_copy = staticmethod(connect_copy)
+    return WorkDb()
+
     
 
 def pytest_addoption(parser):
@@ -77,4 +111,3 @@ def pytest_addoption(parser):
 def pytest_configure(config):
     global database
     database = config.getoption('database')
-
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+""" Test incremental update of the graph against a full rebuild
+"""
+
+from morpheo.core.sql import create_database, table_exists
+from morpheo.core.graph_builder import SpatialiteBuilder
+from morpheo.core.incremental import GraphUpdater, store_input_hashes, UPDATE_TABLE
+
+SNAP_DISTANCE   = 0.2
+MIN_EDGE_LENGTH = 4
+
+
+def _create_input(conn, table, features, srid, dim):
+    """ Create an input table from (fid, geometry) rows
+    """
+    cur = conn.cursor()
+    cur.execute("CREATE TABLE {}(OGC_FID integer PRIMARY KEY)".format(table))
+    cur.execute("SELECT AddGeometryColumn('{}', 'GEOMETRY', ?, 'LINESTRING', ?)".format(table), (srid, dim))
+    cur.execute("SELECT CreateSpatialIndex('{}', 'GEOMETRY')".format(table))
+    cur.executemany("INSERT INTO {}(OGC_FID, GEOMETRY) VALUES (?,?)".format(table), features)
+    conn.commit()
+
+
+def _build(dbname, features, srid, dim):
+    """ Build a graph from input features in a new database
+    """
+    create_database(dbname)
+    builder = SpatialiteBuilder(dbname, table='input')
+    _create_input(builder.connection, 'input', features, srid, dim)
+    store_input_hashes(builder.connection, 'input')
+    builder.build_graph(SNAP_DISTANCE, MIN_EDGE_LENGTH)
+    return builder
+
+
+def _summary(cur):
+    """ Return the number of edges and vertices, the degree distribution and the total length
+    """
+    [edges, length] = cur.execute("SELECT Count(1), Sum(LENGTH) FROM edges").fetchone()
+    [vertices] = cur.execute("SELECT Count(1) FROM vertices").fetchone()
+    degrees = cur.execute("SELECT DEGREE, Count(1) FROM vertices GROUP BY DEGREE ORDER BY DEGREE").fetchall()
+    return edges, vertices, degrees, length
+
+
+def test_update_graph(workdb, tmpdir):
+    """ Test that updating the graph gives the same graph as building it from the updated input
+    """
+    cur = workdb.conn.cursor()
+    [srid, dim] = cur.execute("""SELECT CAST(srid AS integer), coord_dimension
+        FROM geometry_columns WHERE f_table_name=?""", (workdb.input_table,)).fetchone()
+    features = cur.execute("SELECT OGC_FID, GEOMETRY FROM {}".format(workdb.input_table)).fetchall()
+
+    # Remove the features closest to the center and move one of them
+    [cx, cy] = cur.execute("""SELECT (Min(MbrMinX(GEOMETRY))+Max(MbrMaxX(GEOMETRY)))/2,
+        (Min(MbrMinY(GEOMETRY))+Max(MbrMaxY(GEOMETRY)))/2 FROM {}""".format(workdb.input_table)).fetchone()
+    closest = [r[0] for r in cur.execute("""SELECT OGC_FID FROM {}
+        ORDER BY Distance(GEOMETRY, MakePoint(?, ?, ?)) LIMIT 6""".format(workdb.input_table),
+        (cx, cy, srid)).fetchall()]
+    [moved] = cur.execute("SELECT ST_Translate(GEOMETRY, 3, 0, 0) FROM {} WHERE OGC_FID=?".format(
+                          workdb.input_table), (closest[0],)).fetchone()
+    updated = [(fid, moved if fid == closest[0] else geom) for fid, geom in features
+               if fid not in closest[1:]]
+
+    dbname  = str(tmpdir.join('update.sqlite'))
+    builder = _build(dbname, features, srid, dim)
+    conn    = builder.connection
+    _create_input(conn, UPDATE_TABLE, updated, srid, dim)
+    updater = GraphUpdater(conn, dbname, 'input')
+    assert updater.update(SNAP_DISTANCE, MIN_EDGE_LENGTH)
+
+    expected = _build(str(tmpdir.join('rebuild.sqlite')), updated, srid, dim)
+
+    cur = conn.cursor()
+    edges, vertices, degrees, length = _summary(cur)
+    expected_edges, expected_vertices, expected_degrees, expected_length = _summary(expected.connection.cursor())
+    assert (edges, vertices, degrees) == (expected_edges, expected_vertices, expected_degrees)
+    assert abs(length - expected_length) <= 1e-6*expected_length
+
+    # Input and sanitized tables hold the updated data
+    [count] = cur.execute("SELECT Count(1) FROM input").fetchone()
+    assert count == len(updated)
+    [count] = cur.execute("SELECT Count(1) FROM sanitized").fetchone()
+    assert count == edges
+
+    # Temporary update tables are dropped
+    for table in (UPDATE_TABLE, 'update_boxes', 'update_edges', 'update_vtx'):
+        assert not table_exists(cur, table)
+
+    conn.close()
+    expected.connection.close()
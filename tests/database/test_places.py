@@ -18,3 +18,39 @@ def test_no_null_place_edges(conn):
     count = conn.execute("SELECT Count(*) FROM place_edges WHERE GEOMETRY IS NULL").fetchone()[0]
     assert count == 0
 
+
+
+def test_edge_ends(workdb):
+    """ Test that edge ends are created on demand from place edges
+    """
+    from morpheo.core.places import require_edge_ends
+    from morpheo.core.angles import azimuth
+
+    cur = workdb.conn.cursor()
+    cur.execute("DROP TABLE IF EXISTS edge_ends")
+    require_edge_ends(workdb.conn)
+
+    rows = cur.execute("""SELECT PLACE, EDGE, IS_START, X, Y, AZIMUTH
+        FROM edge_ends ORDER BY EDGE, IS_START""").fetchall()
+    expected = cur.execute("""SELECT
+        START_PL, OGC_FID, 1,
+        ST_X(ST_StartPoint(GEOMETRY)), ST_Y(ST_StartPoint(GEOMETRY)),
+        ST_X(ST_PointN(GEOMETRY,2)), ST_Y(ST_PointN(GEOMETRY,2)),
+        END_PL, ST_X(ST_EndPoint(GEOMETRY)), ST_Y(ST_EndPoint(GEOMETRY)),
+        ST_X(ST_PointN(GEOMETRY,ST_NumPoints(GEOMETRY)-1)), ST_Y(ST_PointN(GEOMETRY,ST_NumPoints(GEOMETRY)-1))
+        FROM place_edges ORDER BY OGC_FID""").fetchall()
+    assert len(rows) == 2*len(expected)
+
+    for (end, start), r in zip(zip(rows[0::2], rows[1::2]), expected):
+        assert start[:3] == (r[0], r[1], 1)
+        assert end[:3]   == (r[7], r[1], 0)
+        assert (start[3], start[4]) == (r[3], r[4])
+        assert (end[3], end[4])     == (r[8], r[9])
+        assert abs(start[5] - azimuth(r[3], r[4], r[5], r[6])) < 1e-9
+        assert abs(end[5] - azimuth(r[8], r[9], r[10], r[11])) < 1e-9
+
+    # Already existing table is left unchanged
+    cur.execute("DELETE FROM edge_ends WHERE EDGE IN (SELECT EDGE FROM edge_ends LIMIT 1)")
+    require_edge_ends(workdb.conn)
+    [count] = cur.execute("SELECT Count(1) FROM edge_ends").fetchone()
+    assert count == len(rows) - 2
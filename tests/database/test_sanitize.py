@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+""" Test sanitizer stages against their reference spatialite implementation
+"""
+import time
+import logging
+import pytest
+
+from morpheo.core.angles import create_partition, resolve_pairs
+from morpheo.core.sanitize import Sanitizer
+
+
+def test_find_duplicated_lines(workdb):
+    """ Test that duplicated lines are the ones found with an Equals() self join
+    """
+    cur = workdb.conn.cursor()
+    sanitizer = Sanitizer(workdb.conn, workdb.input_table)
+    sanitizer._create_split_lines(cur)
+    cur.execute("INSERT INTO split_lines(GEOMETRY) SELECT GEOMETRY FROM edges")
+    cur.execute("INSERT INTO split_lines(GEOMETRY) SELECT ST_Reverse(GEOMETRY) FROM edges WHERE OGC_FID % 2 = 0")
+    cur.execute("INSERT INTO split_lines(GEOMETRY) SELECT GEOMETRY FROM edges WHERE OGC_FID % 3 = 0")
+    cur.execute("INSERT INTO split_lines(GEOMETRY) SELECT ST_Translate(GEOMETRY, 0.5, 0, 0) FROM edges WHERE OGC_FID % 5 = 0")
+
+    start = time.time()
+    rows = cur.execute("""SELECT l1.OGC_FID, l2.OGC_FID
+        FROM split_lines AS l1, split_lines AS l2
+        WHERE Equals(l1.GEOMETRY, l2.GEOMETRY)
+        AND l1.OGC_FID < l2.OGC_FID
+        AND l1.ROWID IN (
+                  SELECT ROWID FROM SpatialIndex
+                  WHERE f_table_name='split_lines' AND search_frame=l2.GEOMETRY)
+        """).fetchall()
+    [max_fid] = cur.execute("SELECT Max(OGC_FID) FROM split_lines").fetchone()
+    part = create_partition(max_fid+1)
+    resolve_pairs(part, [r[0] for r in rows], [r[1] for r in rows])
+    expected = set(fid for fid in range(max_fid+1) if part[fid] != fid)
+    elapsed_join = time.time() - start
+
+    start = time.time()
+    duplicates = sanitizer._find_duplicated_lines(cur)
+    elapsed_keys = time.time() - start
+
+    logging.info("Duplicated lines: self join {:.3f}s, grouped keys {:.3f}s".format(elapsed_join, elapsed_keys))
+    assert len(duplicates) == len(set(duplicates))
+    assert set(duplicates) == expected
+
+
+def _sanitized_summary(cur):
+    """ Return the number of lines, the number of distinct end points and the total length
+        of sanitized lines
+    """
+    [count, length] = cur.execute("SELECT Count(1), Sum(GLength(GEOMETRY)) FROM sanitized").fetchone()
+    [nodes] = cur.execute("""SELECT Count(1) FROM (
+        SELECT DISTINCT X(p), Y(p) FROM (
+            SELECT StartPoint(GEOMETRY) AS p FROM sanitized
+            UNION ALL
+            SELECT EndPoint(GEOMETRY) AS p FROM sanitized))""").fetchone()
+    return count, nodes, length
+
+
+def test_sanitize_tiles(workdb):
+    """ Test that sanitizing by tiles gives the same graph as sanitizing the whole data
+    """
+    snap_distance, min_edge_length = 0.2, 4
+    cur = workdb.conn.cursor()
+    [width] = cur.execute("SELECT Max(MbrMaxX(GEOMETRY))-Min(MbrMinX(GEOMETRY)) FROM {}".format(
+                          workdb.input_table)).fetchone()
+
+    results = []
+    for conn, tile_size in ((workdb.conn, None), (workdb.connect_copy(), width/3.0)):
+        sanitizer = Sanitizer(conn, workdb.input_table)
+        cur = conn.cursor()
+        sanitizer._drop_indexed_table(cur, sanitizer.work_table)
+        start = time.time()
+        sanitizer.sanitize(snap_distance, min_edge_length, tile_size=tile_size)
+        results.append((time.time() - start, _sanitized_summary(cur)))
+
+    (elapsed_whole, expected), (elapsed_tiles, (count, nodes, length)) = results
+    logging.info("Sanitize: whole data {:.3f}s, tiles {:.3f}s".format(elapsed_whole, elapsed_tiles))
+    assert (count, nodes) == expected[:2]
+    assert abs(length - expected[2]) <= 1e-6*expected[2]
+
+
+def test_snap_vertices(workdb):
+    """ Compare grid snapping with spatialite Snap()
+
+        End points of each feature are moved by at most the snap distance
+        by both methods.
+    """
+    snap_distance = 0.5
+    results = []
+    for conn, grid_snap in ((workdb.conn, False), (workdb.connect_copy(), True)):
+        sanitizer = Sanitizer(conn, workdb.input_table)
+        cur = conn.cursor()
+        start = time.time()
+        sanitizer.snap_geometries(cur, snap_distance, grid_snap=grid_snap)
+        elapsed = time.time() - start
+        ends = dict((r[0], r[1:]) for r in cur.execute("""SELECT OGC_FID,
+            X(StartPoint(GEOMETRY)), Y(StartPoint(GEOMETRY)), X(EndPoint(GEOMETRY)), Y(EndPoint(GEOMETRY))
+            FROM {}""".format(workdb.input_table)).fetchall())
+        results.append((elapsed, ends))
+
+    (elapsed_snap, expected), (elapsed_grid, ends) = results
+    logging.info("Snapping: Snap() {:.3f}s, grid {:.3f}s, distinct end points {} / {}".format(
+                 elapsed_snap, elapsed_grid,
+                 len(set(p for e in expected.values() for p in (e[:2], e[2:]))),
+                 len(set(p for e in ends.values() for p in (e[:2], e[2:])))))
+
+    assert set(ends) == set(expected)
+    for fid, (x1, y1, x2, y2) in ends.items():
+        u1, v1, u2, v2 = expected[fid]
+        assert (x1-u1)**2 + (y1-v1)**2 <= (2*snap_distance)**2
+        assert (x2-u2)**2 + (y2-v2)**2 <= (2*snap_distance)**2
+
+
+def test_sanitize_tiles_attribute(workdb):
+    """ Test that importing a way attribute is rejected when sanitizing by tiles
+    """
+    from morpheo.core.errors import BuilderError
+    from morpheo.core.graph_builder import SpatialiteBuilder
+
+    [dbname] = [r[2] for r in workdb.conn.execute("PRAGMA database_list").fetchall() if r[1] == 'main']
+    builder = SpatialiteBuilder(dbname, table=workdb.input_table)
+    try:
+        with pytest.raises(BuilderError):
+            builder.build_graph(0.2, 4, way_attribute='NAME', tile_size=100)
+    finally:
+        builder.connection.close()
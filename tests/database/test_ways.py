@@ -24,3 +24,50 @@ def test_positive_connectiviti(conn):
     rows = [r[0] for r in rows]
     assert len(rows)==0, "Found ways with null connectivity {}".format(rows)
  
+
+
+def _way_distances(conn):
+    """ Build ways from the NAME attribute and return edge distance corrections
+    """
+    from morpheo.core.ways import WayBuilder
+    WayBuilder(conn).build_ways_from_attribute('NAME')
+    rows = conn.execute("SELECT EDGE, DIST FROM way_partition").fetchall()
+    return dict(rows)
+
+
+def test_ways_from_attribute_distances(workdb):
+    """ Test that distance corrections sum half the distance between consecutive
+        same name edges at places, chained by edge id, whatever the order of edge ends
+    """
+    from morpheo.core.places import require_edge_ends
+
+    conn = workdb.conn
+    conn.execute("UPDATE place_edges SET NAME = 'n' || (OGC_FID % 3)")
+    require_edge_ends(conn)
+
+    rows = conn.execute("""SELECT e.PLACE, e.EDGE, p.NAME, e.X, e.Y, e.IS_START
+        FROM edge_ends AS e, place_edges AS p WHERE p.OGC_FID=e.EDGE""").fetchall()
+    groups = {}
+    for place, edge, name, x, y, start in rows:
+        groups.setdefault((place, name), []).append((edge, start, x, y))
+    expected = {}
+    for ends in groups.values():
+        ends.sort()
+        for (e1, _, x1, y1), (e2, _, x2, y2) in zip(ends[:-1], ends[1:]):
+            d = ((x2-x1)**2 + (y2-y1)**2)**0.5/2.0
+            expected[e1] = expected.get(e1, 0) + d
+            expected[e2] = expected.get(e2, 0) + d
+    assert any(len(ends) > 2 for ends in groups.values())
+
+    distances = _way_distances(conn)
+    for edge, d in distances.items():
+        assert abs(d - expected.get(edge, 0)) < 1e-6
+
+    # Reverse the order of edge ends
+    conn.execute("CREATE TEMP TABLE reversed_ends AS SELECT * FROM edge_ends ORDER BY ROWID DESC")
+    conn.execute("DELETE FROM edge_ends")
+    conn.execute("INSERT INTO edge_ends SELECT * FROM reversed_ends")
+    reversed_distances = _way_distances(conn)
+    assert set(reversed_distances) == set(distances)
+    for edge, d in distances.items():
+        assert abs(reversed_distances[edge] - d) < 1e-6
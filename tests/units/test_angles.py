@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+""" Partition and pairing unit tests
+"""
+
+import time
+import logging
+import numpy as np
+
+from morpheo.core.angles import (create_partition, resolve, resolve_pairs, update,
+                                 num_partitions, get_index_table,
+                                 create_matrix, next_argmin, get_value, pop_args,
+                                 angle_from_azimuth, azimuth,
+                                 group_offsets, group_pairs, sort_pairs, greedy_pairing,
+                                 azimuths, angles_from_azimuths, orthogonality_sums)
+
+
+def _random_places(seed, num_places=200, max_edges=8):
+    rng = np.random.RandomState(seed)
+    places = np.sort(rng.randint(num_places, size=num_places*max_edges//2))
+    az = rng.uniform(-np.pi, np.pi, size=len(places))
+    return places.tolist(), az
+
+
+def test_azimuths():
+    rng = np.random.RandomState(0)
+    x1, y1, x2, y2 = rng.uniform(-10, 10, size=(4, 50))
+    expected = [azimuth(*p) for p in zip(x1, y1, x2, y2)]
+    assert np.allclose(azimuths(x1, y1, x2, y2), expected)
+    az1, az2 = rng.uniform(-np.pi, np.pi, size=(2, 50))
+    expected = [angle_from_azimuth(a, b) for a, b in zip(az1, az2)]
+    assert np.allclose(angles_from_azimuths(az1, az2), expected)
+
+
+def test_group_pairs():
+    starts, sizes = group_offsets([1, 1, 2, 3, 3, 3])
+    assert starts.tolist() == [0, 2, 3]
+    assert sizes.tolist()  == [2, 1, 3]
+    g, i, j = group_pairs(starts, sizes, min_size=2)
+    pairs = sorted(zip(g.tolist(), i.tolist(), j.tolist()))
+    assert pairs == [(0, 0, 1), (3, 3, 4), (3, 3, 5), (3, 4, 5)]
+
+
+def test_greedy_pairing_matches_matrix():
+    """ Test that sorted pairing gives the same pairs as matrix pairing
+
+        Timings of both methods are logged.
+    """
+    threshold = np.pi/6
+    elapsed_matrix = elapsed_sorted = 0
+    for seed in range(5):
+        places, az = _random_places(seed)
+        # Use a coarse value for producing ties
+        value = lambda a, b: round(angle_from_azimuth(a, b)*(a+b+7), 1)
+
+        # Pairing from matrices
+        start = time.time()
+        expected = set()
+        starts, sizes = group_offsets(places)
+        for s, n in zip(starts, sizes):
+            if n < 3:
+                continue
+            idx = list(range(s, s+n))
+            angles = create_matrix(idx, lambda i, j: angle_from_azimuth(az[i], az[j]))
+            coeffs = create_matrix(idx, lambda i, j: value(az[i], az[j]))
+            for e1, e2 in next_argmin(coeffs):
+                if get_value(angles, e1, e2) < threshold:
+                    expected.add((s+e1, s+e2))
+                    pop_args(coeffs, e1, e2)
+        elapsed_matrix += time.time() - start
+
+        # Sorted pairing
+        start   = time.time()
+        g, i, j = group_pairs(starts, sizes, min_size=3)
+        values  = np.array([value(az[a], az[b]) for a, b in zip(i, j)])
+        order   = sort_pairs(g, i, j, values)
+        i, j    = i[order], j[order]
+        below   = angles_from_azimuths(az[i], az[j]) < threshold
+        i, j    = i[below], j[below]
+        paired  = greedy_pairing(i, j, len(places))
+        elapsed_sorted += time.time() - start
+
+        assert set(zip(i[paired].tolist(), j[paired].tolist())) == expected
+
+    logging.info("Pairing: matrices {:.3f}s, sorted pairs {:.3f}s".format(elapsed_matrix, elapsed_sorted))
+
+
+def _components(size, pairs):
+    """ Naive labelling of connected components by minimum index
+    """
+    labels = list(range(size))
+    changed = True
+    while changed:
+        changed = False
+        for a, b in pairs:
+            m = min(labels[a], labels[b])
+            if labels[a] != m or labels[b] != m:
+                labels[a] = labels[b] = m
+                changed = True
+    return labels
+
+
+def test_partition():
+    rng = np.random.RandomState(0)
+    for size, npairs in ((10, 0), (50, 20), (200, 150), (500, 1000)):
+        pairs = rng.randint(size, size=(npairs, 2)).tolist()
+        expected = _components(size, pairs)
+
+        table = create_partition(size)
+        for a, b in pairs:
+            resolve(table, a, b)
+        update(table)
+        assert table.tolist() == expected
+
+        table = create_partition(size)
+        resolve_pairs(table, [p[0] for p in pairs], [p[1] for p in pairs])
+        assert table.tolist() == expected
+
+        assert num_partitions(table) == len(set(expected))
+        ranks = {r: n for n, r in enumerate(sorted(set(expected)))}
+        assert get_index_table(table).tolist() == [ranks[r] for r in expected]
+
+
+def test_resolve_index():
+    """ Test that resolve returns the minimum index of the merged classes
+    """
+    table = create_partition(6)
+    assert resolve(table, 4, 5) == 4
+    assert resolve(table, 5, 3) == 3
+    assert resolve(table, 1, 2) == 1
+    assert resolve(table, 2, 5) == 1
+    update(table)
+    assert table.tolist() == [0, 1, 1, 1, 1, 1]
+
+
+def test_partition_incremental():
+    """ Test resolving pairs after updating the partition
+    """
+    rng = np.random.RandomState(1)
+    pairs = rng.randint(300, size=(400, 2)).tolist()
+    table = create_partition(300)
+    for a, b in pairs[:200]:
+        resolve(table, a, b)
+    update(table)
+    resolve_pairs(table, [p[0] for p in pairs[200:300]], [p[1] for p in pairs[200:300]])
+    for a, b in pairs[300:]:
+        resolve(table, a, b)
+    update(table)
+    assert table.tolist() == _components(300, pairs)
+
+
+def test_orthogonality_sums():
+    """ Test sums of minimum angles over (place, other) pairs
+    """
+    owners = np.array([1, 1, 1, 2, 2, 1])
+    places = np.array([5, 5, 6, 5, 5, 5])
+    others = np.array([3, 3, 3, 4, 3, 4])
+    angles = np.array([.5, .2, .7, .1, .3, .4])
+    o, sums = orthogonality_sums(owners, places, others, angles)
+    assert o.tolist() == [1, 2]
+    assert np.allclose(sums, [.2+.4+.7, .1+.3])
+
+    rng = np.random.RandomState(0)
+    owners, places, others = rng.randint(20, size=(3, 500))
+    angles = rng.uniform(0, 1, size=500)
+    mins = {}
+    for key, a in zip(zip(owners, places, others), angles):
+        mins[key] = min(a, mins.get(key, a))
+    expected = {}
+    for (owner, _, _), a in mins.items():
+        expected[owner] = expected.get(owner, 0) + a
+    o, sums = orthogonality_sums(owners, places, others, angles)
+    assert o.tolist() == sorted(expected)
+    assert np.allclose(sums, [expected[k] for k in o.tolist()])
+
+    o, sums = orthogonality_sums(np.array([], dtype=int), np.array([], dtype=int),
+                                 np.array([], dtype=int), np.array([]))
+    assert len(o) == len(sums) == 0
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+""" In-memory geometry helpers unit tests
+"""
+
+import numpy as np
+
+from morpheo.core.angles import create_partition, resolve_pairs
+from morpheo.core.geometry import (parse_linestring, format_linestring, locate_points,
+                                   linestring_key, cluster_seeds, cluster_points, cluster_sweep,
+                                   morton_order, parse_polygon, points_in_polygons)
+
+
+def test_parse_linestring():
+    linetype, coords = parse_linestring("LINESTRING(0 0,1.5 2,-3 4)")
+    assert linetype == 'LINESTRING'
+    assert coords.tolist() == [[0, 0], [1.5, 2], [-3, 4]]
+
+    linetype, coords = parse_linestring("LINESTRING Z(0 0 1, 1 1 2)")
+    assert linetype == 'LINESTRING Z'
+    assert coords.shape == (2, 3)
+
+    wkt = format_linestring(linetype, coords)
+    assert parse_linestring(wkt)[1].tolist() == coords.tolist()
+
+
+def test_locate_points():
+    coords = np.array([[0., 0.], [4., 0.], [4., 4.], [0., 4.]])
+    points = np.array([[2., 1.], [5., 2.], [0., 5.], [-1., -1.], [4., 0.]])
+    locations, distances = locate_points(coords, points)
+    assert np.allclose(locations, [2/12., 6/12., 1.0, 0.0, 4/12.])
+    assert np.allclose(distances, [1.0, 1.0, 1.0, np.sqrt(2), 0.0])
+
+    # Degenerated line
+    locations, distances = locate_points(np.array([[1., 1.], [1., 1.]]), points[:1])
+    assert locations.tolist() == [0.0]
+    assert np.allclose(distances, [1.0])
+
+
+def test_linestring_key():
+    line = np.array([[0., 0.], [1., 0.], [2., 1.]])
+    key  = linestring_key(line)
+    assert linestring_key(line[::-1]) == key
+    # Topologically equal line with an extra vertex
+    assert linestring_key(np.array([[0., 0.], [0.5, 0.], [1., 0.], [2., 1.]])) == key
+    # Z coordinates are ignored
+    assert linestring_key(np.array([[0., 0., 1.], [1., 0., 2.], [2., 1., 3.]])) == key
+    # Coordinates are not rounded
+    assert linestring_key(line + 1e-9) != key
+
+    # Closed lines share a key whatever their first vertex
+    ring = np.array([[0., 0.], [1., 0.], [1., 1.], [0., 0.]])
+    assert linestring_key(np.array([[1., 0.], [1., 1.], [0., 0.], [1., 0.]])) == linestring_key(ring)
+
+
+def _seeds(points, distance, groups):
+    """ Naive seed assignment
+    """
+    seeds = list(range(len(points)))
+    assigned = [False]*len(points)
+    for p in range(len(points)):
+        if assigned[p]:
+            continue
+        assigned[p] = True
+        for q in range(len(points)):
+            d = points[p] - points[q]
+            if not assigned[q] and groups[p] != groups[q] and np.sqrt((d*d).sum()) <= distance:
+                seeds[q], assigned[q] = p, True
+    return seeds
+
+
+def test_cluster_seeds():
+    points = np.array([[0., 0.], [.9, 0.], [1.8, 0.], [2.7, 0.]])
+    assert cluster_seeds(points, 1.0).tolist() == [0, 0, 2, 2]
+
+    rng = np.random.RandomState(0)
+    for seed in range(5):
+        points = rng.uniform(0, 10, size=(300, 2))
+        groups = rng.randint(50, size=300)
+        seeds  = cluster_seeds(points, 0.5, groups=groups)
+        assert seeds.tolist() == _seeds(points, 0.5, groups)
+        d = points - points[seeds]
+        assert np.sqrt((d*d).sum(axis=1)).max() <= 0.5
+
+
+def test_morton_order():
+    x, y = np.meshgrid(np.arange(4), np.arange(4))
+    order = morton_order(x.ravel(), y.ravel(), bits=2)
+    assert [(int(x.ravel()[k]), int(y.ravel()[k])) for k in order[:8]] == [
+        (0, 0), (1, 0), (0, 1), (1, 1), (2, 0), (3, 0), (2, 1), (3, 1)]
+    # Constant coordinates
+    assert morton_order([1, 1, 1], [2, 1, 0]).tolist() == [2, 1, 0]
+
+
+def _clusters(points, distance, groups=None):
+    """ Naive clustering from all pairs of points
+    """
+    d = points[:,None,:] - points[None,:,:]
+    close = np.triu(np.sqrt((d*d).sum(axis=2)) <= distance, 1)
+    if groups is not None:
+        close &= groups[:,None] != groups[None,:]
+    part = create_partition(len(points))
+    resolve_pairs(part, *np.nonzero(close))
+    return part.tolist()
+
+
+def test_cluster_points():
+    # Clusters are the transitive closure of close pairs
+    points = np.array([[0., 0.], [.9, 0.], [1.8, 0.], [2.7, 0.], [5., 0.]])
+    assert cluster_points(points, 1.0).tolist() == [0, 0, 0, 0, 4]
+    groups = np.array([0, 1, 1, 0, 0])
+    assert cluster_points(points, 1.0, groups=groups).tolist() == [0, 0, 2, 2, 4]
+
+    rng = np.random.RandomState(0)
+    for seed in range(5):
+        points = rng.uniform(-10, 10, size=(300, 2))
+        groups = rng.randint(50, size=300)
+        assert cluster_points(points, 0.6).tolist() == _clusters(points, 0.6)
+        assert cluster_points(points, 0.6, groups=groups).tolist() == _clusters(points, 0.6, groups)
+
+
+def test_cluster_sweep():
+    rng = np.random.RandomState(1)
+    points = rng.uniform(-10, 10, size=(500, 2))
+    distances = [0.8, 0.1, 0.4]
+    results = list(cluster_sweep(points, distances))
+    assert [d for d, _ in results] == sorted(distances)
+    for distance, part in results:
+        assert part.tolist() == cluster_points(points, distance).tolist()
+
+
+def test_parse_polygon():
+    rings = parse_polygon("POLYGON((0 0,4 0,4 4,0 4,0 0),(1 1,2 1,2 2,1 1))")
+    assert len(rings) == 2
+    assert rings[0].shape == (5, 2)
+    assert rings[1].tolist() == [[1, 1], [2, 1], [2, 2], [1, 1]]
+
+    rings = parse_polygon("POLYGON Z((0 0 1,4 0 1,4 4 1,0 0 1))")
+    assert len(rings) == 1
+    assert rings[0].shape == (4, 3)
+
+
+def test_points_in_polygons():
+    square = parse_polygon("POLYGON((0 0,4 0,4 4,0 4,0 0),(1 1,3 1,3 3,1 3,1 1))")
+    triangle = parse_polygon("POLYGON Z((5 0 1,9 0 1,5 4 1,5 0 1))")
+    points = np.array([[0.5, 0.5], [2., 2.], [3.5, 2.], [6., 1.], [8., 3.], [-1., 0.]])
+    pt, poly = points_in_polygons(points, [square, triangle])
+    assert sorted(zip(pt.tolist(), poly.tolist())) == [(0, 0), (2, 0), (3, 1)]
+
+    # Compare with testing each point against each polygon
+    rng = np.random.RandomState(0)
+    polygons = []
+    for cx, cy in rng.uniform(0, 100, size=(60, 2)):
+        a = np.sort(rng.uniform(0, 2*np.pi, size=6))
+        r = rng.uniform(1, 5, size=6)
+        ring = np.column_stack((cx + r*np.cos(a), cy + r*np.sin(a)))
+        polygons.append([np.vstack((ring, ring[:1]))])
+    points = rng.uniform(0, 100, size=(500, 2))
+    pt, poly = points_in_polygons(points, polygons, leaf_size=4)
+    expected = set()
+    for k, rings in enumerate(polygons):
+        for i in np.nonzero(_in_ring(points, rings[0]))[0]:
+            expected.add((int(i), k))
+    assert set(zip(pt.tolist(), poly.tolist())) == expected
+    assert len(pt) == len(expected)
+
+
+def _in_ring(points, ring):
+    """ Naive crossing number test
+    """
+    inside = []
+    for x, y in points:
+        n = 0
+        for (x1, y1), (x2, y2) in zip(ring[:-1], ring[1:]):
+            if (y1 > y) != (y2 > y) and x < x1 + (y - y1)*(x2 - x1)/(y2 - y1):
+                n += 1
+        inside.append(n % 2 == 1)
+    return np.array(inside)